@@ -1,7 +1,14 @@
+import os
+
 import pandas as pd
 import numpy as np
 import sys
 
+from .utils import format_chromo
+
+# Extension of annotation index files, which are stored next to BED files
+INDEX_EXT = '.idx.npz'
+
 
 def read_bed(filename, sort=False, usecols=[0, 1, 2], *args, **kwargs):
     """Read chromo,start,end from BED file without formatting chromo."""
@@ -9,7 +16,7 @@ def read_bed(filename, sort=False, usecols=[0, 1, 2], *args, **kwargs):
     d.columns = range(d.shape[1])
     d.rename(columns={0: 'chromo', 1: 'start', 2: 'end'}, inplace=True)
     if sort:
-        d.sort(['chromo', 'start', 'end'], inplace=True)
+        d.sort_values(['chromo', 'start', 'end'], inplace=True)
     return d
 
 
@@ -28,18 +35,17 @@ def in_which(x, ys, ye):
     numpy array of same length than x with index or -1
     """
 
-    n = len(ys)
-    m = len(x)
-    rv = np.empty(m, dtype=np.int)
+    x = np.asarray(x)
+    ys = np.asarray(ys)
+    ye = np.asarray(ye)
+    rv = np.empty(len(x), dtype=np.int64)
     rv.fill(-1)
-    i = 0
-    j = 0
-    while i < n and j < m:
-        while j < m and x[j] <= ye[i]:
-            if x[j] >= ys[i]:
-                rv[j] = i
-            j += 1
-        i += 1
+    if len(ys) == 0 or len(x) == 0:
+        return rv
+    # Index of last interval that starts at or before x[i]
+    idx = np.searchsorted(ys, x, side='right') - 1
+    found = (idx >= 0) & (x <= ye[np.maximum(idx, 0)])
+    rv[found] = idx[found]
     return rv
 
 
@@ -48,24 +54,61 @@ def is_in(pos, start, end):
 
 
 def distance(pos, start, end):
+    """Returns distance of positions to the nearest interval.
+
+    Parameters
+    ----------
+    pos : list of positions
+    start: list with start of non-overlapping interval sorted in ascending
+        order
+    end: list with end of interval
+
+    Returns
+    -------
+    numpy array of same length than pos with distances, which are zero for
+    positions in an interval
+    """
+
+    pos = np.asarray(pos, dtype=np.int64)
+    start = np.asarray(start)
+    end = np.asarray(end)
     m = len(start)
-    n = len(pos)
-    i = 0
-    j = 0
-    end_prev = -10**7
-    dist = np.zeros(n)
-    while i < m and j < n:
-        while j < n and pos[j] <= end[i]:
-            if pos[j] < start[i]:
-                dist[j] = min(pos[j] - end_prev, start[i] - pos[j])
-            j += 1
-        end_prev = end[i]
-        i += 1
-    dist[j:] = pos[j:] - end_prev
+    if m == 0:
+        return pos + 10**7
+    # Index of first interval that starts after pos[i]
+    idx = np.searchsorted(start, pos, side='right')
+    end_prev = np.where(idx > 0, end[np.maximum(idx - 1, 0)], -10**7)
+    dist = np.maximum(pos - end_prev, 0)
+    right = idx < m
+    start_next = start[np.minimum(idx, m - 1)]
+    dist[right] = np.minimum(dist[right], start_next[right] - pos[right])
     assert np.all(dist >= 0)
     return dist
 
 
+def _is_first(s, e, group=None):
+    """Returns boolean array that is `True` for intervals that do not overlap
+    with any previous interval, i.e. start after the running maximum of
+    previous ends. Intervals also do not overlap if `group` differs.
+    """
+    s = np.asarray(s)
+    e = np.asarray(e, dtype=np.int64)
+    first = np.ones(len(s), dtype=bool)
+    if len(s) < 2:
+        return first
+    if group is None:
+        cmax = np.maximum.accumulate(e)
+        first[1:] = s[1:] > cmax[:-1]
+    else:
+        # Running maximum within groups, which are sorted in ascending
+        # order, by offsetting ends of each group
+        group = np.asarray(group, dtype=np.int64)
+        offset = group * (int(e.max()) - int(min(e.min(), 0)) + 1)
+        cmax = np.maximum.accumulate(e + offset) - offset
+        first[1:] = (group[1:] != group[:-1]) | (s[1:] > cmax[:-1])
+    return first
+
+
 def join_overlapping(s, e):
     """Transforms a list of possible overlapping intervals into
     non-overlapping intervals.
@@ -77,37 +120,41 @@ def join_overlapping(s, e):
 
     Returns
     -------
-    Tuple (s, e) of non-overlapping intervals
+    Tuple (s, e) of numpy arrays with non-overlapping intervals
     """
-    rs = []
-    re = []
-    n = len(s)
-    if n == 0:
-        return (rs, re)
-    l = s[0]
-    r = e[0]
-    for i in range(1, n):
-        if s[i] > r:
-            rs.append(l)
-            re.append(r)
-            l = s[i]
-            r = e[i]
-        else:
-            r = max(r, e[i])
-    rs.append(l)
-    re.append(r)
-    return (rs, re)
+    s = np.asarray(s)
+    e = np.asarray(e)
+    if len(s) == 0:
+        return (s, e)
+    idx = np.nonzero(_is_first(s, e))[0]
+    return (s[idx], np.maximum.reduceat(e, idx))
 
 
 def join_overlapping_frame(d):
-    d = d.sort(['chromo', 'start', 'end'])
-    e = []
-    for chromo in d.chromo.unique():
-        dc = d.loc[d.chromo == chromo]
-        start, end = join_overlapping(dc.start.values, dc.end.values)
-        ec = pd.DataFrame(dict(chromo=chromo, start=start, end=end))
-        e.append(ec)
-    e = pd.concat(e)
+    """Joins overlapping intervals of all chromosomes at once.
+
+    Parameters
+    ----------
+    d : data frame with columns chromo, start, end
+
+    Returns
+    -------
+    Data frame with non-overlapping intervals sorted by chromo and start
+    """
+    d = d.sort_values(['chromo', 'start', 'end'])
+    chromo = d.chromo.values
+    start = d.start.values
+    end = d.end.values
+    group = np.empty(len(d), dtype=np.int64)
+    if len(d):
+        group[0] = 0
+        np.cumsum(chromo[1:] != chromo[:-1], out=group[1:])
+    idx = np.nonzero(_is_first(start, end, group))[0]
+    if len(idx):
+        end = np.maximum.reduceat(end, idx)
+    else:
+        end = end[idx]
+    e = pd.DataFrame(dict(chromo=chromo[idx], start=start[idx], end=end))
     e = e.loc[:, ['chromo', 'start', 'end']]
     return e
 
@@ -125,21 +172,9 @@ def group_overlapping(s, e):
     -------
     int array of length len(s) with group indices
     """
-    n = len(s)
-    group = np.zeros(n, dtype='int32')
-    if n == 0:
-        return group
-    idx = 0
-    l = s[0]
-    r = e[0]
-    for i in range(1, n):
-        if s[i] > r:
-            idx += 1
-            r = e[i]
-        else:
-            r = max(r, e[i])
-        group[i] = idx
-    return group
+    first = _is_first(s, e)
+    first[:1] = False
+    return np.cumsum(first, dtype='int32')
 
 
 def extend_len(start, end, min_len, min_pos=1):
@@ -157,3 +192,114 @@ def extend_len_frame(d, min_len):
     e['start'] = start
     e['end'] = end
     return e
+
+
+class AnnotationIndex(object):
+    """Merged intervals of an annotation partitioned by chromosome.
+
+    Parameters
+    ----------
+    chromos: List of chromosome names
+    offsets: Integer array of length len(chromos) + 1. Intervals of
+        chromosome chromos[i] are stored at offsets[i]:offsets[i + 1].
+    start: Start of non-overlapping intervals sorted in ascending order per
+        chromosome
+    end: End of intervals
+    """
+
+    def __init__(self, chromos, offsets, start, end):
+        if len(offsets) != len(chromos) + 1:
+            raise ValueError('Offsets do not match chromosomes!')
+        if len(start) != len(end) or len(start) != offsets[-1]:
+            raise ValueError('Start does not match end!')
+        self.chromos = list(chromos)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.start = start
+        self.end = end
+        self._index = {chromo: i for i, chromo in enumerate(self.chromos)}
+
+    @classmethod
+    def from_frame(cls, d):
+        """Creates index from data frame with columns chromo, start, end."""
+        d = join_overlapping_frame(d)
+        chromo = d.chromo.values
+        first = np.ones(len(d), dtype=bool)
+        first[1:] = chromo[1:] != chromo[:-1]
+        idx = np.nonzero(first)[0]
+        offsets = np.append(idx, len(d))
+        return cls(chromo[idx].tolist(), offsets,
+                   d.start.values.astype(np.int32),
+                   d.end.values.astype(np.int32))
+
+    @classmethod
+    def from_bed(cls, filename):
+        """Creates index from BED file, which is read once."""
+        d = pd.read_table(filename, header=None, usecols=[0, 1, 2],
+                          dtype={0: 'str', 1: 'int32', 2: 'int32'})
+        d.columns = ['chromo', 'start', 'end']
+        d['chromo'] = format_chromo(d.chromo)
+        return cls.from_frame(d)
+
+    def save(self, filename, **kwargs):
+        """Saves index to npz file `filename`.
+
+        `kwargs` are stored as additional arrays. The index is first written
+        to a temporary file, which is then renamed.
+        """
+        tmp_filename = '%s.tmp%d.npz' % (filename, os.getpid())
+        np.savez(tmp_filename, chromos=np.array(self.chromos, dtype=str),
+                 offsets=self.offsets, start=self.start, end=self.end,
+                 **kwargs)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['chromos'].tolist(), data['offsets'],
+                       data['start'], data['end'])
+
+    def __contains__(self, chromo):
+        return chromo in self._index
+
+    def get(self, chromo):
+        """Returns tuple (start, end) of intervals of `chromo`."""
+        i = self._index.get(chromo)
+        if i is None:
+            return (self.start[:0], self.end[:0])
+        idx = slice(self.offsets[i], self.offsets[i + 1])
+        return (self.start[idx], self.end[idx])
+
+    def is_in(self, chromo, pos):
+        """Returns boolean array if positions `pos` of `chromo` are in an
+        interval."""
+        return is_in(pos, *self.get(chromo))
+
+    def distance(self, chromo, pos):
+        """Returns distance of positions `pos` of `chromo` to the nearest
+        interval, which is zero for positions in an interval."""
+        return distance(pos, *self.get(chromo))
+
+
+def read_anno_index(filename, cache=True):
+    """Returns `AnnotationIndex` of BED file `filename`.
+
+    If `cache` is `True`, the index is stored in `filename` + `INDEX_EXT`
+    and rebuilt only if the size or modification time of `filename` changed.
+    """
+    stat = os.stat(filename)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    index_file = filename + INDEX_EXT
+    if cache and os.path.isfile(index_file):
+        with np.load(index_file) as data:
+            valid = 'source' in data and \
+                np.array_equal(data['source'], source)
+        if valid:
+            return AnnotationIndex.load(index_file)
+    index = AnnotationIndex.from_bed(filename)
+    if cache:
+        try:
+            index.save(index_file, source=source)
+        except OSError:
+            # Directory of BED file is not writable
+            pass
+    return index
@@ -5,6 +5,21 @@ import numpy as np
 CHAR_TO_INT = OrderedDict([('A', 0), ('T', 1), ('G', 2), ('C', 3), ('N', 4)])
 INT_TO_CHAR = {v: k for k, v in CHAR_TO_INT.items()}
 
+# Maps byte values to integers. Characters that are neither upper nor lower
+# case nucleotides are mapped to 'N'.
+_CHAR_TO_INT_TABLE = np.empty(256, dtype=np.int8)
+_CHAR_TO_INT_TABLE.fill(CHAR_TO_INT['N'])
+for _char, _code in CHAR_TO_INT.items():
+    _CHAR_TO_INT_TABLE[ord(_char)] = _code
+    _CHAR_TO_INT_TABLE[ord(_char.lower())] = _code
+
+_INT_TO_CHAR_TABLE = np.frombuffer(
+    ''.join([INT_TO_CHAR[i] for i in range(len(INT_TO_CHAR))]).encode(),
+    dtype=np.uint8)
+
+# One-hot encoding tables by (dim, dtype)
+_ONEHOT_TABLES = dict()
+
 
 def get_alphabet(special=False, reverse=False):
     alpha = OrderedDict(CHAR_TO_INT)
@@ -16,27 +31,53 @@ def get_alphabet(special=False, reverse=False):
 
 
 def char_to_int(seq):
-    return [CHAR_TO_INT[x] for x in seq.upper()]
+    """Converts DNA sequence to int8 array.
+
+    Parameters
+    ----------
+    seq: DNA sequence as string, bytes, or uint8 array of character codes.
+        Sequences are converted without copying them into an intermediate
+        list, and lower case characters are treated as upper case.
+
+    Returns
+    -------
+    int8 numpy array of same length as `seq`
+    """
+    if isinstance(seq, str):
+        seq = seq.encode('latin-1')
+    if not isinstance(seq, np.ndarray):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+    return _CHAR_TO_INT_TABLE.take(seq.view(np.uint8))
 
 
 def int_to_char(seq, join=True):
-    t = [INT_TO_CHAR[x] for x in seq]
-    if join:
-        t = ''.join(t)
+    seq = np.asarray(seq, dtype=np.uint8)
+    t = _INT_TO_CHAR_TABLE.take(seq).tobytes().decode()
+    if not join:
+        t = list(t)
     return t
 
 
-def int_to_onehot(seqs, dim=4):
-    """Special nucleotides will be encoded as [0, 0, 0, 0]."""
+def _get_onehot_table(dim, dtype):
+    key = (dim, np.dtype(dtype).str)
+    table = _ONEHOT_TABLES.get(key)
+    if table is None:
+        # Rows of integers >= dim and negative integers are zero
+        table = np.eye(256, dim, dtype=dtype)
+        _ONEHOT_TABLES[key] = table
+    return table
+
+
+def int_to_onehot(seqs, dim=4, dtype='int8'):
+    """Special nucleotides will be encoded as [0, 0, 0, 0].
+
+    Looks up integers in a precomputed identity table and directly returns
+    an array of type `dtype`, e.g. the Keras floatx.
+    """
     seqs = np.atleast_2d(np.asarray(seqs))
-    n = seqs.shape[0]
-    l = seqs.shape[1]
-    enc_seqs = np.zeros((n, l, dim), dtype='int8')
-    for i in range(dim):
-        t = seqs == i
-        enc_seqs[t, i] = 1
-    return enc_seqs
+    table = _get_onehot_table(dim, dtype)
+    return table.take(seqs.astype(np.uint8, copy=False), axis=0)
 
 
-def onehot_to_int(seqs, axis=-1):
-    return seqs.argmax(axis=axis)
+def onehot_to_int(seqs, axis=-1, dtype='int8'):
+    return seqs.argmax(axis=axis).astype(dtype, copy=False)
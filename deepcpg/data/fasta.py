@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import os
 from glob import glob
 import gzip as gz
@@ -41,14 +42,203 @@ def read_file(filename, gzip=None):
     return parse_lines(lines)
 
 
-def read_chromo(dna_db, chromo):
+def get_chromo_file(dna_db, chromo):
     filename = glob(os.path.join(dna_db, '*.chromosome.%s.*fa.gz' % chromo))
     if len(filename) != 1:
         tmp = 'File for chromosome "%s" not found in "%s"!' % (chromo, dna_db)
         raise ValueError(tmp)
-    filename = filename[0]
+    return filename[0]
+
 
+def read_chromo(dna_db, chromo):
+    filename = get_chromo_file(dna_db, chromo)
     fasta_seqs = read_file(filename)
     if len(fasta_seqs) != 1:
         raise 'Single sequence expected in file "%s"!' % filename
     return fasta_seqs[0].seq
+
+
+class FaiRecord(object):
+    """Entry of FASTA index.
+
+    Attributes
+    ----------
+    name: Sequence name, i.e. first word of header line
+    length: Number of bases
+    offset: Byte offset of first base in file
+    line_bases: Number of bases per line
+    line_bytes: Number of bytes per line including the line terminator
+    """
+
+    def __init__(self, name, length, offset, line_bases, line_bytes):
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_bytes = line_bytes
+
+    def byte_offset(self, pos):
+        """Returns byte offset of zero-based position `pos`."""
+        return self.offset + (pos // self.line_bases) * self.line_bytes + \
+            pos % self.line_bases
+
+
+def _open(filename, mode='rb'):
+    if filename.endswith('.gz'):
+        return gz.open(filename, mode)
+    return open(filename, mode)
+
+
+def index_file(filename):
+    """Builds FASTA index by scanning `filename` once line by line.
+
+    All lines of a sequence except the last must have the same length, and
+    blank lines are only allowed at the end of a sequence, since bases
+    could not be located by their byte offset otherwise.
+
+    Returns
+    -------
+    OrderedDict with `FaiRecord` of each sequence in `filename`.
+    """
+    index = OrderedDict()
+    rec = None
+    offset = 0
+    last_line = False
+    with _open(filename) as fh:
+        for line in fh:
+            line_len = len(line)
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode()
+                rec = FaiRecord(name, 0, offset + line_len, 0, 0)
+                index[name] = rec
+                last_line = False
+            elif rec is not None:
+                nb_base = len(line.rstrip())
+                if not nb_base:
+                    # Blank lines end the sequence
+                    last_line = True
+                else:
+                    if last_line or (rec.line_bases and
+                                     nb_base > rec.line_bases):
+                        tmp = 'Lines of sequence "%s" in "%s" differ in length!'
+                        raise ValueError(tmp % (rec.name, filename))
+                    if not rec.line_bases:
+                        rec.line_bases = nb_base
+                        rec.line_bytes = line_len
+                    elif nb_base != rec.line_bases or line_len != rec.line_bytes:
+                        last_line = True
+                    rec.length += nb_base
+            offset += line_len
+    return index
+
+
+def write_index(index, filename):
+    with open(filename, 'w') as f:
+        for rec in index.values():
+            f.write('%s\t%d\t%d\t%d\t%d\n' % (rec.name, rec.length, rec.offset,
+                                              rec.line_bases, rec.line_bytes))
+
+
+def read_index(filename):
+    index = OrderedDict()
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip().split('\t')
+            if len(line) < 5:
+                continue
+            index[line[0]] = FaiRecord(line[0], *[int(x) for x in line[1:5]])
+    return index
+
+
+def load_index(filename, index_filename=None):
+    """Returns index of `filename` stored in `index_filename`.
+
+    `index_filename` is `filename`.fai by default. Returns `None` if it does
+    not exist or is older than `filename`, which may have been replaced.
+    """
+    if index_filename is None:
+        index_filename = filename + '.fai'
+    if not os.path.isfile(index_filename) or \
+            os.stat(index_filename).st_mtime_ns < \
+            os.stat(filename).st_mtime_ns:
+        return None
+    return read_index(index_filename)
+
+
+class IndexedFastaReader(object):
+    """Reads arbitrary sequence ranges without parsing the entire file.
+
+    Uses the index `filename`.fai if it exists and is not older than
+    `filename`, and creates it otherwise.
+    Plain FASTA files are accessed by seeking to byte offsets. Gzip files
+    are decompressed while seeking forward and from the start of the file
+    while seeking backward. The bytes of the last read range are buffered,
+    such that ranges with ascending start, which may overlap, are read in a
+    single forward pass over the file.
+    """
+
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        if index_filename is None:
+            index_filename = filename + '.fai'
+        self.index = load_index(filename, index_filename)
+        if self.index is None:
+            self.index = index_file(filename)
+            try:
+                write_index(self.index, index_filename)
+            except OSError:
+                pass
+        self.fh = _open(filename)
+        # Bytes [_buf_start, _buf_start + len(_buf)) of the last read, which
+        # ends at the current file offset
+        self._buf_start = 0
+        self._buf = b''
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return list(self.index.keys())
+
+    def get_length(self, name):
+        return self.index[name].length
+
+    def fetch(self, name, start, end):
+        """Returns bytes of sequence `name` in zero-based range [start, end).
+
+        The range is clipped to the sequence borders.
+        """
+        rec = self.index[name]
+        start = max(0, start)
+        end = min(rec.length, end)
+        if start >= end:
+            return b''
+        seq = self._read(rec.byte_offset(start), rec.byte_offset(end - 1) + 1)
+        return seq.replace(b'\n', b'').replace(b'\r', b'')
+
+    def _read(self, byte_start, byte_end):
+        """Reads bytes [byte_start, byte_end) without seeking backward if
+        `byte_start` is not before the start of the last read."""
+        buf_end = self._buf_start + len(self._buf)
+        if self._buf_start <= byte_start and byte_end <= buf_end:
+            return self._buf[(byte_start - self._buf_start):
+                             (byte_end - self._buf_start)]
+        if self._buf_start <= byte_start <= buf_end:
+            # Continue reading at the current offset
+            data = self._buf[(byte_start - self._buf_start):] + \
+                self.fh.read(byte_end - buf_end)
+        else:
+            self.fh.seek(byte_start)
+            data = self.fh.read(byte_end - byte_start)
+        self._buf_start = byte_start
+        self._buf = data
+        return data
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
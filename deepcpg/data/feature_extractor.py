@@ -1,5 +1,8 @@
 import numpy as np
 
+from . import annotations as an
+from .utils import CPG_NAN
+
 
 class KnnCpgFeatureExtractor(object):
     """Extracts k CpG sites next to target sites. Excludes CpG sites at the
@@ -9,7 +12,7 @@ class KnnCpgFeatureExtractor(object):
     def __init__(self, k=1):
         self.k = k
 
-    def extract(self, x, y, ys):
+    def extract(self, x, y, ys, compact=False):
         """Extracts state and distance of k CpG sites next to target sites.
         Target site is excluded.
 
@@ -18,6 +21,8 @@ class KnnCpgFeatureExtractor(object):
         x: numpy array with target positions sorted in ascending order
         y: numpy array with source positions sorted in ascending order
         ys: numpy array with source CpG states
+        compact: Return int8 states and int32 distances with missing
+            neighbors set to `CPG_NAN` instead of float arrays with `nan`
 
         Returns
         -------
@@ -26,52 +31,67 @@ class KnnCpgFeatureExtractor(object):
             dist: Distances to the left (0:k) and right (k:2k)
         """
 
-        n = len(x)
+        x = np.asarray(x)
+        knn_cpg, knn_dist = self.__empty((len(x), 2 * self.k), compact)
+        self.__fill(x, self.__offsets(len(x)), y, ys, knn_cpg, knn_dist)
+        return (knn_cpg, knn_dist)
+
+    def extract_cells(self, x, profiles, compact=False):
+        """Extracts state and distance of k CpG sites next to target sites
+        for multiple cells at once.
+
+        Parameters
+        ----------
+        x: numpy array with target positions sorted in ascending order
+        profiles: list of tuples (y, ys) with source positions sorted in
+            ascending order and source CpG states of each cell
+        compact: see `extract`
+
+        Returns
+        -------
+        Tuple (cpg, dist) with numpy arrays of dimension
+        (len(x), len(profiles), 2k) and the same layout as `extract`.
+        """
+
+        x = np.asarray(x)
+        knn_cpg, knn_dist = self.__empty((len(x), len(profiles), 2 * self.k),
+                                         compact)
+        offsets = self.__offsets(len(x))
+        for i, (y, ys) in enumerate(profiles):
+            self.__fill(x, offsets, y, ys, knn_cpg[:, i], knn_dist[:, i])
+        return (knn_cpg, knn_dist)
+
+    def __empty(self, shape, compact):
+        if compact:
+            knn_cpg = np.full(shape, CPG_NAN, dtype=np.int8)
+            knn_dist = np.full(shape, CPG_NAN, dtype=np.int32)
+        else:
+            knn_cpg = np.full(shape, np.nan, dtype=np.float16)
+            knn_dist = np.full(shape, np.nan, dtype=np.float32)
+        return (knn_cpg, knn_dist)
+
+    def __offsets(self, n):
+        """Returns offsets of neighbors relative to the first source site
+        that is >= the target site."""
+        return np.broadcast_to(np.arange(-self.k, self.k), (n, 2 * self.k))
+
+    def __fill(self, x, offsets, y, ys, knn_cpg, knn_dist):
+        """Fills `knn_cpg` and `knn_dist` with neighbors of `x` in `y`."""
+        y = np.asarray(y)
+        ys = np.asarray(ys)
         m = len(y)
+        if not m:
+            return
         k = self.k
-        kk = 2 * self.k
+        # Left neighbors are yc - k, ..., yc - 1 and right neighbors start
+        # at yc, or at yc + 1 if the source site at yc is the target site.
         yc = self.__larger_equal(x, y)
-        knn_cpg = np.empty((n, kk), dtype=np.float16)
-        knn_cpg.fill(np.nan)
-        knn_dist = np.empty((n, kk), dtype=np.float32)
-        knn_dist.fill(np.nan)
-
-        for i in range(n):
-            # Left side
-            yl = yc[i] - k
-            yr = yc[i] - 1
-            if yr >= 0:
-                xl = 0
-                xr = k - 1
-                if yl < 0:
-                    xl += np.abs(yl)
-                    yl = 0
-                xr += 1
-                yr += 1
-                knn_cpg[i, xl:xr] = ys[yl:yr]
-                knn_dist[i, xl:xr] = np.abs(y[yl:yr] - x[i])
-
-            # Right side
-            yl = yc[i]
-            if yl >= m:
-                continue
-            if x[i] == y[yl]:
-                yl += 1
-                if yl >= m:
-                    continue
-            yr = yl + k - 1
-            xl = 0
-            xr = k - 1
-            if yr >= m:
-                xr -= yr - m + 1
-                yr = m - 1
-            xl += k
-            xr += k + 1
-            yr += 1
-            knn_cpg[i, xl:xr] = ys[yl:yr]
-            knn_dist[i, xl:xr] = np.abs(y[yl:yr] - x[i])
-
-        return (knn_cpg, knn_dist)
+        idx = offsets + yc[:, None]
+        idx[:, k:] += ((yc < m) & (y[np.minimum(yc, m - 1)] == x))[:, None]
+        valid = (idx >= 0) & (idx < m)
+        idx = np.clip(idx, 0, m - 1)
+        knn_cpg[valid] = ys[idx[valid]]
+        knn_dist[valid] = np.abs(y[idx] - x[:, None])[valid]
 
     def __larger_equal(self, x, y):
         """Returns for each x[i] index j, s.t. y[j] >= x[i].
@@ -82,20 +102,7 @@ class KnnCpgFeatureExtractor(object):
         y : numpy array of with positions sorted in ascending order
         """
 
-        n = len(x)
-        m = len(y)
-        rv = np.empty(n, dtype=np.int)
-        i = 0
-        j = 0
-        while i < n and j < m:
-            while j < m and x[i] > y[j]:
-                j += 1
-            rv[i] = j
-            i += 1
-        if i < n:
-            # x[i] > y[m - 1]
-            rv[i:] = m
-        return rv
+        return np.searchsorted(y, x, side='left')
 
 
 class IntervalFeatureExtractor(object):
@@ -113,27 +120,10 @@ class IntervalFeatureExtractor(object):
 
         Returns
         -------
-        Tuple (s, e) of non-overlapping intervals
+        Tuple (s, e) of numpy arrays with non-overlapping intervals
         """
 
-        rs = []
-        re = []
-        n = len(s)
-        if n == 0:
-            return (rs, re)
-        l = s[0]
-        r = e[0]
-        for i in range(1, n):
-            if s[i] > r:
-                rs.append(l)
-                re.append(r)
-                l = s[i]
-                r = e[i]
-            else:
-                r = max(r, e[i])
-        rs.append(l)
-        re.append(r)
-        return (rs, re)
+        return an.join_overlapping(s, e)
 
     @staticmethod
     def index_intervals(x, ys, ye):
@@ -151,30 +141,47 @@ class IntervalFeatureExtractor(object):
         numpy array of same length than x with index or -1
         """
 
-        n = len(ys)
-        m = len(x)
-        rv = np.empty(m, dtype=np.int)
-        rv.fill(-1)
-        i = 0
-        j = 0
-        while i < n and j < m:
-            while j < m and x[j] <= ye[i]:
-                if x[j] >= ys[i]:
-                    rv[j] = i
-                j += 1
-            i += 1
-        return rv
+        return an.in_which(x, ys, ye)
 
     def extract(self, x, ys, ye):
-        return self.index_intervals(x, ys, ye) >= 0
+        return an.is_in(x, ys, ye)
 
 
 class KmersFeatureExtractor(object):
+    """Extracts k-mer frequencies from integer sequences.
+
+    Parameters
+    ----------
+    kmer_len: Length k of k-mers
+    nb_char: Number of characters. K-mers with characters >= nb_char, e.g.
+        'N', are not counted.
+    sparse: Return `scipy.sparse.csr_matrix` instead of dense array, e.g.
+        for large k
+    """
 
-    def __init__(self, kmer_len, nb_char=4):
+    # Maximum number of k-mers that are hashed, and of dense frequencies
+    # that are counted, at once
+    _BATCH_KMERS = 2**22
+
+    def __init__(self, kmer_len, nb_char=4, sparse=False):
         self.kmer_len = kmer_len
         self.nb_char = nb_char
         self.nb_kmer = self.nb_char**self.kmer_len
+        self.sparse = sparse
+
+    def _hash(self, seqs):
+        """Returns base nb_char hash of k-mers at all offsets of `seqs`, with
+        the first character as least significant digit, and boolean array
+        that is `True` for k-mers without invalid characters."""
+        nb_pos = seqs.shape[1] - self.kmer_len + 1
+        kmers = np.zeros((len(seqs), nb_pos), dtype=np.int64)
+        valid = np.ones((len(seqs), nb_pos), dtype=bool)
+        for i in reversed(range(self.kmer_len)):
+            chars = seqs[:, i:(i + nb_pos)]
+            kmers *= self.nb_char
+            kmers += chars
+            valid &= (chars >= 0) & (chars < self.nb_char)
+        return (kmers, valid)
 
     def __call__(self, seqs):
         """Extracts kmer frequencies from integer sequences.
@@ -185,15 +192,48 @@ class KmersFeatureExtractor(object):
 
         Returns
         -------
-        freq: numpy array of size M x C of kmer frequencies.
+        freq: numpy array of size M x C of kmer frequencies, or sparse
+            matrix if `sparse` is `True`.
         """
 
+        seqs = np.asarray(seqs)
         nb_seq, seq_len = seqs.shape
-        kmer_freq = np.zeros((nb_seq, self.nb_kmer), dtype=np.int32)
-        vec = np.array([self.nb_char**i for i in range(self.kmer_len)],
-                       dtype=np.int32)
-        for i in range(nb_seq):
-            for j in range(seq_len - self.kmer_len + 1):
-                kmer = seqs[i, j:(j + self.kmer_len)]
-                kmer_freq[i, kmer.dot(vec)] += 1
+        nb_pos = max(seq_len - self.kmer_len + 1, 0)
+        batch_size = max(1, self._BATCH_KMERS // max(nb_pos, 1))
+        if self.sparse:
+            from scipy import sparse
+            kmer_freq = []
+        else:
+            kmer_freq = np.zeros((nb_seq, self.nb_kmer), dtype=np.int32)
+            # `np.bincount` returns int64 counts of all k-mers of a batch
+            batch_size = min(batch_size,
+                             max(1, self._BATCH_KMERS // self.nb_kmer))
+        if nb_pos == 0:
+            nb_seq = 0
+
+        for start in range(0, nb_seq, batch_size):
+            batch = seqs[start:(start + batch_size)]
+            kmers, valid = self._hash(batch)
+            rows = np.broadcast_to(np.arange(len(batch))[:, None],
+                                   kmers.shape)[valid]
+            kmers = kmers[valid]
+            if self.sparse:
+                freq = sparse.coo_matrix(
+                    (np.ones(len(kmers), dtype=np.int32), (rows, kmers)),
+                    shape=(len(batch), self.nb_kmer))
+                kmer_freq.append(freq.tocsr())
+            else:
+                # Count k-mers of all sequences at once by offsetting hashes
+                # of sequence i by i * nb_kmer
+                freq = np.bincount(rows * self.nb_kmer + kmers,
+                                   minlength=len(batch) * self.nb_kmer)
+                kmer_freq[start:(start + len(batch))] = \
+                    freq.reshape(len(batch), self.nb_kmer)
+
+        if self.sparse:
+            if len(kmer_freq):
+                kmer_freq = sparse.vstack(kmer_freq, format='csr')
+            else:
+                kmer_freq = sparse.csr_matrix((len(seqs), self.nb_kmer),
+                                              dtype=np.int32)
         return kmer_freq
@@ -0,0 +1,191 @@
+"""Memory-mapped cache of integer encoded DNA sequences.
+
+A genome cache is a directory with one int8 `.npy` file per chromosome,
+which stores the sequence encoded by `dna.char_to_int`, and an index file
+with the length of each chromosome. Cached sequences are memory-mapped,
+such that repeated runs and parallel processes share the page cache
+instead of parsing and holding private copies of FASTA files.
+"""
+
+from collections import OrderedDict
+import gzip as gz
+import json
+import os
+from glob import glob
+import re
+
+import numpy as np
+
+from . import dna
+from . import fasta
+
+INDEX_FILE = 'genome.json'
+
+# Number of FASTA lines that are encoded at once
+_LINE_BLOCK = 2**16
+
+# Number of nucleotides that are scanned at once for CpG sites
+_SCAN_BLOCK = 2**24
+
+
+def is_cache(dirname):
+    return os.path.isfile(os.path.join(dirname, INDEX_FILE))
+
+
+def read_index(dirname):
+    with open(os.path.join(dirname, INDEX_FILE), 'r') as f:
+        index = json.load(f, object_pairs_hook=OrderedDict)
+    return index
+
+
+def get_chromo_files(dna_db):
+    """Returns ordered dict with FASTA file of each chromosome in `dna_db`."""
+    filenames = glob(os.path.join(dna_db, '*.chromosome.*.fa*'))
+    chromo_files = OrderedDict()
+    for filename in sorted(filenames):
+        match = re.search(r'\.chromosome\.([^.]+)\.fa(\.gz)?$', filename)
+        if match:
+            chromo_files[match.group(1)] = filename
+    return chromo_files
+
+
+def encode_fasta(filename):
+    """Encodes single sequence FASTA file without building a string.
+
+    Returns
+    -------
+    int8 numpy array with sequence encoded by `dna.char_to_int`
+    """
+    seq = []
+    lines = []
+    nb_head = 0
+    if filename.endswith('.gz'):
+        fh = gz.open(filename, 'rb')
+    else:
+        fh = open(filename, 'rb')
+    for line in fh:
+        if line.startswith(b'>'):
+            nb_head += 1
+            if nb_head > 1:
+                raise ValueError('Single sequence expected in file "%s"!' %
+                                 filename)
+            continue
+        lines.append(line.rstrip())
+        if len(lines) == _LINE_BLOCK:
+            seq.append(dna.char_to_int(b''.join(lines)))
+            lines = []
+    fh.close()
+    seq.append(dna.char_to_int(b''.join(lines)))
+    return np.concatenate(seq)
+
+
+def convert_dna_db(dna_db, cache_dir, chromos=None, log=None):
+    """Converts directory with one FASTA file per chromosome to genome cache.
+
+    Parameters
+    ----------
+    dna_db: Directory with FASTA files as read by `fasta.read_chromo`
+    cache_dir: Output directory
+    chromos: List of chromosomes that are converted. All if `None`.
+    log: Function for logging progress messages
+
+    Returns
+    -------
+    Ordered dict with the length of each converted chromosome
+    """
+    chromo_files = get_chromo_files(dna_db)
+    if chromos is not None:
+        chromos = [str(chromo) for chromo in chromos]
+        chromo_files = OrderedDict([(chromo, chromo_files[chromo])
+                                    for chromo in chromos
+                                    if chromo in chromo_files])
+    if not len(chromo_files):
+        raise ValueError('No chromosome files found in "%s"!' % dna_db)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    index = OrderedDict()
+    for chromo, filename in chromo_files.items():
+        if log:
+            log('Converting chromosome %s ...' % chromo)
+        seq = encode_fasta(filename)
+        np.save(os.path.join(cache_dir, '%s.npy' % chromo), seq)
+        index[chromo] = len(seq)
+    # Index is written last and marks the cache as complete
+    with open(os.path.join(cache_dir, INDEX_FILE), 'w') as f:
+        json.dump(OrderedDict([('chromos', index)]), f, indent=2)
+    return index
+
+
+def read_chromo(dna_db, chromo, mmap=True):
+    """Reads integer encoded sequence of chromosome `chromo`.
+
+    Parameters
+    ----------
+    dna_db: Genome cache directory or directory with FASTA files
+    chromo: Chromosome name
+    mmap: Memory-map sequence if `dna_db` is a genome cache
+
+    Returns
+    -------
+    int8 numpy array with sequence encoded by `dna.char_to_int`
+    """
+    if not is_cache(dna_db):
+        return encode_fasta(fasta.get_chromo_file(dna_db, chromo))
+    filename = os.path.join(dna_db, '%s.npy' % chromo)
+    if not os.path.isfile(filename):
+        tmp = 'Chromosome "%s" not found in "%s"!' % (chromo, dna_db)
+        raise ValueError(tmp)
+    return np.load(filename, mmap_mode='r' if mmap else None)
+
+
+def get_chromos(dna_db):
+    """Returns sorted list of chromosomes of genome cache or directory with
+    FASTA files."""
+    if is_cache(dna_db):
+        chromos = read_index(dna_db)['chromos'].keys()
+    else:
+        chromos = get_chromo_files(dna_db).keys()
+    return sorted(chromos)
+
+
+def find_cpgs(seq, seq_index=1):
+    """Returns positions of CpG sites in integer encoded sequence.
+
+    Memory-mapped sequences are scanned in blocks, such that they are not
+    entirely loaded into memory.
+
+    Parameters
+    ----------
+    seq: Sequence encoded by `dna.char_to_int`
+    seq_index: Position of the first nucleotide
+
+    Returns
+    -------
+    int32 numpy array with positions of the C of 'CG' dinucleotides sorted
+    in ascending order
+    """
+    c = dna.CHAR_TO_INT['C']
+    g = dna.CHAR_TO_INT['G']
+    pos = [np.empty(0, dtype=np.int32)]
+    for start in range(0, len(seq) - 1, _SCAN_BLOCK):
+        # Blocks overlap by one nucleotide for CpG sites at block borders
+        block = np.asarray(seq[start:(start + _SCAN_BLOCK + 1)])
+        idx = np.flatnonzero((block[:-1] == c) & (block[1:] == g))
+        pos.append((idx + start + seq_index).astype(np.int32))
+    return np.concatenate(pos)
+
+
+def iter_cpgs(dna_db, chromos=None):
+    """Yields tuple (chromo, pos) with CpG positions of each chromosome.
+
+    Parameters
+    ----------
+    dna_db: Genome cache directory or directory with FASTA files
+    chromos: List of chromosomes. All chromosomes of `dna_db` if `None`.
+    """
+    all_chromos = get_chromos(dna_db)
+    if chromos is not None:
+        chromos = [str(chromo) for chromo in chromos]
+        all_chromos = [chromo for chromo in all_chromos if chromo in chromos]
+    for chromo in all_chromos:
+        yield (chromo, find_cpgs(read_chromo(dna_db, chromo)))
@@ -66,6 +66,8 @@ def hnames_to_names(hnames):
 
 def reader(data_files, names, batch_size=128, nb_sample=None, shuffle=False,
            loop=False):
+    from .manifest import get_nb_sample
+
     if isinstance(names, dict):
         names = hnames_to_names(names)
     else:
@@ -83,12 +85,17 @@ def reader(data_files, names, batch_size=128, nb_sample=None, shuffle=False,
     if nb_sample:
         # Select the first k files s.t. the total sample size is at least
         # nb_sample. Only these files will be shuffled.
+        # Sample counts are read from the manifest of data files if listed.
+        nb_samples = get_nb_sample(data_files)
         _data_files = []
         nb_seen = 0
-        for data_file in data_files:
-            h5_file = h5.File(data_file, 'r')
-            nb_seen += len(h5_file[names[0]])
-            h5_file.close()
+        for i, data_file in enumerate(data_files):
+            if nb_samples is not None:
+                nb_seen += nb_samples[i]
+            else:
+                h5_file = h5.File(data_file, 'r')
+                nb_seen += len(h5_file[names[0]])
+                h5_file.close()
             _data_files.append(data_file)
             if nb_seen >= nb_sample:
                 break
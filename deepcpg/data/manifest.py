@@ -0,0 +1,211 @@
+"""Manifest of data chunk files.
+
+`dcpg_data.py` writes a manifest file to the output directory, which
+describes each chunk file by its chromosome, first and last position, number
+of samples, and the number of observed values and mean of each output. Names
+and shapes of datasets are stored once if they are identical for all files.
+Consumers such as `get_nb_sample` or `hdf.reader` look up files in the
+manifest of their directory instead of opening each file, and fall back to
+reading files if they are not listed.
+"""
+
+from collections import OrderedDict
+import json
+import os
+
+import h5py as h5
+import numpy as np
+
+from . import hdf
+from ..utils import filter_regex
+
+MANIFEST_FILE = 'manifest.json'
+
+# Loaded manifests by directory
+_MANIFESTS = dict()
+
+
+def get_obs_stats(value, nan=-1):
+    """Returns tuple (nb_obs, mean) with the number of observed values and
+    their mean, which is `None` if no value is observed."""
+    obs = value != nan
+    nb_obs = int(obs.sum())
+    mean = float(value[obs].mean()) if nb_obs else None
+    return (nb_obs, mean)
+
+
+def get_entry_obs_stats(entry):
+    """Returns dict with tuple (nb_obs, mean) of each output of `entry`."""
+    names = [name for name, _ in entry['datasets']
+             if name.startswith('outputs/')]
+    return OrderedDict(zip(names, zip(entry['nb_obs'], entry['mean'])))
+
+
+def describe(h5_file, obs_stats=None, nan=-1):
+    """Describes data chunk file.
+
+    Parameters
+    ----------
+    h5_file: Filename or open `h5py.File`
+    obs_stats: Dict with tuple (nb_obs, mean) of outputs by name, e.g.
+        'outputs/cpg/cell', such as returned by `get_obs_stats`. Outputs
+        that are not included are read from `h5_file`.
+    nan: Value of unobserved outputs
+
+    Returns
+    -------
+    OrderedDict with chromosome, first and last position, number of samples,
+    list of (name, shape) of datasets in the order of `hdf.ls`, and the
+    number of observed values and mean of each output.
+    """
+    is_file = not isinstance(h5_file, str)
+    if not is_file:
+        h5_file = h5.File(h5_file, 'r')
+    if obs_stats is None:
+        obs_stats = dict()
+    pos = h5_file['pos']
+    datasets = []
+    for name in hdf._ls(h5_file['/'], recursive=True):
+        datasets.append((name.lstrip('/'), list(h5_file[name].shape[1:])))
+    nb_obs = []
+    mean = []
+    for name, _ in datasets:
+        if not name.startswith('outputs/'):
+            continue
+        stats = obs_stats.get(name)
+        if stats is None:
+            stats = get_obs_stats(h5_file[name][()], nan)
+        nb_obs.append(stats[0])
+        mean.append(stats[1])
+    entry = OrderedDict()
+    entry['chromo'] = h5_file['chromo'][0].decode() if len(pos) else None
+    entry['start'] = int(pos[0]) if len(pos) else None
+    entry['end'] = int(pos[-1]) if len(pos) else None
+    entry['nb_sample'] = len(pos)
+    entry['datasets'] = datasets
+    entry['nb_obs'] = nb_obs
+    entry['mean'] = mean
+    if not is_file:
+        h5_file.close()
+    return entry
+
+
+def write_manifest(dirname, entries, build=None):
+    """Writes manifest of files in `dirname`.
+
+    Parameters
+    ----------
+    dirname: Directory of files
+    entries: Dict with entry returned by `describe` for each file name
+    build: Identifier of input files and options of the files
+    """
+    manifest = OrderedDict()
+    manifest['build'] = build
+    manifest['datasets'] = None
+    manifest['files'] = OrderedDict()
+    for filename, entry in sorted(entries.items()):
+        entry = OrderedDict(entry)
+        if manifest['datasets'] is None:
+            manifest['datasets'] = entry['datasets']
+        if entry['datasets'] == manifest['datasets']:
+            del entry['datasets']
+        manifest['files'][os.path.basename(filename)] = entry
+    filename = os.path.join(dirname, MANIFEST_FILE)
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filename, filename)
+
+
+def read_manifest(dirname):
+    """Returns manifest of `dirname` or `None` if it does not exist.
+
+    Manifests are loaded once and reloaded if they were modified.
+    """
+    filename = os.path.join(os.path.abspath(dirname), MANIFEST_FILE)
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        _MANIFESTS.pop(filename, None)
+        return None
+    cached = _MANIFESTS.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(filename, 'r') as f:
+            manifest = json.load(f, object_pairs_hook=OrderedDict)
+        cached = (mtime, manifest)
+        _MANIFESTS[filename] = cached
+    return cached[1]
+
+
+def remove_manifest(dirname):
+    filename = os.path.join(dirname, MANIFEST_FILE)
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+
+def get_entry(filename):
+    """Returns manifest entry of `filename` or `None` if it is not listed.
+
+    The returned entry always includes the list of datasets.
+    """
+    manifest = read_manifest(os.path.dirname(filename) or '.')
+    if manifest is None:
+        return None
+    entry = manifest['files'].get(os.path.basename(filename))
+    if entry is None:
+        return None
+    if 'datasets' not in entry:
+        entry = OrderedDict(entry)
+        entry['datasets'] = manifest['datasets']
+    return entry
+
+
+def get_entries(filenames):
+    """Returns list with manifest entries of `filenames` or `None` if any
+    file is not listed."""
+    entries = []
+    for filename in filenames:
+        entry = get_entry(filename)
+        if entry is None:
+            return None
+        entries.append(entry)
+    return entries
+
+
+def get_nb_sample(filenames):
+    """Returns array with number of samples of `filenames` or `None`."""
+    entries = get_entries(filenames)
+    if entries is None:
+        return None
+    return np.array([entry['nb_sample'] for entry in entries], dtype=np.int64)
+
+
+def ls(filename, group='/', regex=None, nb_key=None):
+    """Lists datasets of `group` in `filename` like `hdf.ls` with
+    `recursive=True` or returns `None` if `filename` is not listed."""
+    entry = get_entry(filename)
+    if entry is None:
+        return None
+    prefix = group.strip('/')
+    if prefix:
+        prefix += '/'
+    keys = [name[len(prefix):] for name, _ in entry['datasets']
+            if name.startswith(prefix)]
+    if regex:
+        keys = filter_regex(keys, regex)
+    if nb_key is not None:
+        keys = keys[:nb_key]
+    return keys
+
+
+def get_shape(filename, name):
+    """Returns shape of dataset `name` in `filename` without the sample
+    dimension or `None` if `filename` or `name` is not listed."""
+    entry = get_entry(filename)
+    if entry is None:
+        return None
+    name = name.strip('/')
+    for _name, shape in entry['datasets']:
+        if _name == name:
+            return tuple(shape)
+    return None
@@ -0,0 +1,349 @@
+"""Compact columnar storage of CpG profiles.
+
+A `CpgProfile` stores positions and values of a single cell in one int32
+array and one value array, which are sorted by chromosome and position. An
+offsets index points to the first site of each chromosome, such that the
+sites of a chromosome are returned as zero-copy slices.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from glob import glob
+
+import numpy as np
+
+from .utils import read_cpg_profile
+
+# File extensions of a saved profile. The index is written last.
+PROFILE_EXTS = ['.pos.npy', '.value.npy', '.json']
+
+
+def merge_pos(pos_arrays, counts=None):
+    """Merges sorted position arrays into their sorted union.
+
+    Concatenated arrays are sorted by a stable sort, which merges presorted
+    runs instead of sorting from scratch, followed by a single pass for
+    extracting unique positions.
+
+    Parameters
+    ----------
+    pos_arrays: List of arrays with unique positions sorted in ascending
+        order
+    counts: List with count arrays of `pos_arrays`, e.g. of previously
+        merged positions, or `None` for positions that are counted once
+
+    Returns
+    -------
+    Tuple (pos, count) with unique positions and the number of arrays that
+    contain them.
+    """
+    if counts is None:
+        counts = [None] * len(pos_arrays)
+    idx = [i for i, pos in enumerate(pos_arrays) if len(pos)]
+    if not len(idx):
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32))
+    pos = np.concatenate([pos_arrays[i] for i in idx])
+    if all([counts[i] is None for i in idx]):
+        pos.sort(kind='mergesort')
+        count = None
+    else:
+        count = np.concatenate([
+            np.ones(len(pos_arrays[i]), dtype=np.int32) if counts[i] is None
+            else counts[i] for i in idx])
+        order = np.argsort(pos, kind='mergesort')
+        pos = pos[order]
+        count = count[order]
+        del order
+    first = np.empty(len(pos), dtype=bool)
+    first[0] = True
+    np.not_equal(pos[1:], pos[:-1], out=first[1:])
+    idx = np.nonzero(first)[0]
+    if count is None:
+        count = np.diff(np.append(idx, len(pos)))
+    else:
+        count = np.add.reduceat(count, idx)
+    return (pos[idx], count.astype(np.int32))
+
+
+class CpgProfile(object):
+    """Positions and values of a single profile partitioned by chromosome.
+
+    Parameters
+    ----------
+    chromos: List of chromosome names
+    offsets: Integer array of length len(chromos) + 1. Sites of chromosome
+        chromos[i] are stored at offsets[i]:offsets[i + 1].
+    pos: int32 array with positions sorted in ascending order per chromosome
+    value: Array with values, e.g. binary int8 methylation states
+    """
+
+    def __init__(self, chromos, offsets, pos, value):
+        if len(offsets) != len(chromos) + 1:
+            raise ValueError('Offsets do not match chromosomes!')
+        if len(pos) != len(value) or len(pos) != offsets[-1]:
+            raise ValueError('Positions do not match values!')
+        self.chromos = list(chromos)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.pos = pos
+        self.value = value
+        self._index = {chromo: i for i, chromo in enumerate(self.chromos)}
+
+    @classmethod
+    def from_dict(cls, data, value_dtype=None):
+        """Creates profile from dict with tuple (pos, value) per chromosome
+        as returned by `read_cpg_profile`."""
+        chromos = list(data.keys())
+        offsets = np.zeros(len(chromos) + 1, dtype=np.int64)
+        for i, chromo in enumerate(chromos):
+            offsets[i + 1] = offsets[i] + len(data[chromo][0])
+        if value_dtype is None:
+            if len(chromos):
+                value_dtype = data[chromos[0]][1].dtype
+            else:
+                value_dtype = np.int8
+        pos = np.empty(offsets[-1], dtype=np.int32)
+        value = np.empty(offsets[-1], dtype=value_dtype)
+        for i, chromo in enumerate(chromos):
+            pos[offsets[i]:offsets[i + 1]] = data[chromo][0]
+            value[offsets[i]:offsets[i + 1]] = data[chromo][1]
+        return cls(chromos, offsets, pos, value)
+
+    def __contains__(self, chromo):
+        return chromo in self._index
+
+    def __len__(self):
+        return len(self.pos)
+
+    def get(self, chromo, start=None, end=None, margin=0):
+        """Returns tuple (pos, value) of `chromo` as views.
+
+        If `start` or `end` is given, only sites with start <= pos <= end
+        and `margin` additional sites on both sides are returned, such that
+        only these sites of memory-mapped profiles are read. Returns empty
+        arrays if `chromo` is not stored.
+        """
+        i = self._index.get(chromo)
+        if i is None:
+            return (self.pos[:0], self.value[:0])
+        lo = self.offsets[i]
+        hi = self.offsets[i + 1]
+        if start is not None:
+            lo += max(np.searchsorted(self.pos[lo:hi], start) - margin, 0)
+        if end is not None:
+            hi = lo + min(np.searchsorted(self.pos[lo:hi], end, side='right') +
+                          margin, hi - lo)
+        return (self.pos[lo:hi], self.value[lo:hi])
+
+    def items(self):
+        for chromo in self.chromos:
+            yield (chromo, self.get(chromo))
+
+    def save(self, prefix):
+        """Saves profile to `prefix`.{json,pos.npy,value.npy}.
+
+        Files are first written to temporary files and then renamed, such
+        that concurrent readers never see incomplete files.
+        """
+        tmp_prefix = '%s.tmp%d' % (prefix, os.getpid())
+        np.save(tmp_prefix + '.pos.npy', self.pos)
+        np.save(tmp_prefix + '.value.npy', self.value)
+        with open(tmp_prefix + '.json', 'w') as f:
+            json.dump({'chromos': self.chromos,
+                       'offsets': self.offsets.tolist()}, f)
+        # Index is renamed last and marks the profile as complete
+        for ext in PROFILE_EXTS:
+            os.replace(tmp_prefix + ext, prefix + ext)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        """Loads profile saved by `save` and memory-maps arrays."""
+        with open(prefix + '.json', 'r') as f:
+            index = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        pos = np.load(prefix + '.pos.npy', mmap_mode=mmap_mode)
+        value = np.load(prefix + '.value.npy', mmap_mode=mmap_mode)
+        return cls(index['chromos'], index['offsets'], pos, value)
+
+
+class CpgProfileStore(object):
+    """Ordered collection of named `CpgProfile`s, e.g. of multiple cells."""
+
+    def __init__(self, profiles=None):
+        self.profiles = OrderedDict()
+        if profiles is not None:
+            for name, profile in profiles.items():
+                self.add(name, profile)
+
+    def add(self, name, profile):
+        if not isinstance(profile, CpgProfile):
+            profile = CpgProfile.from_dict(profile)
+        self.profiles[name] = profile
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __contains__(self, name):
+        return name in self.profiles
+
+    def __getitem__(self, name):
+        return self.profiles[name]
+
+    def names(self):
+        return list(self.profiles.keys())
+
+    def items(self):
+        return self.profiles.items()
+
+    def chromos(self):
+        """Returns sorted list of chromosomes of all profiles."""
+        chromos = set()
+        for profile in self.profiles.values():
+            chromos.update(profile.chromos)
+        return sorted(chromos)
+
+    def get(self, name, chromo, *args, **kwargs):
+        """Returns tuple (pos, value) of profile `name` and `chromo`.
+
+        Further arguments are passed to `CpgProfile.get`.
+        """
+        return self.profiles[name].get(chromo, *args, **kwargs)
+
+    def get_chromo(self, chromo, *args, **kwargs):
+        """Returns list with tuple (pos, value) of `chromo` of all profiles.
+
+        Further arguments are passed to `CpgProfile.get`.
+        """
+        return [profile.get(chromo, *args, **kwargs)
+                for profile in self.profiles.values()]
+
+    def merge_pos(self, chromo, max_sites=None):
+        """Returns tuple (pos, cov) with sorted union of positions of
+        `chromo` and the number of profiles that cover them.
+
+        If `max_sites` is given, profiles are merged in batches of about
+        `max_sites` positions with the union of previous batches, such that
+        not all positions are copied at once.
+        """
+        if max_sites is None:
+            return merge_pos([pos for pos, _ in self.get_chromo(chromo)])
+        pos = np.empty(0, dtype=np.int32)
+        cov = np.empty(0, dtype=np.int32)
+        batch = []
+        nb_site = 0
+        for i, profile in enumerate(self.profiles.values()):
+            batch.append(profile.get(chromo)[0])
+            nb_site += len(batch[-1])
+            if nb_site >= max_sites or i == len(self.profiles) - 1:
+                pos, cov = merge_pos([pos] + batch,
+                                     [cov] + [None] * len(batch))
+                batch = []
+                nb_site = 0
+        return (pos, cov)
+
+    def coverage(self, chromo, pos):
+        """Returns number of profiles that cover sorted positions `pos`.
+
+        Only sites of profiles in the range of `pos` are read.
+        """
+        cov = np.zeros(len(pos), dtype=np.int32)
+        if not len(pos):
+            return cov
+        for chromo_pos, _ in self.get_chromo(chromo, pos[0], pos[-1]):
+            if not len(chromo_pos):
+                continue
+            idx = np.minimum(np.searchsorted(chromo_pos, pos),
+                             len(chromo_pos) - 1)
+            cov += chromo_pos[idx] == pos
+        return cov
+
+
+class CpgProfileCache(object):
+    """Persistent cache of parsed profiles.
+
+    Profiles are stored in `cache_dir` in the format of `CpgProfile.save`
+    under a key that is derived from the path, size, and modification time
+    of the input file, and from parsing options. Cached profiles are
+    memory-mapped. If `max_size` is set, least recently used profiles are
+    removed by `prune` until the cache is smaller than `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, filename, round=True, chromos=None, nrows=None, **kwargs):
+        stat = os.stat(filename)
+        if chromos is not None:
+            if not isinstance(chromos, list):
+                chromos = [chromos]
+            chromos = sorted([str(chromo) for chromo in chromos])
+        key = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+               bool(round), chromos, nrows]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def _prefix(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, filename, **kwargs):
+        """Returns cached profile of `filename` or `None`."""
+        prefix = self._prefix(self.key(filename, **kwargs))
+        if not os.path.isfile(prefix + '.json'):
+            return None
+        # Access time of the index is used for removing least recently used
+        # profiles
+        os.utime(prefix + '.json')
+        return CpgProfile.load(prefix)
+
+    def save(self, filename, profile, **kwargs):
+        profile.save(self._prefix(self.key(filename, **kwargs)))
+
+    def read(self, filename, **kwargs):
+        """Returns cached profile or reads and caches it.
+
+        `kwargs` are passed to `read_cpg_profile`.
+        """
+        profile = self.load(filename, **kwargs)
+        if profile is None:
+            profile = CpgProfile.from_dict(read_cpg_profile(filename,
+                                                            **kwargs))
+            self.save(filename, profile, **kwargs)
+            profile = self.load(filename, **kwargs)
+        return profile
+
+    def entries(self):
+        """Returns list of (last access, size, prefix) of cached profiles."""
+        entries = []
+        for index_file in glob(os.path.join(self.cache_dir, '*.json')):
+            prefix = index_file[:-len('.json')]
+            if '.tmp' in os.path.basename(prefix):
+                continue
+            size = 0
+            for ext in PROFILE_EXTS:
+                if os.path.isfile(prefix + ext):
+                    size += os.path.getsize(prefix + ext)
+            entries.append((os.path.getmtime(index_file), size, prefix))
+        return entries
+
+    def prune(self, max_size=None):
+        """Removes least recently used profiles until the cache is smaller
+        than `max_size` bytes. Returns the number of removed profiles."""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        entries = sorted(self.entries())
+        size = sum([entry[1] for entry in entries])
+        nb_removed = 0
+        for _, entry_size, prefix in entries:
+            if size <= max_size:
+                break
+            # Index is removed first such that the profile is not loaded
+            for ext in reversed(PROFILE_EXTS):
+                if os.path.isfile(prefix + ext):
+                    os.remove(prefix + ext)
+            size -= entry_size
+            nb_removed += 1
+        return nb_removed
@@ -7,7 +7,10 @@ CpG matrix x assumed to have shape
 
 import numpy as np
 
+from collections import OrderedDict
+
 from ..utils import EPS, get_from_module
+from .utils import CPG_NAN
 
 
 def mean(x):
@@ -56,5 +59,128 @@ def diff(x):
     return x.min(axis=1) != x.max(axis=1).astype(np.int8)
 
 
+def cov(x):
+    if x.ndim > 2:
+        x = x.mean(axis=2)
+    return np.ma.masked_array(np.ma.count(x, axis=1))
+
+
+def cpg_stats(x, names, min_cov=1):
+    """Computes per CpG statistics in a single pass over CpG matrix.
+
+    Counts observed and methylated cells once and derives all statistics
+    from these counts, without creating masked arrays.
+
+    Parameters
+    ----------
+    x: int8 numpy array of shape [sites, cells] with binary CpG states and
+        `CPG_NAN` for unobserved states
+    names: list of statistics
+    min_cov: Statistics of sites observed in less than `min_cov` cells are
+        `CPG_NAN`
+
+    Returns
+    -------
+    OrderedDict with numpy array of length sites for each statistic
+    """
+    nb_obs = np.count_nonzero(x != CPG_NAN, axis=1)
+    nb_met = np.count_nonzero(x == 1, axis=1)
+    return _from_moments(names, nb_obs, nb_met, nb_met,
+                         nb_met == nb_obs, nb_met > 0, min_n=min_cov)
+
+
+def win_counts(pos, profiles, wlens):
+    """Counts observed and methylated CpG sites of cells in windows.
+
+    Windows of length `wlen` include all sites within `wlen // 2` of the
+    target site. Counts are computed from cumulative sums of each profile
+    and window bounds obtained by `np.searchsorted`, such that the costs
+    are independent of the window length.
+
+    Parameters
+    ----------
+    pos: numpy array with target positions sorted in ascending order
+    profiles: list of tuples (y, ys) with positions sorted in ascending
+        order and binary CpG states of each cell
+    wlens: list of window lengths
+
+    Returns
+    -------
+    List with tuple (nb_obs, nb_met) of int32 arrays of shape [sites, cells]
+    for each window length.
+    """
+    pos = np.asarray(pos)
+    shape = (len(pos), len(profiles))
+    counts = [(np.zeros(shape, dtype=np.int32),
+               np.zeros(shape, dtype=np.int32)) for wlen in wlens]
+    for i, (y, ys) in enumerate(profiles):
+        if not len(y):
+            continue
+        met = np.zeros(len(y) + 1, dtype=np.int32)
+        np.cumsum(ys, out=met[1:])
+        for wlen, (nb_obs, nb_met) in zip(wlens, counts):
+            delta = wlen // 2
+            lo = np.searchsorted(y, pos - delta, side='left')
+            hi = np.searchsorted(y, pos + delta, side='right')
+            nb_obs[:, i] = hi - lo
+            nb_met[:, i] = met[hi] - met[lo]
+    return counts
+
+
+def _from_moments(names, n, s1, s2, vmin, vmax, min_n=1, nb_bin=3):
+    """Derives statistics from the number `n` of observed values, their
+    sum `s1`, sum of squares `s2`, minimum, and maximum. Statistics of sites
+    with less than `min_n` observations are `CPG_NAN`."""
+    nan = n < min_n
+    _n = np.maximum(n, 1)
+    mean = s1 / _n
+    var = np.maximum(s2 / _n - mean**2, 0)
+    bins = np.linspace(-EPS, 0.25, nb_bin + 1)
+    cv = np.digitize(var, bins, right=True) - 1
+    p1 = np.minimum(1 - EPS, np.maximum(EPS, mean))
+    p0 = 1 - p1
+
+    funs = dict(
+        mean=lambda: mean,
+        mode=lambda: mean.round().astype(np.int8),
+        var=lambda: var,
+        cat_var=lambda: cv,
+        cat2_var=lambda: (cv > 0).astype(cv.dtype),
+        entropy=lambda: -(p1 * np.log(p1) + p0 * np.log(p0)),
+        diff=lambda: (vmin != vmax).astype(np.int8),
+        cov=lambda: n)
+    stats = OrderedDict()
+    for name in names:
+        stat = funs[name]()
+        stats[name] = np.where(nan, CPG_NAN, stat).astype(stat.dtype)
+    return stats
+
+
+def win_stats(nb_obs, nb_met, names):
+    """Computes window-based statistics from counts of `win_counts`.
+
+    Methylation levels of cells are the mean of observed CpG states in the
+    window, and statistics are computed across cells with at least one
+    observed CpG site. `cov` is the number of these cells.
+
+    Parameters
+    ----------
+    nb_obs: numpy array of shape [sites, cells] with number of observed sites
+    nb_met: numpy array of shape [sites, cells] with number of methylated
+        sites
+    names: list of statistics
+
+    Returns
+    -------
+    OrderedDict with numpy array of length sites for each statistic
+    """
+    obs = nb_obs > 0
+    x = nb_met / np.maximum(nb_obs, 1)
+    vmin = np.where(obs, x, np.inf).min(axis=1)
+    vmax = np.where(obs, x, -np.inf).max(axis=1)
+    return _from_moments(names, obs.sum(axis=1), x.sum(axis=1),
+                         (x**2).sum(axis=1), vmin, vmax)
+
+
 def get(name):
     return get_from_module(name, globals())
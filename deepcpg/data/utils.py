@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import gzip
 import threading
 import re
@@ -7,6 +8,8 @@ import numpy as np
 import pandas as pd
 
 from . import hdf
+from . import manifest
+from ..utils import to_list
 
 CPG_NAN = -1
 OUTPUT_SEP = '/'
@@ -60,28 +63,47 @@ def stack_dict(data):
 
 
 def get_nb_sample(data_files, nb_max=None, batch_size=None):
-    nb_sample = 0
-    for data_file in data_files:
-        data_file = h5.File(data_file, 'r')
-        nb_sample += len(data_file['pos'])
-        data_file.close()
+    """Returns number of samples in `data_files`.
+
+    Sample counts are read from the manifest of data files if they are
+    listed instead of opening each file.
+    """
+    nb_samples = manifest.get_nb_sample(data_files)
+    if nb_samples is not None:
+        nb_sample = int(nb_samples.sum())
         if nb_max and nb_sample > nb_max:
             nb_sample = nb_max
-            break
+    else:
+        nb_sample = 0
+        for data_file in data_files:
+            data_file = h5.File(data_file, 'r')
+            nb_sample += len(data_file['pos'])
+            data_file.close()
+            if nb_max and nb_sample > nb_max:
+                nb_sample = nb_max
+                break
     if batch_size:
         nb_sample = (nb_sample // batch_size) * batch_size
     return nb_sample
 
 
 def get_dna_wlen(data_file, max_len=None):
-    data_file = h5.File(data_file, 'r')
-    wlen = data_file['/inputs/dna'].shape[1]
+    shape = manifest.get_shape(data_file, 'inputs/dna')
+    if shape is not None:
+        wlen = shape[0]
+    else:
+        data_file = h5.File(data_file, 'r')
+        wlen = data_file['/inputs/dna'].shape[1]
+        data_file.close()
     if max_len:
         wlen = min(max_len, wlen)
     return wlen
 
 
 def get_output_names(data_file, *args, **kwargs):
+    names = manifest.ls(data_file, 'outputs', *args, **kwargs)
+    if names is not None:
+        return names
     return hdf.ls(data_file, 'outputs',
                   recursive=True,
                   groups=False,
@@ -102,9 +124,15 @@ def get_anno_names(data_file, *args, **kwargs):
 
 
 def get_cpg_wlen(data_file, max_len=None):
-    data_file = h5.File(data_file, 'r')
-    group = data_file['/inputs/cpg']
-    wlen = group['%s/dist' % list(group.keys())[0]].shape[1]
+    names = manifest.ls(data_file, 'inputs/cpg', regex=r'/dist$', nb_key=1)
+    if names:
+        wlen = manifest.get_shape(data_file,
+                                  'inputs/cpg/%s' % names[0])[0]
+    else:
+        data_file = h5.File(data_file, 'r')
+        group = data_file['/inputs/cpg']
+        wlen = group['%s/dist' % list(group.keys())[0]].shape[1]
+        data_file.close()
     if max_len:
         wlen = min(max_len, wlen)
     return wlen
@@ -112,17 +140,20 @@ def get_cpg_wlen(data_file, max_len=None):
 
 def is_bedgraph(filename):
     if isinstance(filename, str):
-        with open(filename) as f:
-            line = f.readline()
+        f = GzipFile(filename, 'rt')
+        line = f.readline()
+        f.close()
     else:
         pos = filename.tell()
         line = filename.readline()
         filename.seek(pos)
+    if isinstance(line, bytes):
+        line = line.decode()
     return re.match(r'track\s+type=bedGraph', line) is not None
 
 
 def format_chromo(chromo):
-    return chromo.str.upper().str.replace('^CHR', '')
+    return chromo.str.upper().str.replace('^CHR', '', regex=True)
 
 
 def read_cpg_table(filename, chromos=None, nrows=None, round=True, sort=True):
@@ -150,6 +181,79 @@ def read_cpg_table(filename, chromos=None, nrows=None, round=True, sort=True):
     return d
 
 
+def read_cpg_profile(filename, chromos=None, nrows=None, round=True,
+                     chunk_size=2**20):
+    """Reads CpG profile in dcpg or bedGraph format in chunks.
+
+    Parses `chunk_size` rows at a time and only keeps positions and values
+    of chromosomes in `chromos` as compact arrays, such that peak memory
+    depends on `chunk_size` instead of the file size.
+
+    Parameters
+    ----------
+    filename: Path of (gzip) dcpg or bedGraph file
+    chromos: List of chromosomes that are read. Chromosome names are
+        compared after formatting them by `format_chromo`.
+    nrows: Maximum number of rows that are read
+    round: Round values and check that they are binary
+    chunk_size: Number of rows that are parsed at once
+
+    Returns
+    -------
+    OrderedDict with tuple (pos, value) for each chromosome sorted by name.
+    `pos` is an int32 array with positions sorted in ascending order and
+    `value` an int8 array if `round` is `True` or float32 array otherwise.
+    """
+    if is_bedgraph(filename):
+        usecols = [0, 1, 3]
+        skiprows = 1
+    else:
+        usecols = [0, 1, 2]
+        skiprows = 0
+    dtype = {usecols[0]: str, usecols[1]: np.int32, usecols[2]: np.float32}
+    if chromos is not None:
+        chromos = set([str(chromo) for chromo in to_list(chromos)])
+
+    chunks = dict()
+    reader = pd.read_table(filename, header=None, nrows=nrows, comment='#',
+                           usecols=usecols, dtype=dtype, skiprows=skiprows,
+                           chunksize=chunk_size)
+    for chunk in reader:
+        chunk.columns = ['chromo', 'pos', 'value']
+        # Format chromosome names once instead of once per row
+        names, idx = np.unique(chunk['chromo'].values, return_inverse=True)
+        names = format_chromo(pd.Series(names)).values
+        order = np.argsort(idx, kind='mergesort')
+        bounds = np.searchsorted(idx[order], np.arange(len(names) + 1))
+        pos = chunk['pos'].values
+        value = chunk['value'].values
+        for i, chromo in enumerate(names):
+            if chromos is not None and chromo not in chromos:
+                continue
+            chromo_idx = order[bounds[i]:bounds[i + 1]]
+            chromo_value = value[chromo_idx]
+            if round:
+                chromo_value = np.round(chromo_value)
+                if not np.all((chromo_value == 0) | (chromo_value == 1)):
+                    raise ValueError('Invalid methylation states')
+                chromo_value = chromo_value.astype(np.int8)
+            chromo_chunks = chunks.setdefault(chromo, ([], []))
+            chromo_chunks[0].append(pos[chromo_idx])
+            chromo_chunks[1].append(chromo_value)
+
+    profile = OrderedDict()
+    for chromo in sorted(chunks.keys()):
+        pos = np.concatenate(chunks[chromo][0])
+        value = np.concatenate(chunks[chromo][1])
+        del chunks[chromo]
+        if np.any(pos[1:] < pos[:-1]):
+            idx = np.argsort(pos, kind='mergesort')
+            pos = pos[idx]
+            value = value[idx]
+        profile[chromo] = (pos, value)
+    return profile
+
+
 class GzipFile(object):
 
     def __init__(self, filename, mode='r', *args, **kwargs):
@@ -252,7 +252,7 @@ class DataReader(object):
             center = cur_wlen // 2
             delta = self.dna_wlen // 2
             dna = dna[:, (center - delta):(center + delta + 1)]
-        return int_to_onehot(dna)
+        return int_to_onehot(dna, dtype=K.floatx())
 
     def _prepro_cpg(self, states, dists):
         prepro_states = []
@@ -1,6 +1,9 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 import os
 import re
+import sys
+from time import time
 
 import numpy as np
 
@@ -117,6 +120,20 @@ def format_table(table, colwidth=None, precision=2, header=True, sep=' | '):
     return '\n'.join(rows)
 
 
+def get_rss():
+    """Returns peak resident set size of the current process in bytes, or 0
+    if it is unknown, e.g. on Windows."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS and in kilobytes on Linux
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
 def filter_regex(x, regexs):
     if not isinstance(x, list):
         x = [x]
@@ -160,3 +177,93 @@ class ProgressBar(object):
     def close(self):
         if self._value < self.nb_tot:
             self.update(self.nb_tot)
+
+
+class StageTimer(object):
+    """Records wall time, number of sites, and peak RSS of stages.
+
+    Parameters
+    ----------
+    keys: Keys such as the chromosome that are added to each record
+    """
+
+    def __init__(self, **keys):
+        self.keys = keys
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, nb_site=0, **keys):
+        """Times the enclosed block and yields its record.
+
+        The number of bytes written by the block can be stored as `nb_byte`
+        in the yielded record. `peak_rss` is the peak RSS of the process at
+        the end of the block and `peak_rss_inc` by how much the block
+        increased it.
+
+        Parameters
+        ----------
+        name: Name of stage
+        nb_site: Number of processed sites
+        keys: Keys such as the chunk that are added to the record
+        """
+        record = OrderedDict(self.keys)
+        record.update(keys)
+        record['stage'] = name
+        record['nb_site'] = nb_site
+        record['nb_byte'] = 0
+        start_rss = get_rss()
+        start = time()
+        try:
+            yield record
+        finally:
+            record['time'] = time() - start
+            record['peak_rss'] = get_rss()
+            record['peak_rss_inc'] = record['peak_rss'] - start_rss
+            self.records.append(record)
+
+
+def summarize_stages(records):
+    """Summarizes records of `StageTimer` by stage.
+
+    Returns
+    -------
+    OrderedDict with columns of table with one row per stage in order of
+    appearance and a last row with the total. `peak_rss_mb` is the maximum
+    peak RSS at the end of a stage and `peak_rss_inc_mb` the sum of
+    increases of the peak RSS during a stage.
+    """
+    keys = ['time', 'nb_site', 'nb_byte', 'peak_rss_inc']
+    stages = OrderedDict()
+    for record in records:
+        stage = stages.setdefault(record['stage'],
+                                  dict([(key, 0) for key in keys],
+                                       peak_rss=0))
+        for key in keys:
+            stage[key] += record[key]
+        stage['peak_rss'] = max(stage['peak_rss'], record['peak_rss'])
+    total = dict([(key, 0) for key in keys], peak_rss=0)
+    total['nb_site'] = None
+    for stage in stages.values():
+        for key in ['time', 'nb_byte', 'peak_rss_inc']:
+            total[key] += stage[key]
+        total['peak_rss'] = max(total['peak_rss'], stage['peak_rss'])
+    stages['total'] = total
+
+    table = OrderedDict([(key, []) for key in
+                         ['stage', 'time', 'time_per', 'nb_site',
+                          'sites_per_sec', 'mb_written', 'peak_rss_mb',
+                          'peak_rss_inc_mb']])
+    for name, stage in stages.items():
+        table['stage'].append(name)
+        table['time'].append(stage['time'])
+        table['time_per'].append(stage['time'] / max(total['time'], EPS) *
+                                 100)
+        table['nb_site'].append(stage['nb_site'])
+        sites_per_sec = None
+        if stage['nb_site']:
+            sites_per_sec = stage['nb_site'] / max(stage['time'], EPS)
+        table['sites_per_sec'].append(sites_per_sec)
+        table['mb_written'].append(stage['nb_byte'] / 1024**2)
+        table['peak_rss_mb'].append(stage['peak_rss'] / 1024**2)
+        table['peak_rss_inc_mb'].append(stage['peak_rss_inc'] / 1024**2)
+    return table
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""Finds all CpG sites in a DNA database.
+
+Scans the sequence of each chromosome for 'CG' dinucleotides and writes a
+position table with columns chromosome and position of the C, which can be
+passed as `--pos_file` to `dcpg_data.py`. Alternatively, writes the
+boundaries of chunks with `--chunk_size` CpG sites, with columns
+chromosome, first position, last position, and number of CpG sites.
+Chromosomes are processed one at a time, such that only the sites of a
+single chromosome are held in memory.
+
+Examples:
+    dcpg_cpg_sites.py ./mm10_cache -o cpg_sites.tsv.gz
+    dcpg_cpg_sites.py ./mm10_cache --chunk_size 32768 -o chunks.tsv
+"""
+
+import gzip as gz
+import os
+import sys
+
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+from deepcpg.data import genome
+
+
+def get_chunks(pos, chunk_size):
+    """Returns tuple (start, end, nb_site) with first and last position and
+    number of sites of chunks of `chunk_size` sites."""
+    idx = np.arange(0, len(pos), chunk_size)
+    end = np.minimum(idx + chunk_size, len(pos))
+    return (pos[idx], pos[end - 1], end - idx)
+
+
+class App(object):
+
+    def run(self, args):
+        name = os.path.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Finds all CpG sites in a DNA database')
+        p.add_argument(
+            'dna_db',
+            help='DNA database with one FASTA file per chromosome or genome cache')
+        p.add_argument(
+            '-o', '--out_file',
+            help='Output file. Compressed if ending with .gz.',
+            required=True)
+        p.add_argument(
+            '--chunk_size',
+            help='Write boundaries of chunks with this number of CpG sites instead of positions',
+            type=int)
+        p.add_argument(
+            '--chromos',
+            nargs='+',
+            help='Chromosomes that are scanned')
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+        log.debug(opts)
+
+        if opts.out_file.endswith('.gz'):
+            out_file = gz.open(opts.out_file, 'wt')
+        else:
+            out_file = open(opts.out_file, 'w')
+        nb_site = 0
+        for chromo, pos in genome.iter_cpgs(opts.dna_db, opts.chromos):
+            log.info('Chromosome %s: %d CpG sites' % (chromo, len(pos)))
+            nb_site += len(pos)
+            if opts.chunk_size:
+                start, end, nb_chunk_site = get_chunks(pos, opts.chunk_size)
+                table = pd.DataFrame({'chromo': chromo, 'start': start,
+                                      'end': end, 'nb_site': nb_chunk_site},
+                                     columns=['chromo', 'start', 'end',
+                                              'nb_site'])
+            else:
+                table = pd.DataFrame({'chromo': chromo, 'pos': pos},
+                                     columns=['chromo', 'pos'])
+            table.to_csv(out_file, sep='\t', header=False, index=False)
+        out_file.close()
+        log.info('%d CpG sites' % nb_site)
+        log.info('Done!')
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
@@ -18,12 +18,20 @@ Examples:
 """
 
 from collections import OrderedDict
+from glob import escape, glob
+import hashlib
+import json
 import os
+import re
+import shutil
 import sys
+import tempfile
 import warnings
 
 import argparse
 import logging
+import logging.handlers
+import multiprocessing as mp
 import h5py as h5
 import numpy as np
 import pandas as pd
@@ -33,73 +41,273 @@ from deepcpg.data import annotations as an
 from deepcpg.data import stats
 from deepcpg.data import dna
 from deepcpg.data import fasta
+from deepcpg.data import genome
+from deepcpg.data import manifest
 from deepcpg.data import feature_extractor as fext
-from deepcpg.utils import make_dir
+from deepcpg.data.profiles import CpgProfile, CpgProfileCache, \
+    CpgProfileStore
+from deepcpg.utils import make_dir, format_table, get_rss, StageTimer, \
+    summarize_stages
 
 
-def prepro_pos_table(pos_tables):
-    """Extracts unique positions and sorts them."""
-    if not isinstance(pos_tables, list):
-        pos_tables = [pos_tables]
+def read_pos_table(filename):
+    """Reads position table with columns chromosome and position.
 
-    pos_table = None
-    for next_pos_table in pos_tables:
-        if pos_table is None:
-            pos_table = next_pos_table
-        else:
-            pos_table = pd.concat([pos_table, next_pos_table])
-        pos_table = pos_table.groupby('chromo').apply(
-            lambda df: pd.DataFrame({'pos': np.unique(df['pos'])}))
-        pos_table.reset_index(inplace=True)
-        pos_table = pos_table[['chromo', 'pos']]
-        pos_table.sort_values(['chromo', 'pos'], inplace=True)
+    Returns
+    -------
+    OrderedDict with tuple (pos, cov) for each chromosome sorted by name.
+    `pos` are unique positions sorted in ascending order and `cov` is `None`.
+    """
+    pos_table = pd.read_table(filename, usecols=[0, 1],
+                              dtype={0: str, 1: np.int32},
+                              header=None, comment='#')
+    pos_table.columns = ['chromo', 'pos']
+    pos_table['chromo'] = dat.format_chromo(pos_table['chromo'])
+    _pos_table = OrderedDict()
+    for chromo, chromo_table in sorted(pos_table.groupby('chromo')):
+        _pos_table[chromo] = (np.unique(chromo_table.pos.values), None)
+    return _pos_table
+
+
+def merge_pos_tables(cpg_profiles, max_sites=None):
+    """Merges positions of profiles in `CpgProfileStore`.
+
+    If `max_sites` is given, positions are merged in batches as by
+    `CpgProfileStore.merge_pos`.
+
+    Returns
+    -------
+    OrderedDict with tuple (pos, cov) for each chromosome sorted by name.
+    `pos` are unique positions sorted in ascending order and `cov` the
+    number of profiles that cover them.
+    """
+    pos_table = OrderedDict()
+    for chromo in cpg_profiles.chromos():
+        pos_table[chromo] = cpg_profiles.merge_pos(chromo, max_sites)
     return pos_table
 
 
+def head_pos_table(pos_table, nb_sample):
+    """Selects the first `nb_sample` positions of `pos_table`."""
+    _pos_table = OrderedDict()
+    for chromo, (pos, cov) in pos_table.items():
+        if nb_sample <= 0:
+            break
+        if cov is not None:
+            cov = cov[:nb_sample]
+        _pos_table[chromo] = (pos[:nb_sample], cov)
+        nb_sample -= len(_pos_table[chromo][0])
+    return _pos_table
+
+
 def split_ext(filename):
     return os.path.basename(filename).split(os.extsep)[0]
 
 
-def read_cpg_profiles(filenames, *args, **kwargs):
-    cpg_profiles = OrderedDict()
+def _read_cpg_profile(args):
+    """Reads profile in worker and saves it to `prefix` or cache."""
+    filename, prefix, cache_dir, kwargs = args
+    cpg_profile = CpgProfile.from_dict(dat.read_cpg_profile(filename,
+                                                            **kwargs))
+    if cache_dir:
+        CpgProfileCache(cache_dir).save(filename, cpg_profile, **kwargs)
+    else:
+        cpg_profile.save(prefix)
+    return prefix
+
+
+def read_cpg_profiles(filenames, nb_worker=1, tmp_dir=None, cache=None,
+                      mmap=False, **kwargs):
+    """Reads profiles into `CpgProfileStore`.
+
+    If `nb_worker` > 1, files are parsed concurrently by worker processes,
+    which save profiles as `.npy` files in `tmp_dir`. These are
+    memory-mapped instead of being pickled to the main process and removed
+    after opening them. If `mmap` is `True`, profiles are also saved and
+    memory-mapped if they are parsed by a single process.
+
+    If a `CpgProfileCache` is given, cached profiles are loaded instead of
+    parsing files, and newly parsed profiles are added to the cache.
+    """
+    profiles = dict()
+    if cache is not None:
+        for filename in filenames:
+            profile = cache.load(filename, **kwargs)
+            if profile is not None:
+                profiles[filename] = profile
+    missing = [filename for filename in filenames
+               if filename not in profiles]
+
+    parallel = nb_worker > 1 and len(missing) > 1
+    if not parallel and (cache is not None or not mmap):
+        for filename in missing:
+            if cache is not None:
+                profiles[filename] = cache.read(filename, **kwargs)
+            else:
+                profiles[filename] = CpgProfile.from_dict(
+                    dat.read_cpg_profile(filename, **kwargs))
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='.dcpg_profiles_', dir=tmp_dir)
+        cache_dir = cache.cache_dir if cache is not None else None
+        pool = None
+        if parallel:
+            pool = mp.get_context('fork').Pool(min(nb_worker, len(missing)))
+        try:
+            tasks = [(filename, os.path.join(tmp_dir, str(i)), cache_dir,
+                      kwargs) for i, filename in enumerate(missing)]
+            if pool is not None:
+                prefixes = pool.imap(_read_cpg_profile, tasks)
+            else:
+                prefixes = map(_read_cpg_profile, tasks)
+            for filename, prefix in zip(missing, prefixes):
+                if cache is not None:
+                    profiles[filename] = cache.load(filename, **kwargs)
+                else:
+                    profiles[filename] = CpgProfile.load(prefix)
+            if pool is not None:
+                pool.close()
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+            # Memory-mapped files remain accessible after removing them
+            shutil.rmtree(tmp_dir)
+
+    if cache is not None:
+        cache.prune()
+
+    cpg_profiles = CpgProfileStore()
     for filename in filenames:
-        cpg_file = dat.GzipFile(filename, 'r')
-        output_name = split_ext(filename)
-        cpg_profile = dat.read_cpg_table(cpg_file, sort=True, *args, **kwargs)
-        cpg_profiles[output_name] = cpg_profile
-        cpg_file.close()
+        cpg_profiles.add(split_ext(filename), profiles[filename])
     return cpg_profiles
 
 
+# Maximum number of nucleotides between DNA windows that are read at once
+_FETCH_GAP = 2**16
+# Maximum number of nucleotides that are read at once
+_FETCH_MAX_LEN = 2**22
+
+
 def extract_seq_windows(seq, pos, wlen, seq_index=1, assert_cpg=False):
     """Extracts DNA sequence windows at positions.
 
     Parameters
     ----------
-    seq: DNA sequence string
+    seq: DNA sequence string or integer sequence as returned by
+        `dna.char_to_int`, which can be memory-mapped. Sequences should be
+        converted once per chromosome if windows are extracted repeatedly.
     pos: Array with positions at which windows are extracted
     wlen: Window length
     seq_index: Minimum positions. Set to 0 if positions in `pos` start at 0
         instead of 1
-    cpg_sites: Check if positions in `pos` point to CpG sites
+    assert_cpg: Check if positions in `pos` point to CpG sites
     """
 
     delta = wlen // 2
-    nb_win = len(pos)
-    seq = seq.upper()
-    seq_wins = np.zeros((nb_win, wlen), dtype='int8')
-
-    for i in range(nb_win):
-        p = pos[i] - seq_index
-        if seq[p:p + 2] != 'CG':
-            warnings.warn('No CpG at position %d!' % p)
-        win = seq[max(0, p - delta): min(len(seq), p + delta + 1)]
-        if len(win) < wlen:
-            win = max(0, delta - p) * 'N' + win
-            win += max(0, p + delta + 1 - len(seq)) * 'N'
-            assert len(win) == wlen
-        seq_wins[i] = dna.char_to_int(win)
-    # Randomly choose missing nucleotides
+    nan = dna.CHAR_TO_INT['N']
+    if isinstance(seq, str):
+        seq = dna.char_to_int(seq)
+    pos = np.asarray(pos) - seq_index
+    seq_len = len(seq)
+
+    # Positions outside the sequence are no CpG sites
+    valid = (pos >= 0) & (pos + 1 < seq_len)
+    cur = np.where(valid, pos, 0)
+    nb_cpg = np.sum((seq[cur] == dna.CHAR_TO_INT['C']) &
+                    (seq[np.minimum(cur + 1, seq_len - 1)] ==
+                     dna.CHAR_TO_INT['G']) & valid)
+    if nb_cpg < len(pos):
+        warnings.warn('No CpG at %d of %d positions!' %
+                      (len(pos) - nb_cpg, len(pos)))
+
+    # View with one window per row, where window i starts at position i.
+    # Windows that overlap with the sequence borders are padded with 'N'.
+    starts = pos - delta
+    inner = (starts >= 0) & (starts + wlen <= seq_len)
+    seq_wins = np.empty((len(pos), wlen), dtype=np.int8)
+    if seq_len >= wlen:
+        wins = np.lib.stride_tricks.as_strided(
+            seq, shape=(seq_len - wlen + 1, wlen),
+            strides=(seq.strides[0], seq.strides[0]))
+        seq_wins[inner] = wins[starts[inner]]
+    if not np.all(inner):
+        idx = np.expand_dims(starts[~inner], 1) + np.arange(wlen)
+        valid = (idx >= 0) & (idx < seq_len)
+        border_wins = np.empty(idx.shape, dtype=np.int8)
+        border_wins.fill(nan)
+        border_wins[valid] = seq[idx[valid]]
+        seq_wins[~inner] = border_wins
+
+    return fill_seq_windows(seq_wins, assert_cpg)
+
+
+def fetch_seq_windows(reader, name, pos, wlen, seq_index=1, assert_cpg=False):
+    """Extracts DNA sequence windows at positions from indexed FASTA file.
+
+    Reads only the windows instead of the entire sequence, which is faster
+    if windows cover only a small part of the sequence. Windows that overlap
+    or are less than `_FETCH_GAP` apart are read as a single range of at
+    most `_FETCH_MAX_LEN` nucleotides, and ranges are read in ascending
+    order, such that gzip files are decompressed in a single forward pass.
+
+    Parameters
+    ----------
+    reader: `fasta.IndexedFastaReader`
+    name: Sequence name in `reader`
+    pos: Array with positions at which windows are extracted
+    wlen: Window length
+    seq_index: Minimum positions. Set to 0 if positions in `pos` start at 0
+        instead of 1
+    assert_cpg: Check if positions in `pos` point to CpG sites
+    """
+
+    delta = wlen // 2
+    nan = dna.CHAR_TO_INT['N']
+    pos = np.asarray(pos) - seq_index
+    # Windows with one extra nucleotide for checking CpG sites at the border
+    seq_wins = np.empty((len(pos), wlen + 1), dtype=np.int8)
+    order = np.argsort(pos, kind='mergesort')
+    starts = pos[order] - delta
+    gaps = np.flatnonzero(np.diff(starts) > wlen + 1 + _FETCH_GAP) + 1
+    gaps = np.hstack((gaps, len(starts)))
+    breaks = []
+    i = 0
+    while i < len(starts):
+        # End of range that starts at window `i`
+        end = np.searchsorted(starts, starts[i] + _FETCH_MAX_LEN - wlen - 1,
+                              side='right')
+        end = min(max(end, i + 1), gaps[np.searchsorted(gaps, i, 'right')])
+        breaks.append(end)
+        i = end
+    for idx in np.split(np.arange(len(starts)), breaks[:-1]):
+        if not len(idx):
+            continue
+        range_start = starts[idx[0]]
+        range_end = starts[idx[-1]] + wlen + 1
+        seq = np.empty(range_end - range_start, dtype=np.int8)
+        seq.fill(nan)
+        fetched = dna.char_to_int(reader.fetch(name, range_start, range_end))
+        left = max(0, -range_start)
+        seq[left:left + len(fetched)] = fetched
+        wins = np.lib.stride_tricks.as_strided(
+            seq, shape=(len(seq) - wlen, wlen + 1),
+            strides=(seq.strides[0], seq.strides[0]))
+        seq_wins[order[idx]] = wins[starts[idx] - range_start]
+
+    nb_cpg = np.sum((seq_wins[:, delta] == dna.CHAR_TO_INT['C']) &
+                    (seq_wins[:, delta + 1] == dna.CHAR_TO_INT['G']))
+    if nb_cpg < len(pos):
+        warnings.warn('No CpG at %d of %d positions!' %
+                      (len(pos) - nb_cpg, len(pos)))
+    return fill_seq_windows(seq_wins[:, :wlen], assert_cpg)
+
+
+def fill_seq_windows(seq_wins, assert_cpg=False):
+    """Randomly chooses missing nucleotides of DNA sequence windows."""
+    delta = seq_wins.shape[1] // 2
     idx = seq_wins == dna.CHAR_TO_INT['N']
     seq_wins[idx] = np.random.randint(0, 4, idx.sum())
     assert seq_wins.max() < 4
@@ -109,41 +317,154 @@ def extract_seq_windows(seq, pos, wlen, seq_index=1, assert_cpg=False):
     return seq_wins
 
 
-def map_values(values, pos, target_pos, dtype=None, nan=dat.CPG_NAN):
-    """Maps `values` array at positions `pos` to `target_pos`."""
+def is_sorted(x):
+    return np.all(x[1:] >= x[:-1])
+
+
+def map_index(pos, target_pos):
+    """Returns for each `target_pos` index in `pos` and if it was found.
+
+    Parameters
+    ----------
+    pos: Array with positions sorted in ascending order
+    target_pos: Array with target positions
+
+    Returns
+    -------
+    Tuple (idx, found) of arrays of length len(target_pos). pos[idx[i]] ==
+    target_pos[i] if found[i] is `True`.
+    """
+    idx = np.searchsorted(pos, target_pos)
+    if not len(pos):
+        return (idx, np.zeros(len(target_pos), dtype=bool))
+    idx = np.minimum(idx, len(pos) - 1)
+    return (idx, pos[idx] == target_pos)
+
+
+def map_values(values, pos, target_pos, dtype=None, nan=dat.CPG_NAN,
+               out=None):
+    """Maps `values` array at positions `pos` to `target_pos`.
+
+    If `out` is provided, values are written to `out`, e.g. a column of a
+    preallocated matrix, which must be initialized with `nan`.
+    """
     assert len(values) == len(pos)
-    assert np.all(pos == np.sort(pos))
-    assert np.all(target_pos == np.sort(target_pos))
+    assert is_sorted(pos)
 
     values = values.ravel()
     pos = pos.ravel()
     target_pos = target_pos.ravel()
-    idx = np.in1d(pos, target_pos)
-    pos = pos[idx]
-    values = values[idx]
-    if not dtype:
-        dtype = values.dtype
-    target_values = np.empty(len(target_pos), dtype=dtype)
-    target_values.fill(nan)
-    idx = np.in1d(target_pos, pos).nonzero()[0]
-    assert len(idx) == len(values)
-    assert np.all(target_pos[idx] == pos)
-    target_values[idx] = values
-    return target_values
-
-
-def map_cpg_tables(cpg_tables, chromo, chromo_pos):
+    if out is None:
+        if not dtype:
+            dtype = values.dtype
+        out = np.empty(len(target_pos), dtype=dtype)
+        out.fill(nan)
+    idx, found = map_index(pos, target_pos)
+    out[found] = values[idx[found]]
+    return out
+
+
+def map_cpg_tables(cpg_tables, chromo, chromo_pos, dtype=np.int8,
+                   nan=dat.CPG_NAN):
+    """Maps profiles of `chromo` to `chromo_pos`.
+
+    Returns
+    -------
+    nb_site x nb_profile matrix with values of profiles at `chromo_pos`
+    """
     chromo_pos.sort()
-    mapped_tables = OrderedDict()
-    for name, cpg_table in cpg_tables.items():
-        cpg_table = cpg_table.loc[cpg_table.chromo == chromo]
-        cpg_table = cpg_table.sort_values(['chromo', 'pos'])
-        mapped_table = map_values(cpg_table.value.values,
-                                  cpg_table.pos.values,
-                                  chromo_pos)
-        assert len(mapped_table) == len(chromo_pos)
-        mapped_tables[name] = mapped_table
-    return mapped_tables
+    mat = np.empty((len(chromo_pos), len(cpg_tables)), dtype=dtype)
+    mat.fill(nan)
+    if not len(chromo_pos):
+        return mat
+    for i, name in enumerate(cpg_tables.names()):
+        # Only sites in the range of `chromo_pos` are read
+        pos, value = cpg_tables.get(name, chromo, chromo_pos[0],
+                                    chromo_pos[-1])
+        map_values(value, pos, chromo_pos, out=mat[:, i])
+    return mat
+
+
+def get_chunk_file(out_dir, chromo, start, end):
+    return os.path.join(out_dir, 'c%s_%06d-%06d.h5' % (chromo, start, end))
+
+
+def get_chunk_files(out_dir):
+    """Returns OrderedDict with chunk files of each chromosome in `out_dir`
+    sorted by position."""
+    chunk_files = OrderedDict()
+    for filename in glob(os.path.join(out_dir, 'c*_*-*.h5')):
+        match = re.match(r'c(.+)_(\d+)-\d+\.h5$', os.path.basename(filename))
+        if match:
+            chunk_files.setdefault(match.group(1), []).append(
+                (int(match.group(2)), filename))
+    for chromo in sorted(chunk_files.keys()):
+        chunk_files[chromo] = [filename for _, filename
+                               in sorted(chunk_files.pop(chromo))]
+    return chunk_files
+
+
+def remove_tmp_files(filename):
+    """Removes temporary files of chunk file `filename` that were partially
+    written by killed runs.
+
+    Only temporary files of chunks that are about to be written are removed,
+    such that runs of other chromosomes that write to the same directory
+    are not affected.
+    """
+    for tmp_file in glob('%s.tmp*' % escape(filename)):
+        os.remove(tmp_file)
+
+
+# Options that do not change the content of chunk files
+_BUILD_EXCLUDE = ['out_dir', 'cache_dir', 'cache_size', 'nb_worker',
+                  'memory_budget', 'resume', 'verbose', 'log_file']
+
+
+def get_build(opts):
+    """Returns hash of input files and options that determine chunk files.
+
+    Input files are identified by their path, size, and modification time,
+    as by `CpgProfileCache`, instead of hashing their content.
+    """
+    filenames = []
+    for name in ['cpg_profiles', 'bulk_profiles', 'anno_files']:
+        filenames.extend(getattr(opts, name) or [])
+    if opts.pos_file:
+        filenames.append(opts.pos_file)
+    if opts.dna_db:
+        if genome.is_cache(opts.dna_db):
+            filenames.append(os.path.join(opts.dna_db, genome.INDEX_FILE))
+        else:
+            filenames.extend(genome.get_chromo_files(opts.dna_db).values())
+    inputs = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        inputs.append([os.path.abspath(filename), stat.st_size,
+                       stat.st_mtime_ns])
+    options = [[key, value] for key, value in sorted(vars(opts).items())
+               if key not in _BUILD_EXCLUDE]
+    build = json.dumps([inputs, options])
+    return hashlib.sha1(build.encode()).hexdigest()
+
+
+def write_timing(records, prefix):
+    """Writes `StageTimer` records to `prefix`.tsv and records with summary
+    to `prefix`.json."""
+    pd.DataFrame(records).to_csv(prefix + '.tsv', sep='\t', index=False)
+    with open(prefix + '.json', 'w') as f:
+        json.dump(OrderedDict([('records', records),
+                               ('summary', summarize_stages(records))]),
+                  f, indent=2)
+
+
+def write_output(group, name, value, dtype, obs_stats=None):
+    """Writes output `value` to dataset `name` of `group` and adds its tuple
+    (nb_obs, mean) to `obs_stats` for `manifest.describe`."""
+    value = np.asarray(value, dtype=dtype)
+    dataset = group.create_dataset(name, data=value, compression='gzip')
+    if obs_stats is not None:
+        obs_stats[dataset.name.lstrip('/')] = manifest.get_obs_stats(value)
 
 
 def format_out_of(out, of):
@@ -156,6 +477,8 @@ def get_stats_meta(names):
         fun = stats.get(name)
         if name in ['mode', 'cat_var', 'cat2_var', 'diff']:
             dtype = np.int8
+        elif name == 'cov':
+            dtype = np.int32
         else:
             dtype = np.float32
         funs[name] = (fun, dtype)
@@ -172,18 +495,24 @@ def select_dict(data, idx):
     return data
 
 
-def annotate(anno_file, chromo, pos):
-    anno_file = dat.GzipFile(anno_file, 'r')
-    anno = pd.read_table(anno_file, header=None, usecols=[0, 1, 2],
-                         dtype={0: 'str', 1: 'int32', 2: 'int32'})
-    anno_file.close()
-    anno.columns = ['chromo', 'start', 'end']
-    anno.chromo = anno.chromo.str.upper().str.replace('CHR', '')
-    anno = anno.loc[anno.chromo == chromo]
-    anno.sort_values('start', inplace=True)
-    start, end = an.join_overlapping(anno.start.values, anno.end.values)
-    anno = np.array(an.is_in(pos, start, end), dtype='int8')
-    return anno
+# App instance that is shared with worker processes via fork
+_worker_app = None
+
+
+def _init_worker(log_queue):
+    """Redirects log messages of worker process to queue of main process."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _process_chromo(args):
+    return (args[0], _worker_app.process_chromo(*args))
+
+
+def _append_chromo(args):
+    return (args[0], _worker_app.append_chromo(*args))
 
 
 class App(object):
@@ -204,6 +533,10 @@ class App(object):
         p.add_argument(
             '--pos_file',
             help='File with positions of CpG sites that are to be predicted. If missing, only CpG sites that are observed in at least one of the given cells will be used.')
+        p.add_argument(
+            '--all_cpgs',
+            help='Predict all CpG sites of `--dna_db` instead of observed CpG sites. Cannot be combined with `--pos_file` or `--cpg_cov`.',
+            action='store_true')
         p.add_argument(
             '--cpg_profiles',
             help='Input single-cell methylation profiles in dcpg or bedGraph format that are to be imputed',
@@ -214,16 +547,15 @@ class App(object):
             type=int)
         p.add_argument(
             '--cpg_cov',
-            help='Minimum CpG coverage. Only use CpG sites for which the true methylation state is known in at least that many cells.',
-            type=int,
-            default=1)
+            help='Minimum CpG coverage. Only use CpG sites for which the true methylation state is known in at least that many cells. Defaults to 1, or 0 with `--all_cpgs`.',
+            type=int)
         p.add_argument(
             '--bulk_profiles',
             help='Input bulk methylation profiles in dcpg or bedGraph format that are to be imputed',
             nargs='+')
         p.add_argument(
             '--dna_db',
-            help='DNA database for extracting DNA sequence windows. Directory with one FASTA file per chromosome as downloadable from UCSC.')
+            help='DNA database for extracting DNA sequence windows. Directory with one FASTA file per chromosome as downloadable from UCSC, or genome cache created by `dcpg_dna_cache.py`, which is memory-mapped.')
         p.add_argument(
             '--dna_wlen',
             help='DNA window length',
@@ -231,8 +563,12 @@ class App(object):
             default=1001)
         p.add_argument(
             '--anno_files',
-            help='Files with genomic annotations that are used as input features. Currently ignored by `dcpg_train.py`.',
+            help='Files with genomic annotations that are used as input features. Currently ignored by `dcpg_train.py`. Merged intervals are cached next to each file.',
             nargs='+')
+        p.add_argument(
+            '--anno_dist',
+            help='Also add distance to the nearest annotated interval as input feature',
+            action='store_true')
         p.add_argument(
             '-o', '--out_dir',
             help='Output directory',
@@ -277,6 +613,30 @@ class App(object):
             type=int,
             default=32768,
             help='Maximum number of samples per output file. Should be divisible by batch size.')
+        g.add_argument(
+            '--cache_dir',
+            help='Directory for caching parsed profiles, which are loaded instead of parsing input files in subsequent runs')
+        g.add_argument(
+            '--cache_size',
+            type=float,
+            help='Maximum size of --cache_dir in GB. Least recently used profiles are removed if exceeded.')
+        g.add_argument(
+            '--nb_worker',
+            type=int,
+            default=1,
+            help='Number of processes for reading profiles and processing chromosomes in parallel')
+        g.add_argument(
+            '--memory_budget',
+            type=float,
+            help='Approximate memory budget in GB that is shared by all processes. Profiles are memory-mapped, positions of profiles are merged in batches, and chromosomes are processed in tiles of chunks that fit into the budget. The resulting table of positions, which takes 8 bytes per site, is part of the budget.')
+        g.add_argument(
+            '--resume',
+            help='Skip chunk files that were completely written by a previous run with the same input files and options, e.g. after it was killed',
+            action='store_true')
+        g.add_argument(
+            '--append',
+            help='Add cells of --cpg_profiles that are missing in existing chunk files of --out_dir and recompute statistics instead of rebuilding the dataset. Positions and DNA windows are kept. Window-based statistics require the profiles of all cells.',
+            action='store_true')
         g.add_argument(
             '--verbose',
             help='More detailed log messages',
@@ -286,9 +646,572 @@ class App(object):
             help='Write log messages to file')
         return p
 
+    def map_outputs(self, chromo, pos):
+        """Maps profiles of `chromo` to `pos`."""
+        outputs = self.outputs
+        pos_outputs = OrderedDict()
+
+        if 'cpg' in outputs:
+            # Map CpG tables into single nb_site x nb_output matrix
+            cpg_mat = map_cpg_tables(outputs['cpg'], chromo, pos)
+            assert len(cpg_mat) == len(pos)
+            pos_outputs['cpg'] = OrderedDict(
+                zip(outputs['cpg'].names(), cpg_mat.T))
+            pos_outputs['cpg_mat'] = cpg_mat
+
+        if 'bulk' in outputs:
+            # Map CpG tables into single nb_site x nb_output matrix
+            bulk_mat = map_cpg_tables(outputs['bulk'], chromo, pos,
+                                      dtype=np.float32)
+            pos_outputs['bulk'] = OrderedDict(
+                zip(outputs['bulk'].names(), bulk_mat.T))
+
+        return pos_outputs
+
+    def annotate(self, chromo, pos):
+        """Returns tuple (annos, annos_dist) with annotations of `pos` and
+        distances to the nearest interval, which are `None` if not used."""
+        annos = None
+        annos_dist = None
+        if self.annos:
+            self.log.info('Annotating CpG sites ...')
+            annos = OrderedDict()
+            for name, anno in self.annos.items():
+                annos[name] = anno.is_in(chromo, pos).astype(np.int8)
+            if self.opts.anno_dist:
+                annos_dist = OrderedDict()
+                for name, anno in self.annos.items():
+                    annos_dist[name] = anno.distance(chromo, pos)
+        return (annos, annos_dist)
+
+    def get_tiling(self):
+        """Returns tuple (tile_size, knn_batch) with the number of sites of
+        which outputs are mapped at once and the number of cells of which
+        CpG neighbors are extracted at once.
+
+        Both are chosen such that the estimated memory usage of each process
+        is within `--memory_budget`. `tile_size` is a multiple of
+        `--chunk_size`.
+        """
+        opts = self.opts
+        outputs = self.outputs
+        nb_cell = len(outputs['cpg']) if 'cpg' in outputs else 0
+        nb_bulk = len(outputs['bulk']) if 'bulk' in outputs else 0
+        nb_anno = len(self.annos) * (1 + 8 * bool(opts.anno_dist))
+        nb_wlen = len(opts.win_stats_wlen) if opts.win_stats else 0
+        nb_knn = 2 * (opts.cpg_wlen // 2) if opts.cpg_wlen else 0
+        # Peak instead of current RSS, which is not provided by `resource`,
+        # such that the budget is underestimated if memory was freed
+        budget = opts.memory_budget * 1024**3 / opts.nb_worker - get_rss()
+
+        # Estimated bytes per site of a tile, chunk, and cell of a chunk
+        tile_bytes = 16 + nb_cell + 4 * nb_bulk + nb_anno
+        chunk_bytes = 64 + 2 * opts.dna_wlen + nb_cell * (24 + 8 * nb_wlen) \
+            + 17 * nb_knn
+        knn_bytes = 5 * nb_knn
+
+        budget -= opts.chunk_size * chunk_bytes
+        knn_batch = max(nb_cell, 1)
+        if knn_bytes:
+            knn_batch = int(budget / 4 / (opts.chunk_size * knn_bytes))
+            knn_batch = max(min(knn_batch, nb_cell), 1)
+            budget -= knn_batch * opts.chunk_size * knn_bytes
+        nb_tile_chunk = int(budget / (opts.chunk_size * tile_bytes))
+        if nb_tile_chunk < 1:
+            self.log.warning('Memory budget too small for --chunk_size %d!' %
+                             opts.chunk_size)
+            nb_tile_chunk = 1
+        return (nb_tile_chunk * opts.chunk_size, knn_batch)
+
+    def get_done_entry(self, filename):
+        """Returns manifest entry of chunk file `filename` if it was written
+        by a run with the same build or `None`."""
+        if not os.path.isfile(filename):
+            return None
+        entry = self.prev_entries.get(filename)
+        if entry is not None:
+            return entry
+        # Chunk file of chromosome that was not completed by previous run
+        try:
+            with h5.File(filename, 'r') as h5_file:
+                if h5_file.attrs.get('build') == self.build:
+                    return manifest.describe(h5_file)
+        except OSError:
+            pass
+        return None
+
+    def update_manifest(self, entries):
+        """Adds `entries` of processed chromosome to manifest, such that
+        they are skipped if the run is resumed."""
+        self.entries.update(entries)
+        # Chunk files of different builds are listed while appending cells
+        build = None if self.opts.append else self.build
+        manifest.write_manifest(self.opts.out_dir, self.entries, build)
+
+    def process_chromo(self, chromo, chromo_pos, chromo_cov=None):
+        """Creates data chunk files of single chromosome.
+
+        `chromo_cov` is the number of profiles that cover `chromo_pos` and
+        computed if `None`.
+
+        Returns
+        -------
+        Tuple (entries, records) with dict of manifest entry of each chunk
+        file and list of `StageTimer` records
+        """
+        opts = self.opts
+        log = self.log
+        outputs = self.outputs
+        cpg_stats_meta = self.cpg_stats_meta
+        win_stats_meta = self.win_stats_meta
+        timer = StageTimer(chromo=chromo)
+        entries = OrderedDict()
+
+        log.info('-' * 80)
+        log.info('Chromosome %s ...' % (chromo))
+
+        if 'cpg' in outputs and opts.cpg_cov:
+            # Filter sites by coverage before mapping profiles
+            with timer.stage('cov_filter', len(chromo_pos)):
+                if chromo_cov is None:
+                    # Coverage is computed for tiles, which bounds the size
+                    # of temporary arrays
+                    tile_size = self.tile_size or max(len(chromo_pos), 1)
+                    chromo_cov = np.empty(len(chromo_pos), dtype=np.int32)
+                    for start in range(0, len(chromo_pos), tile_size):
+                        end = start + tile_size
+                        chromo_cov[start:end] = outputs['cpg'].coverage(
+                            chromo, chromo_pos[start:end])
+                idx = chromo_cov >= opts.cpg_cov
+                tmp = '%s sites matched minimum coverage filter'
+                tmp %= format_out_of(idx.sum(), len(idx))
+                log.info(tmp)
+                chromo_pos = chromo_pos[idx]
+            if len(chromo_pos) == 0:
+                return (entries, timer.records)
+
+        chunks = []
+        for chunk_start in range(0, len(chromo_pos), opts.chunk_size):
+            chunk_end = min(len(chromo_pos), chunk_start + opts.chunk_size)
+            chunks.append((chunk_start, chunk_end,
+                           get_chunk_file(opts.out_dir, chromo, chunk_start,
+                                          chunk_end)))
+        if not chunks:
+            return (entries, timer.records)
+
+        # Skip chunks that were completely written by a previous run with the
+        # same inputs and options
+        if opts.resume:
+            with timer.stage('resume', len(chromo_pos)):
+                for _, _, filename in chunks:
+                    entry = self.get_done_entry(filename)
+                    if entry is not None:
+                        entries[filename] = entry
+            tmp = '%s chunks completed by previous run'
+            log.info(tmp % format_out_of(len(entries), len(chunks)))
+            if len(entries) == len(chunks):
+                return (entries, timer.records)
+
+        # Read DNA of chromosome
+        chromo_dna = None
+        dna_reader = None
+        if opts.dna_db:
+            with timer.stage('read_dna'):
+                if genome.is_cache(opts.dna_db):
+                    chromo_dna = genome.read_chromo(opts.dna_db, chromo)
+                else:
+                    dna_file = fasta.get_chromo_file(opts.dna_db, chromo)
+                    # Only read windows if they cover a small part of the
+                    # sequence or the sequence might not fit into the memory
+                    # budget. The sequence length is approximated by the
+                    # last position if the file is not indexed yet, such
+                    # that it is not decompressed twice.
+                    seq_len = chromo_pos[-1]
+                    dna_index = fasta.load_index(dna_file)
+                    if dna_index is not None:
+                        seq_len = list(dna_index.values())[0].length
+                    if opts.memory_budget or \
+                            len(chromo_pos) * opts.dna_wlen < seq_len:
+                        dna_reader = fasta.IndexedFastaReader(dna_file)
+                        dna_name = dna_reader.names()[0]
+                    else:
+                        chromo_dna = genome.read_chromo(opts.dna_db, chromo)
+
+        # Iterate over chunks
+        # -------------------
+        # Outputs and annotations are mapped for tiles of `tile_size` sites,
+        # which cover the entire chromosome if no memory budget is given.
+        tile_size = self.tile_size or len(chromo_pos)
+        tile_end = 0
+        for chunk, (chunk_start, chunk_end, filename) in enumerate(chunks):
+            if filename in entries:
+                continue
+            log.info('Chunk \t%d / %d' % (chunk + 1, len(chunks)))
+            chunk_pos = chromo_pos[chunk_start:chunk_end]
+
+            if chunk_start >= tile_end:
+                tile_start = chunk_start
+                tile_end = min(len(chromo_pos), tile_start + tile_size)
+                tile_pos = chromo_pos[tile_start:tile_end]
+                with timer.stage('map', len(tile_pos)):
+                    tile_outputs = self.map_outputs(chromo, tile_pos)
+                with timer.stage('annotate', len(tile_pos)):
+                    annos, annos_dist = self.annotate(chromo, tile_pos)
+            chunk_idx = slice(chunk_start - tile_start, chunk_end - tile_start)
+            chunk_outputs = select_dict(tile_outputs, chunk_idx)
+
+            # Chunks are written to temporary files and renamed after they
+            # are complete, such that killed runs do not leave partially
+            # written chunk files
+            remove_tmp_files(filename)
+            tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+            chunk_file = h5.File(tmp_filename, 'w')
+            chunk_file.attrs['build'] = self.build
+            nb_site = len(chunk_pos)
+            # Observed values of outputs, which are computed in memory for
+            # the manifest instead of reading outputs from file
+            obs_stats = OrderedDict()
+
+            with timer.stage('write', nb_site, chunk=chunk + 1):
+                # Write positions
+                chunk_file.create_dataset('chromo', shape=(len(chunk_pos),),
+                                          dtype='S2')
+                chunk_file['chromo'][:] = chromo.encode()
+                chunk_file.create_dataset('pos', data=chunk_pos,
+                                          dtype=np.int32)
+
+                if len(chunk_outputs):
+                    out_group = chunk_file.create_group('outputs')
+
+                # Write cpg profiles
+                if 'cpg' in chunk_outputs:
+                    for name, value in chunk_outputs['cpg'].items():
+                        assert len(value) == len(chunk_pos)
+                        write_output(out_group, 'cpg/%s' % name, value,
+                                     np.int8, obs_stats)
+
+                # Write bulk profiles
+                if 'bulk' in chunk_outputs:
+                    for name, value in chunk_outputs['bulk'].items():
+                        assert len(value) == len(chunk_pos)
+                        write_output(out_group, 'bulk/%s' % name, value,
+                                     np.float32, obs_stats)
+
+            # Compute and write statistics
+            if 'cpg' in chunk_outputs and cpg_stats_meta is not None:
+                log.info('Computing per CpG statistics ...')
+                with timer.stage('stats', nb_site, chunk=chunk + 1):
+                    self.write_cpg_stats(out_group, chunk_outputs['cpg_mat'],
+                                         cpg_stats_meta, obs_stats)
+
+            if 'cpg' in chunk_outputs and win_stats_meta is not None:
+                log.info('Computing window-based statistics ...')
+                with timer.stage('win_stats', nb_site, chunk=chunk + 1):
+                    self.write_win_stats(out_group, chromo, chunk_pos,
+                                         win_stats_meta, opts.win_stats_wlen,
+                                         obs_stats)
+
+            # Write input features
+            in_group = chunk_file.create_group('inputs')
+
+            # DNA windows
+            if chromo_dna is not None or dna_reader is not None:
+                log.info('Extracting DNA sequence windows ...')
+                with timer.stage('dna_windows', nb_site, chunk=chunk + 1):
+                    if dna_reader is not None:
+                        dna_wins = fetch_seq_windows(dna_reader, dna_name,
+                                                     pos=chunk_pos,
+                                                     wlen=opts.dna_wlen)
+                    else:
+                        dna_wins = extract_seq_windows(chromo_dna,
+                                                       pos=chunk_pos,
+                                                       wlen=opts.dna_wlen)
+                    assert len(dna_wins) == len(chunk_pos)
+                    in_group.create_dataset('dna', data=dna_wins,
+                                            dtype=np.int8,
+                                            compression='gzip')
+
+            # CpG neighbors
+            if opts.cpg_wlen:
+                log.info('Extracting CpG neighbors ...')
+                with timer.stage('knn', nb_site, chunk=chunk + 1):
+                    self.write_cpg_neighbors(in_group, chromo, chunk_pos)
+
+            if annos:
+                log.info('Adding annotations ...')
+                with timer.stage('write_annos', nb_site, chunk=chunk + 1):
+                    group = in_group.create_group('annos')
+                    for name, anno in annos.items():
+                        group.create_dataset(name, data=anno[chunk_idx],
+                                             dtype='int8',
+                                             compression='gzip')
+                    if annos_dist:
+                        group = in_group.create_group('annos_dist')
+                        for name, dist in annos_dist.items():
+                            group.create_dataset(name, data=dist[chunk_idx],
+                                                 dtype=np.int32,
+                                                 compression='gzip')
+
+            with timer.stage('manifest', nb_site, chunk=chunk + 1):
+                entries[filename] = manifest.describe(chunk_file, obs_stats)
+
+            # Bytes are counted once per chunk after the file is closed since
+            # HDF5 only writes buffered data to disk when flushing
+            with timer.stage('write', 0, chunk=chunk + 1) as record:
+                chunk_file.close()
+                record['nb_byte'] = os.path.getsize(tmp_filename)
+            os.replace(tmp_filename, filename)
+
+        if dna_reader is not None:
+            dna_reader.close()
+        return (entries, timer.records)
+
+    def write_cpg_stats(self, out_group, cpg_mat, stats_meta, obs_stats=None):
+        """Computes per CpG statistics of nb_site x nb_cell matrix `cpg_mat`
+        and writes them to `out_group` as `write_output`."""
+        cpg_stats = stats.cpg_stats(cpg_mat, list(stats_meta.keys()),
+                                    min_cov=self.opts.stats_cov)
+        for name, fun in stats_meta.items():
+            stat = cpg_stats[name]
+            assert len(stat) == len(cpg_mat)
+            write_output(out_group, 'stats/%s' % name, stat, fun[1],
+                         obs_stats)
+
+    def write_win_stats(self, out_group, chromo, pos, stats_meta, wlens,
+                        obs_stats=None):
+        """Computes window-based statistics of `pos` from all single-cell
+        profiles and writes them to `out_group` as `write_output`."""
+        delta = max(wlens) // 2
+        win_counts = stats.win_counts(
+            pos,
+            self.outputs['cpg'].get_chromo(chromo, pos[0] - delta,
+                                           pos[-1] + delta),
+            wlens)
+        for wlen, (nb_obs, nb_met) in zip(wlens, win_counts):
+            win_stats = stats.win_stats(nb_obs, nb_met,
+                                        list(stats_meta.keys()))
+            group = out_group.create_group('win_stats/%d' % wlen)
+            for name, fun in stats_meta.items():
+                write_output(group, name, win_stats[name], fun[1], obs_stats)
+
+    def append_chromo(self, chromo, filenames):
+        """Adds missing cells to chunk files of single chromosome.
+
+        Outputs and CpG neighbors of cells of `--cpg_profiles` that are
+        missing in a chunk file are added, and statistics, which depend on
+        the set of cells, are recomputed. Chunk files are copied and renamed
+        after they are complete.
+
+        Returns
+        -------
+        Tuple (entries, records) as `process_chromo`
+        """
+        opts = self.opts
+        log = self.log
+        outputs = self.outputs
+        timer = StageTimer(chromo=chromo)
+        entries = OrderedDict()
+
+        log.info('-' * 80)
+        log.info('Chromosome %s ...' % (chromo))
+
+        for chunk, filename in enumerate(filenames):
+            log.info('Chunk \t%d / %d' % (chunk + 1, len(filenames)))
+            with h5.File(filename, 'r') as h5_file:
+                chunk_pos = h5_file['pos'][()]
+                cells = []
+                if 'outputs/cpg' in h5_file:
+                    cells = list(h5_file['outputs/cpg'].keys())
+                names = [name for name in outputs['cpg'].names()
+                         if name not in cells]
+                # CpG neighbors are only added if existing cells have them
+                cpg_wlen = None
+                if not cells:
+                    cpg_wlen = opts.cpg_wlen
+                elif 'inputs/cpg' in h5_file:
+                    cpg_wlen = h5_file['inputs/cpg/%s/dist' %
+                                       cells[0]].shape[1]
+                # Statistics of chunk file if not specified
+                stats_meta = self.cpg_stats_meta
+                if stats_meta is None and 'outputs/stats' in h5_file:
+                    stats_meta = get_stats_meta(
+                        list(h5_file['outputs/stats'].keys()))
+                win_stats_meta = self.win_stats_meta
+                win_stats_wlen = opts.win_stats_wlen
+                if win_stats_meta is None and 'outputs/win_stats' in h5_file:
+                    group = h5_file['outputs/win_stats']
+                    win_stats_wlen = sorted([int(wlen) for wlen in group])
+                    win_stats_meta = get_stats_meta(
+                        list(group[str(win_stats_wlen[0])].keys()))
+
+            prev_entry = self.prev_entries.get(filename)
+            if not names:
+                log.info('No cells missing')
+                entry = prev_entry
+                if entry is None:
+                    entry = manifest.describe(filename)
+                entries[filename] = entry
+                continue
+            if opts.cpg_wlen and cpg_wlen is None:
+                raise ValueError('--cpg_wlen %d given but "%s" has no CpG '
+                                 'neighbors!' % (opts.cpg_wlen, filename))
+            if opts.cpg_wlen and cpg_wlen != opts.cpg_wlen:
+                raise ValueError('--cpg_wlen %d does not match %d of "%s"!' %
+                                 (opts.cpg_wlen, cpg_wlen, filename))
+            missing = [cell for cell in cells if cell not in outputs['cpg']]
+            if win_stats_meta is not None and missing:
+                raise ValueError('Profiles of %s are required for computing '
+                                 'window-based statistics of "%s"!' %
+                                 (', '.join(missing), filename))
+            log.info('Adding %d cells' % len(names))
+
+            remove_tmp_files(filename)
+            tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+            nb_site = len(chunk_pos)
+            with timer.stage('copy', nb_site, chunk=chunk + 1) as record:
+                shutil.copyfile(filename, tmp_filename)
+                copy_size = os.path.getsize(tmp_filename)
+                record['nb_byte'] = copy_size
+            chunk_file = h5.File(tmp_filename, 'r+')
+            chunk_file.attrs['build'] = self.build
+            # Outputs of existing cells are unchanged and only read from file
+            # for the manifest if the chunk file is not listed
+            obs_stats = OrderedDict()
+            if prev_entry is not None:
+                obs_stats.update(manifest.get_entry_obs_stats(prev_entry))
+
+            with timer.stage('map', nb_site, chunk=chunk + 1):
+                profiles = CpgProfileStore(OrderedDict(
+                    [(name, outputs['cpg'][name]) for name in names]))
+                cpg_mat = map_cpg_tables(profiles, chromo, chunk_pos)
+                out_group = chunk_file.require_group('outputs')
+                for name, value in zip(names, cpg_mat.T):
+                    write_output(out_group, 'cpg/%s' % name, value, np.int8,
+                                 obs_stats)
+
+            if stats_meta is not None:
+                log.info('Computing per CpG statistics ...')
+                with timer.stage('stats', nb_site, chunk=chunk + 1):
+                    cpg_mat = np.hstack(
+                        [cpg_mat] +
+                        [out_group['cpg/%s' % cell][()].reshape(-1, 1)
+                         for cell in cells])
+                    if 'stats' in out_group:
+                        del out_group['stats']
+                    self.write_cpg_stats(out_group, cpg_mat, stats_meta,
+                                         obs_stats)
+
+            if win_stats_meta is not None:
+                log.info('Computing window-based statistics ...')
+                with timer.stage('win_stats', nb_site, chunk=chunk + 1):
+                    if 'win_stats' in out_group:
+                        del out_group['win_stats']
+                    self.write_win_stats(out_group, chromo, chunk_pos,
+                                         win_stats_meta, win_stats_wlen,
+                                         obs_stats)
+
+            if cpg_wlen:
+                log.info('Extracting CpG neighbors ...')
+                with timer.stage('knn', nb_site, chunk=chunk + 1):
+                    in_group = chunk_file.require_group('inputs')
+                    self.write_cpg_neighbors(in_group, chromo, chunk_pos,
+                                             names, cpg_wlen)
+
+            with timer.stage('manifest', nb_site, chunk=chunk + 1):
+                entries[filename] = manifest.describe(chunk_file, obs_stats)
+
+            with timer.stage('write', 0, chunk=chunk + 1) as record:
+                chunk_file.close()
+                record['nb_byte'] = os.path.getsize(tmp_filename) - copy_size
+            os.replace(tmp_filename, filename)
+
+        return (entries, timer.records)
+
+    def write_cpg_neighbors(self, in_group, chromo, pos, names=None,
+                            cpg_wlen=None):
+        """Extracts CpG neighbors of `pos` and writes them to `in_group`.
+
+        Neighbors are extracted for profiles `names` or all profiles if
+        `None`, and `cpg_wlen` is `--cpg_wlen` if `None`.
+        """
+        outputs = self.outputs
+        cpg_wlen = cpg_wlen or self.opts.cpg_wlen
+        cpg_ext = fext.KnnCpgFeatureExtractor(cpg_wlen // 2)
+        context_group = in_group.require_group('cpg')
+        # outputs['cpg'], since neighboring CpG sites might lie
+        # outside chunk borders and un-mapped values are needed
+        if names is None:
+            names = outputs['cpg'].names()
+        knn_batch = self.knn_batch or len(names)
+        for batch_start in range(0, len(names), knn_batch):
+            batch_names = names[batch_start:(batch_start + knn_batch)]
+            profiles = [outputs['cpg'].get(name, chromo, pos[0], pos[-1],
+                                           margin=cpg_ext.k)
+                        for name in batch_names]
+            # sites x outputs x cpg_wlen
+            states, dists = cpg_ext.extract_cells(pos, profiles, compact=True)
+            assert len(states) == len(pos)
+            assert np.all((states == 0) | (states == 1) |
+                          (states == dat.CPG_NAN))
+            assert np.all((dists > 0) | (dists == dat.CPG_NAN))
+            for i, name in enumerate(batch_names):
+                group = context_group.create_group(name)
+                group.create_dataset('state', data=states[:, i],
+                                     compression='gzip')
+                group.create_dataset('dist',
+                                     data=dists[:, i].astype(np.float32),
+                                     compression='gzip')
+
+    def process_chromos_parallel(self, tasks, worker=_process_chromo):
+        """Processes chromosomes in `nb_worker` worker processes.
+
+        `tasks` are tuples with arguments of `process_chromo`, or of
+        `append_chromo` if `worker` is `_append_chromo`.
+
+        Workers are forked and share read-only data with the main process.
+        Log messages of workers are sent to the main process via a queue.
+
+        Returns
+        -------
+        Tuple (entries, records) with manifest entries and `StageTimer`
+        records of all chromosomes
+        """
+        if not tasks:
+            return (OrderedDict(), [])
+        global _worker_app
+        _worker_app = self
+        ctx = mp.get_context('fork')
+        log_queue = ctx.Queue()
+        listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers)
+        listener.start()
+        pool = ctx.Pool(min(self.opts.nb_worker, len(tasks)),
+                        initializer=_init_worker, initargs=(log_queue,))
+        entries = OrderedDict()
+        records = []
+        try:
+            for chromo, (chromo_entries, chromo_records) in \
+                    pool.imap_unordered(worker, tasks):
+                self.log.debug('Chromosome %s done' % chromo)
+                self.update_manifest(chromo_entries)
+                entries.update(chromo_entries)
+                records.extend(chromo_records)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            listener.stop()
+            _worker_app = None
+        return (entries, records)
+
     def main(self, name, opts):
-        logging.basicConfig(filename=opts.log_file,
-                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log_format = '%(levelname)s (%(asctime)s): %(message)s'
+        if opts.nb_worker > 1:
+            log_format = '%(levelname)s (%(asctime)s) %(processName)s: ' \
+                '%(message)s'
+        logging.basicConfig(filename=opts.log_file, format=log_format)
         log = logging.getLogger(name)
         if opts.verbose:
             log.setLevel(logging.DEBUG)
@@ -300,6 +1223,17 @@ class App(object):
         if not (opts.cpg_profiles or opts.bulk_profiles):
             if not (opts.pos_file or opts.dna_db):
                 raise ValueError('Position table and DNA database expected!')
+        if opts.all_cpgs and not opts.dna_db:
+            raise ValueError('--all_cpgs requires --dna_db!')
+        if opts.all_cpgs and opts.pos_file:
+            raise ValueError('--all_cpgs and --pos_file cannot be combined!')
+        if opts.all_cpgs and opts.cpg_cov is not None:
+            raise ValueError('--all_cpgs and --cpg_cov cannot be combined!')
+        if opts.cpg_cov is None:
+            # Unobserved CpG sites are imputed with --all_cpgs
+            opts.cpg_cov = 0 if opts.all_cpgs else 1
+        if opts.append and not opts.cpg_profiles:
+            raise ValueError('--append requires --cpg_profiles!')
 
         if opts.dna_wlen and opts.dna_wlen % 2 == 0:
             raise '--dna_wlen must be odd!'
@@ -315,240 +1249,179 @@ class App(object):
             win_stats_meta = get_stats_meta(opts.win_stats)
 
         make_dir(opts.out_dir)
+        build = get_build(opts)
+        prev_entries = OrderedDict()
+        prev_manifest = manifest.read_manifest(opts.out_dir)
+        if opts.resume and prev_manifest is not None:
+            if prev_manifest.get('build') == build:
+                for filename in prev_manifest['files'].keys():
+                    filename = os.path.join(opts.out_dir, filename)
+                    prev_entries[filename] = manifest.get_entry(filename)
+            else:
+                log.warning('Input files or options changed since previous '
+                            'run!')
+        elif opts.append and prev_manifest is not None:
+            # Entries of chunk files are replaced after adding cells
+            for filename in prev_manifest['files'].keys():
+                filename = os.path.join(opts.out_dir, filename)
+                prev_entries[filename] = manifest.get_entry(filename)
+        elif not opts.resume:
+            # Manifest of previous runs is invalid if files are overwritten
+            manifest.remove_manifest(opts.out_dir)
         outputs = OrderedDict()
+        timer = StageTimer(chromo=None)
+
+        profile_cache = None
+        if opts.cache_dir:
+            cache_size = None
+            if opts.cache_size:
+                cache_size = int(opts.cache_size * 1024**3)
+            profile_cache = CpgProfileCache(opts.cache_dir, cache_size)
 
         # Read single-cell profiles if provided
         if opts.cpg_profiles:
             log.info('Reading single-cell profiles ...')
-            outputs['cpg'] = read_cpg_profiles(opts.cpg_profiles,
-                                               chromos=opts.chromos,
-                                               nrows=opts.nb_sample)
+            with timer.stage('read_profiles') as record:
+                outputs['cpg'] = read_cpg_profiles(
+                    opts.cpg_profiles,
+                    nb_worker=opts.nb_worker,
+                    tmp_dir=opts.out_dir,
+                    cache=profile_cache,
+                    mmap=bool(opts.memory_budget),
+                    chromos=opts.chromos,
+                    nrows=opts.nb_sample)
+                record['nb_site'] = sum([len(profile) for _, profile
+                                         in outputs['cpg'].items()])
 
         if opts.bulk_profiles:
             log.info('Reading bulk profiles ...')
-            outputs['bulk'] = read_cpg_profiles(opts.bulk_profiles,
-                                                chromos=opts.chromos,
-                                                nrows=opts.nb_sample,
-                                                round=False)
+            with timer.stage('read_profiles') as record:
+                outputs['bulk'] = read_cpg_profiles(
+                    opts.bulk_profiles,
+                    nb_worker=opts.nb_worker,
+                    tmp_dir=opts.out_dir,
+                    cache=profile_cache,
+                    mmap=bool(opts.memory_budget),
+                    chromos=opts.chromos,
+                    nrows=opts.nb_sample,
+                    round=False)
+                record['nb_site'] = sum([len(profile) for _, profile
+                                         in outputs['bulk'].items()])
+
+        # Read annotations once for all chromosomes
+        annos = OrderedDict()
+        if opts.anno_files:
+            log.info('Reading annotations ...')
+            with timer.stage('read_annos'):
+                for anno_file in opts.anno_files:
+                    annos[split_ext(anno_file)] = \
+                        an.read_anno_index(anno_file)
 
         # Create table with unique positions
-        if opts.pos_file:
-            # Read positions from file
-            log.info('Reading position table ...')
-            pos_table = pd.read_table(opts.pos_file, usecols=[0, 1],
-                                      dtype={0: str, 1: np.int32},
-                                      header=None, comment='#')
-            pos_table.columns = ['chromo', 'pos']
-            pos_table['chromo'] = dat.format_chromo(pos_table['chromo'])
-            pos_table = prepro_pos_table(pos_table)
-        else:
-            # Extract positions from profiles
-            pos_tables = []
-            for cpg_table in list(outputs['cpg'].values()):
-                pos_tables.append(cpg_table[['chromo', 'pos']])
-            pos_table = prepro_pos_table(pos_tables)
-        log.info('%d samples' % len(pos_table))
+        with timer.stage('pos_table') as record:
+            if opts.append:
+                # Positions of existing chunk files are kept
+                log.info('Listing chunk files ...')
+                pos_table = get_chunk_files(opts.out_dir)
+                if not len(pos_table):
+                    raise ValueError('No chunk files found in "%s"!' %
+                                     opts.out_dir)
+            elif opts.all_cpgs:
+                # Find CpG sites in DNA sequences
+                log.info('Finding CpG sites in DNA database ...')
+                pos_table = OrderedDict()
+                for chromo, pos in genome.iter_cpgs(opts.dna_db,
+                                                    opts.chromos):
+                    pos_table[chromo] = (pos, None)
+            elif opts.pos_file:
+                # Read positions from file
+                log.info('Reading position table ...')
+                pos_table = read_pos_table(opts.pos_file)
+            else:
+                # Extract positions from profiles
+                max_sites = None
+                if opts.memory_budget:
+                    # About 32 bytes per position are needed for merging
+                    max_sites = int(opts.memory_budget * 1024**3 / 32)
+                pos_table = merge_pos_tables(outputs['cpg'], max_sites)
+            if not opts.append:
+                record['nb_site'] = sum([len(pos) for pos, _
+                                         in pos_table.values()])
+                log.info('%d samples' % record['nb_site'])
+                if opts.memory_budget:
+                    nb_byte = sum([pos.nbytes + getattr(cov, 'nbytes', 0)
+                                   for pos, cov in pos_table.values()])
+                    log.info('Position table takes %.1f MB' %
+                             (nb_byte / 1024**2))
 
         if opts.chromos:
-            pos_table = pos_table.loc[pos_table.chromo.isin(opts.chromos)]
-        if opts.nb_sample:
-            pos_table = pos_table.iloc[:opts.nb_sample]
+            pos_table = OrderedDict([(chromo, value) for chromo, value
+                                     in pos_table.items()
+                                     if chromo in opts.chromos])
+        if opts.nb_sample and not opts.append:
+            pos_table = head_pos_table(pos_table, opts.nb_sample)
 
         make_dir(opts.out_dir)
 
         # Iterate over chromosomes
         # ------------------------
-        for chromo in pos_table.chromo.unique():
-            log.info('-' * 80)
-            log.info('Chromosome %s ...' % (chromo))
-            idx = pos_table.chromo == chromo
-            chromo_pos = pos_table.loc[idx].pos.values
-            chromo_outputs = OrderedDict()
-
-            if 'cpg' in outputs:
-                # Concatenate CpG tables into single nb_site x nb_output matrix
-                chromo_outputs['cpg'] = map_cpg_tables(outputs['cpg'],
-                                                       chromo, chromo_pos)
-                chromo_outputs['cpg_mat'] = np.vstack(
-                    list(chromo_outputs['cpg'].values())).T
-                assert len(chromo_outputs['cpg_mat']) == len(chromo_pos)
-
-            if 'bulk' in outputs:
-                # Concatenate CpG tables into single nb_site x nb_output matrix
-                chromo_outputs['bulk'] = map_cpg_tables(outputs['bulk'],
-                                                        chromo, chromo_pos)
-
-            if 'cpg_mat' in chromo_outputs and opts.cpg_cov:
-                cov = np.sum(chromo_outputs['cpg_mat'] != dat.CPG_NAN, axis=1)
-                assert np.all(cov >= 1)
-                idx = cov >= opts.cpg_cov
-                tmp = '%s sites matched minimum coverage filter'
-                tmp %= format_out_of(idx.sum(), len(idx))
-                log.info(tmp)
-                if idx.sum() == 0:
-                    continue
-
-                chromo_pos = chromo_pos[idx]
-                chromo_outputs = select_dict(chromo_outputs, idx)
-
-            # Read DNA of chromosome
-            chromo_dna = None
-            if opts.dna_db:
-                chromo_dna = fasta.read_chromo(opts.dna_db, chromo)
-
-            annos = None
-            if opts.anno_files:
-                log.info('Annotating CpG sites ...')
-                annos = dict()
-                for anno_file in opts.anno_files:
-                    name = split_ext(anno_file)
-                    annos[name] = annotate(anno_file, chromo, chromo_pos)
-
-            # Iterate over chunks
-            # -------------------
-            nb_chunk = int(np.ceil(len(chromo_pos) / opts.chunk_size))
-            for chunk in range(nb_chunk):
-                log.info('Chunk \t%d / %d' % (chunk + 1, nb_chunk))
-                chunk_start = chunk * opts.chunk_size
-                chunk_end = min(len(chromo_pos), chunk_start + opts.chunk_size)
-                chunk_idx = slice(chunk_start, chunk_end)
-                chunk_pos = chromo_pos[chunk_idx]
-
-                chunk_outputs = select_dict(chromo_outputs, chunk_idx)
-
-                filename = 'c%s_%06d-%06d.h5' % (chromo, chunk_start, chunk_end)
-                filename = os.path.join(opts.out_dir, filename)
-                chunk_file = h5.File(filename, 'w')
-
-                # Write positions
-                chunk_file.create_dataset('chromo', shape=(len(chunk_pos),),
-                                          dtype='S2')
-                chunk_file['chromo'][:] = chromo.encode()
-                chunk_file.create_dataset('pos', data=chunk_pos, dtype=np.int32)
-
-                if len(chunk_outputs):
-                    out_group = chunk_file.create_group('outputs')
-
-                # Write cpg profiles
-                if 'cpg' in chunk_outputs:
-                    for name, value in chunk_outputs['cpg'].items():
-                        assert len(value) == len(chunk_pos)
-                        out_group.create_dataset('cpg/%s' % name,
-                                                 data=value,
-                                                 dtype=np.int8,
-                                                 compression='gzip')
-                    # Compute and write statistics
-                    if cpg_stats_meta is not None:
-                        log.info('Computing per CpG statistics ...')
-                        cpg_mat = np.ma.masked_values(chunk_outputs['cpg_mat'],
-                                                      dat.CPG_NAN)
-                        mask = np.sum(~cpg_mat.mask, axis=1)
-                        mask = mask < opts.stats_cov
-                        for name, fun in cpg_stats_meta.items():
-                            stat = fun[0](cpg_mat).data.astype(fun[1])
-                            stat[mask] = dat.CPG_NAN
-                            assert len(stat) == len(chunk_pos)
-                            out_group.create_dataset('stats/%s' % name,
-                                                     data=stat,
-                                                     dtype=fun[1],
-                                                     compression='gzip')
-
-                # Write bulk profiles
-                if 'bulk' in chunk_outputs:
-                    for name, value in chunk_outputs['bulk'].items():
-                        assert len(value) == len(chunk_pos)
-                        out_group.create_dataset('bulk/%s' % name,
-                                                 data=value,
-                                                 dtype=np.float32,
-                                                 compression='gzip')
-
-                # Write input features
-                in_group = chunk_file.create_group('inputs')
-
-                # DNA windows
-                if chromo_dna:
-                    log.info('Extracting DNA sequence windows ...')
-                    dna_wins = extract_seq_windows(chromo_dna, pos=chunk_pos,
-                                                   wlen=opts.dna_wlen)
-                    assert len(dna_wins) == len(chunk_pos)
-                    in_group.create_dataset('dna', data=dna_wins, dtype=np.int8,
-                                            compression='gzip')
-
-                # CpG neighbors
-                if opts.cpg_wlen:
-                    log.info('Extracting CpG neighbors ...')
-                    cpg_ext = fext.KnnCpgFeatureExtractor(opts.cpg_wlen // 2)
-                    context_group = in_group.create_group('cpg')
-                    # outputs['cpg'], since neighboring CpG sites might lie
-                    # outside chunk borders and un-mapped values are needed
-                    for name, cpg_table in outputs['cpg'].items():
-                        cpg_table = cpg_table.loc[cpg_table.chromo == chromo]
-                        state, dist = cpg_ext.extract(chunk_pos,
-                                                      cpg_table.pos.values,
-                                                      cpg_table.value.values)
-                        nan = np.isnan(state)
-                        state[nan] = dat.CPG_NAN
-                        dist[nan] = dat.CPG_NAN
-                        state = state.astype(np.int8, copy=False)
-                        dist = dist.astype(np.float32, copy=False)
-
-                        assert len(state) == len(chunk_pos)
-                        assert np.all((state == 0) | (state == 1) |
-                                      (state == dat.CPG_NAN))
-                        assert len(dist) == len(chunk_pos)
-                        assert np.all((dist > 0) | (dist == dat.CPG_NAN))
-
-                        group = context_group.create_group(name)
-                        group.create_dataset('state', data=state,
-                                             compression='gzip')
-                        group.create_dataset('dist', data=dist,
-                                             compression='gzip')
-
-                if win_stats_meta is not None and opts.cpg_wlen:
-                    log.info('Computing window-based statistics ...')
-                    states = []
-                    dists = []
-                    cpg_states = []
-                    cpg_group = out_group['cpg']
-                    context_group = in_group['cpg']
-                    for output_name in cpg_group.keys():
-                        state = context_group[output_name]['state'].value
-                        states.append(np.expand_dims(state, 2))
-                        dist = context_group[output_name]['dist'].value
-                        dists.append(np.expand_dims(dist, 2))
-                        cpg_states.append(cpg_group[output_name].value)
-                    # samples x outputs x cpg_wlen
-                    states = np.swapaxes(np.concatenate(states, axis=2), 1, 2)
-                    dists = np.swapaxes(np.concatenate(dists, axis=2), 1, 2)
-                    cpg_states = np.expand_dims(np.vstack(cpg_states).T, 2)
-                    cpg_dists = np.zeros_like(cpg_states)
-                    states = np.concatenate([states, cpg_states], axis=2)
-                    dists = np.concatenate([dists, cpg_dists], axis=2)
-
-                    for wlen in opts.win_stats_wlen:
-                        idx = (states == dat.CPG_NAN) | (dists > wlen // 2)
-                        states_wlen = np.ma.masked_array(states, idx)
-                        group = out_group.create_group('win_stats/%d' % wlen)
-                        for name, fun in win_stats_meta.items():
-                            stat = fun[0](states_wlen)
-                            if hasattr(stat, 'mask'):
-                                idx = stat.mask
-                                stat = stat.data
-                                if np.sum(idx):
-                                    stat[idx] = dat.CPG_NAN
-                            group.create_dataset(name, data=stat, dtype=fun[1],
-                                                 compression='gzip')
-
-                if annos:
-                    log.info('Adding annotations ...')
-                    group = in_group.create_group('annos')
-                    for name, anno in annos.items():
-                        group.create_dataset(name, data=anno[chunk_idx],
-                                             dtype='int8',
-                                             compression='gzip')
-
-                chunk_file.close()
-
+        self.opts = opts
+        self.log = log
+        self.outputs = outputs
+        self.annos = annos
+        self.tile_size = None
+        self.knn_batch = None
+        if opts.memory_budget:
+            self.tile_size, self.knn_batch = self.get_tiling()
+            log.info('Mapping outputs of %d sites and extracting CpG '
+                     'neighbors of %d cells at once' %
+                     (self.tile_size, self.knn_batch))
+        self.cpg_stats_meta = cpg_stats_meta
+        self.win_stats_meta = win_stats_meta
+        self.build = build
+        self.prev_entries = prev_entries
+        self.entries = OrderedDict(prev_entries)
+
+        if opts.append:
+            # Entries of chunk files are listed again after cells were added,
+            # such that killed runs do not leave entries of replaced files
+            for filenames in pos_table.values():
+                for filename in filenames:
+                    self.entries.pop(filename, None)
+            manifest.write_manifest(opts.out_dir, self.entries)
+            tasks = [(chromo, filenames)
+                     for chromo, filenames in pos_table.items()]
+            process = self.append_chromo
+            worker = _append_chromo
+        else:
+            tasks = [(chromo,) + value for chromo, value in pos_table.items()]
+            process = self.process_chromo
+            worker = _process_chromo
+        if opts.nb_worker > 1:
+            # Schedule largest chromosomes first to reduce the time that
+            # workers are idle at the end.
+            tasks = sorted(tasks, key=lambda task: -len(task[1]))
+            log.info('Processing %d chromosomes using %d workers ...' %
+                     (len(tasks), opts.nb_worker))
+            entries, records = self.process_chromos_parallel(tasks, worker)
+        else:
+            entries = OrderedDict()
+            records = []
+            for task in tasks:
+                chromo_entries, chromo_records = process(*task)
+                self.update_manifest(chromo_entries)
+                entries.update(chromo_entries)
+                records.extend(chromo_records)
+
+        if opts.append:
+            # Chunk files of chromosomes that were not selected are kept
+            manifest.write_manifest(opts.out_dir, self.entries)
+        else:
+            # Manifest only lists chunk files of this run
+            manifest.write_manifest(opts.out_dir, entries, self.build)
+        records = timer.records + records
+        write_timing(records, os.path.join(opts.out_dir, 'dcpg_data.timing'))
+        log.info('Stages:\n%s' % format_table(summarize_stages(records)))
         log.info('Done!')
         return 0
 
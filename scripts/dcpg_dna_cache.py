@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Converts DNA database to memory-mapped genome cache.
+
+Encodes each chromosome FASTA file of a DNA database once and stores it as
+int8 numpy file. The output directory can be passed as `--dna_db` to
+`dcpg_data.py`, which then memory-maps sequences instead of parsing FASTA
+files in each run.
+
+Examples:
+    dcpg_dna_cache.py ./mm10 -o ./mm10_cache
+"""
+
+import os
+import sys
+
+import argparse
+import logging
+
+from deepcpg.data import genome
+
+
+class App(object):
+
+    def run(self, args):
+        name = os.path.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Converts DNA database to genome cache')
+        p.add_argument(
+            'dna_db',
+            help='DNA database with one FASTA file per chromosome')
+        p.add_argument(
+            '-o', '--out_dir',
+            help='Output directory',
+            required=True)
+        p.add_argument(
+            '--chromos',
+            nargs='+',
+            help='Chromosomes that are converted')
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+        log.debug(opts)
+
+        index = genome.convert_dna_db(opts.dna_db, opts.out_dir,
+                                      chromos=opts.chromos,
+                                      log=log.info)
+        log.info('%d chromosomes with %d nucleotides' %
+                 (len(index), sum(index.values())))
+        log.info('Done!')
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
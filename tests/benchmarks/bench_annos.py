@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""Benchmarks interval queries of `deepcpg.data.annotations`.
+
+Compares vectorized `in_which` and `distance` with the previous loop-based
+implementations, which are included below as reference.
+
+Examples:
+    python bench_annos.py --nb_pos 10000000 --nb_interval 100000
+"""
+
+import sys
+from time import time
+
+import argparse
+import numpy as np
+
+from deepcpg.data import annotations as an
+
+
+def in_which_loop(x, ys, ye):
+    n = len(ys)
+    m = len(x)
+    rv = np.empty(m, dtype=np.int64)
+    rv.fill(-1)
+    i = 0
+    j = 0
+    while i < n and j < m:
+        while j < m and x[j] <= ye[i]:
+            if x[j] >= ys[i]:
+                rv[j] = i
+            j += 1
+        i += 1
+    return rv
+
+
+def distance_loop(pos, start, end):
+    m = len(start)
+    n = len(pos)
+    i = 0
+    j = 0
+    end_prev = -10**7
+    dist = np.zeros(n)
+    while i < m and j < n:
+        while j < n and pos[j] <= end[i]:
+            if pos[j] < start[i]:
+                dist[j] = min(pos[j] - end_prev, start[i] - pos[j])
+            j += 1
+        end_prev = end[i]
+        i += 1
+    dist[j:] = pos[j:] - end_prev
+    return dist
+
+
+def sample(nb_pos, nb_interval, chromo_len, seed=0):
+    rng = np.random.RandomState(seed)
+    pos = np.sort(rng.randint(0, chromo_len, nb_pos)).astype(np.int32)
+    bounds = np.sort(rng.choice(chromo_len, 2 * nb_interval, replace=False))
+    start = bounds[0::2].astype(np.int32)
+    end = bounds[1::2].astype(np.int32)
+    return (pos, start, end)
+
+
+def bench(fun, *args):
+    t = time()
+    rv = fun(*args)
+    return (rv, time() - t)
+
+
+def main(args):
+    p = argparse.ArgumentParser(
+        description='Benchmarks interval queries')
+    p.add_argument('--nb_pos', type=int, default=10**7)
+    p.add_argument('--nb_interval', type=int, default=10**5)
+    p.add_argument('--chromo_len', type=int, default=2 * 10**8)
+    p.add_argument('--no_loop', action='store_true',
+                   help='Only benchmark vectorized functions')
+    opts = p.parse_args(args)
+
+    pos, start, end = sample(opts.nb_pos, opts.nb_interval, opts.chromo_len)
+    print('%d positions, %d intervals' % (len(pos), len(start)))
+    funs = [('in_which', an.in_which, in_which_loop),
+            ('distance', an.distance, distance_loop)]
+    for name, fun, fun_loop in funs:
+        rv, t = bench(fun, pos, start, end)
+        print('%-10s vectorized: %8.2fs' % (name, t))
+        if opts.no_loop:
+            continue
+        rv_loop, t_loop = bench(fun_loop, pos, start, end)
+        assert np.array_equal(rv, rv_loop)
+        print('%-10s loop:       %8.2fs (%.0fx)' % (name, t_loop,
+                                                    t_loop / t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,11 @@
+import os
+
 import numpy as np
 import numpy.testing as npt
 import pandas as pd
 
 from deepcpg.data import annotations as annos
+from deepcpg.data import format_chromo
 
 
 def test_join_overlapping():
@@ -16,7 +19,7 @@ def test_join_overlapping():
     e = [2, 4, 10]
     expect = (s, e)
     result = f(s, e)
-    assert result == expect
+    npt.assert_array_equal(result, expect)
 
     x = np.array([[1, 2],
                   [3, 4], [4, 5],
@@ -104,3 +107,85 @@ def test_group_overlapping():
     g = [0, 1, 1,  2,  2,  2,  3]
     a = annos.group_overlapping(s, e)
     npt.assert_array_equal(a, g)
+
+
+class TestAnnotationIndex(object):
+
+    def _index(self):
+        d = pd.DataFrame({
+            'chromo': ['1', '1', '2', '1', '1'],
+            'start':  [10, 3, 5, 17, 4],
+            'end':    [15, 6, 8, 18, 5]
+        })
+        return annos.AnnotationIndex.from_frame(d)
+
+    def test_from_frame(self):
+        index = self._index()
+        assert index.chromos == ['1', '2']
+        start, end = index.get('1')
+        npt.assert_array_equal(start, [3, 10, 17])
+        npt.assert_array_equal(end, [6, 15, 18])
+        start, end = index.get('X')
+        assert len(start) == 0
+        assert len(end) == 0
+
+    def test_is_in(self):
+        index = self._index()
+        pos = np.array([-1, 2, 3, 6, 7, 10, 15, 16, 18, 19])
+        npt.assert_array_equal(index.is_in('1', pos),
+                               annos.is_in(pos, *index.get('1')))
+        npt.assert_array_equal(index.is_in('2', pos),
+                               annos.is_in(pos, *index.get('2')))
+        npt.assert_array_equal(index.is_in('X', pos), False)
+
+    def test_distance(self):
+        index = self._index()
+        pos = np.array([1, 2, 5, 8, 10, 15, 16, 19])
+        npt.assert_array_equal(index.distance('1', pos),
+                               [2, 1, 0, 2, 0, 0, 1, 1])
+        npt.assert_array_equal(index.distance('2', pos),
+                               annos.distance(pos, *index.get('2')))
+
+    def test_from_bed(self, tmpdir):
+        filename = str(tmpdir.join('anno.bed'))
+        names = ['chr1', 'Chr2', 'chrUn_CHR3']
+        with open(filename, 'w') as f:
+            for i, name in enumerate(names):
+                f.write('%s\t%d\t%d\n' % (name, i, i + 1))
+        index = annos.AnnotationIndex.from_bed(filename)
+        # Chromosome names are formatted as names of profiles
+        assert sorted(index.chromos) == \
+            sorted(format_chromo(pd.Series(names)).tolist())
+
+    def test_read_anno_index(self, tmpdir):
+        filename = str(tmpdir.join('anno.bed'))
+        with open(filename, 'w') as f:
+            f.write('chr1\t3\t6\nchr1\t4\t8\nchr2\t1\t2\n')
+        index = annos.read_anno_index(filename)
+        assert os.path.isfile(filename + annos.INDEX_EXT)
+        npt.assert_array_equal(index.get('1')[1], [8])
+
+        index = annos.read_anno_index(filename)
+        assert index.chromos == ['1', '2']
+        npt.assert_array_equal(index.get('1')[0], [3])
+
+        # Index is rebuilt if file changed
+        with open(filename, 'w') as f:
+            f.write('chr1\t3\t6\nchr1\t10\t11\n')
+        os.utime(filename, ns=(0, 0))
+        index = annos.read_anno_index(filename)
+        assert index.chromos == ['1']
+        npt.assert_array_equal(index.get('1')[0], [3, 10])
+
+
+def test_join_overlapping_frame():
+    d = pd.DataFrame({
+        'chromo': ['2', '1', '1', '2', '1', '1'],
+        'start':  [1, 6, 1, 3, 3, 12],
+        'end':    [4, 10, 2, 5, 8, 12]
+    })
+    d = d.loc[:, ['chromo', 'start', 'end']]
+    expect = [['1', 1, 2], ['1', 3, 10], ['1', 12, 12], ['2', 1, 5]]
+    actual = annos.join_overlapping_frame(d)
+    assert list(actual.columns) == ['chromo', 'start', 'end']
+    assert actual.values.tolist() == expect
@@ -0,0 +1,70 @@
+import gzip
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from deepcpg.data import utils
+
+
+def _write(filename, lines):
+    fh = gzip.open(filename, 'wt') if filename.endswith('.gz') \
+        else open(filename, 'w')
+    fh.write('\n'.join(lines) + '\n')
+    fh.close()
+
+
+class TestReadCpgProfile(object):
+
+    lines = ['chr1\t5\t1',
+             'chr1\t2\t0',
+             '2\t10\t0.9',
+             'chr1\t8\t0',
+             'CHRX\t3\t1',
+             '2\t4\t0.2']
+
+    def _test_profile(self, profile):
+        assert list(profile.keys()) == ['1', '2', 'X']
+        npt.assert_array_equal(profile['1'][0], [2, 5, 8])
+        npt.assert_array_equal(profile['1'][1], [0, 1, 0])
+        npt.assert_array_equal(profile['2'][0], [4, 10])
+        npt.assert_array_equal(profile['2'][1], [0, 1])
+        npt.assert_array_equal(profile['X'][0], [3])
+        assert profile['1'][0].dtype == np.int32
+        assert profile['1'][1].dtype == np.int8
+
+    def test_dcpg(self, tmpdir):
+        filename = str(tmpdir.join('cell.tsv.gz'))
+        _write(filename, self.lines)
+        for chunk_size in [1, 2, 100]:
+            profile = utils.read_cpg_profile(filename, chunk_size=chunk_size)
+            self._test_profile(profile)
+
+    def test_bedgraph(self, tmpdir):
+        filename = str(tmpdir.join('cell.bedGraph'))
+        lines = ['track type=bedGraph']
+        for line in self.lines:
+            line = line.split('\t')
+            lines.append('\t'.join([line[0], line[1], line[1], line[2]]))
+        _write(filename, lines)
+        self._test_profile(utils.read_cpg_profile(filename, chunk_size=2))
+
+        profile = utils.read_cpg_profile(filename, round=False)
+        assert profile['2'][1].dtype == np.float32
+        npt.assert_array_almost_equal(profile['2'][1], [0.2, 0.9])
+
+    def test_chromos(self, tmpdir):
+        filename = str(tmpdir.join('cell.tsv'))
+        _write(filename, self.lines)
+        profile = utils.read_cpg_profile(filename, chromos=['1', 'X'],
+                                         chunk_size=3)
+        assert list(profile.keys()) == ['1', 'X']
+        profile = utils.read_cpg_profile(filename, nrows=2)
+        assert list(profile.keys()) == ['1']
+        npt.assert_array_equal(profile['1'][0], [2, 5])
+
+    def test_invalid(self, tmpdir):
+        filename = str(tmpdir.join('cell.tsv'))
+        _write(filename, ['1\t1\t2'])
+        with pytest.raises(ValueError):
+            utils.read_cpg_profile(filename)
@@ -0,0 +1,44 @@
+import numpy as np
+import numpy.testing as npt
+
+from deepcpg.data import dna
+
+
+def test_char_to_int():
+    seq = 'ACGTNacgtn'
+    expect = [0, 3, 2, 1, 4, 0, 3, 2, 1, 4]
+    result = dna.char_to_int(seq)
+    assert result.dtype == np.int8
+    npt.assert_array_equal(result, expect)
+    npt.assert_array_equal(dna.char_to_int(seq.encode()), expect)
+
+    # Unknown characters are treated as 'N'
+    npt.assert_array_equal(dna.char_to_int('AYR-'), [0, 4, 4, 4])
+    assert len(dna.char_to_int('')) == 0
+
+
+def test_int_to_char():
+    seq = [0, 3, 2, 1, 4]
+    assert dna.int_to_char(seq) == 'ACGTN'
+    assert dna.int_to_char(seq, join=False) == ['A', 'C', 'G', 'T', 'N']
+    assert dna.int_to_char(dna.char_to_int('GATTACA')) == 'GATTACA'
+
+
+def test_int_to_onehot():
+    seqs = np.array([[0, 1, 2, 3, 4]])
+    expect = np.array([[[1, 0, 0, 0],
+                        [0, 1, 0, 0],
+                        [0, 0, 1, 0],
+                        [0, 0, 0, 1],
+                        [0, 0, 0, 0]]])
+    result = dna.int_to_onehot(seqs)
+    assert result.dtype == np.int8
+    npt.assert_array_equal(result, expect)
+
+    result = dna.int_to_onehot(seqs.astype(np.int8), dtype=np.float32)
+    assert result.dtype == np.float32
+    npt.assert_array_equal(result, expect)
+
+    result = dna.int_to_onehot([0, 3])
+    assert result.shape == (1, 2, 4)
+    npt.assert_array_equal(dna.onehot_to_int(result), [[0, 3]])
@@ -0,0 +1,126 @@
+import gzip
+import os
+
+import pytest
+
+from deepcpg.data import fasta
+
+
+SEQS = [('chr1', 'ACGTACGTACGTAC'),
+        ('chr2', 'GGGCCCAATT'),
+        ('chr3', 'A')]
+
+
+def _write_fasta(filename, line_len=4):
+    fh = gzip.open(filename, 'wt') if filename.endswith('.gz') \
+        else open(filename, 'w')
+    for name, seq in SEQS:
+        fh.write('>%s description\n' % name)
+        for i in range(0, len(seq), line_len):
+            fh.write(seq[i:i + line_len] + '\n')
+    fh.close()
+
+
+def _test_reader(filename):
+    reader = fasta.IndexedFastaReader(filename)
+    assert reader.names() == [name for name, seq in SEQS]
+    assert 'chr1' in reader
+    for name, seq in SEQS:
+        assert reader.get_length(name) == len(seq)
+        assert reader.fetch(name, 0, len(seq)).decode() == seq
+        for start in range(-2, len(seq) + 2):
+            for end in range(start, len(seq) + 2):
+                expect = seq[max(0, start):max(0, end)]
+                assert reader.fetch(name, start, end).decode() == expect
+    reader.close()
+
+
+def test_indexed_reader(tmpdir):
+    for ext in ['fa', 'fa.gz']:
+        filename = str(tmpdir.join('seqs.%s' % ext))
+        _write_fasta(filename)
+        _test_reader(filename)
+        # Read existing index
+        assert os.path.isfile(filename + '.fai')
+        _test_reader(filename)
+
+
+def test_index_file(tmpdir):
+    filename = str(tmpdir.join('seqs.fa'))
+    _write_fasta(filename, line_len=5)
+    index = fasta.index_file(filename)
+    rec = index['chr1']
+    assert (rec.length, rec.offset, rec.line_bases, rec.line_bytes) == \
+        (14, 18, 5, 6)
+    rec = index['chr2']
+    assert (rec.length, rec.line_bases, rec.line_bytes) == (10, 5, 6)
+
+    index_filename = str(tmpdir.join('seqs.fai'))
+    fasta.write_index(index, index_filename)
+    index2 = fasta.read_index(index_filename)
+    for name, rec in index.items():
+        assert vars(index2[name]) == vars(rec)
+
+
+def test_index_file_lines(tmpdir):
+    filename = str(tmpdir.join('seqs.fa'))
+    # Blank line inside sequence and last line longer than other lines
+    for lines in [['ACGT', '', 'ACGT'], ['ACGT', 'ACGTA']]:
+        with open(filename, 'w') as f:
+            f.write('>chr1\n%s\n' % '\n'.join(lines))
+        with pytest.raises(ValueError):
+            fasta.index_file(filename)
+    # Blank lines at the end of sequences
+    with open(filename, 'w') as f:
+        f.write('>chr1\nACGT\nAC\n\n>chr2\nGG\n\n')
+    index = fasta.index_file(filename)
+    assert index['chr1'].length == 6
+    assert index['chr2'].length == 2
+
+
+def test_indexed_reader_replaced(tmpdir):
+    filename = str(tmpdir.join('seqs.fa'))
+    _write_fasta(filename)
+    fasta.IndexedFastaReader(filename).close()
+    with open(filename, 'w') as f:
+        f.write('>chr4\nCCGG\n')
+    stat = os.stat(filename + '.fai')
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with fasta.IndexedFastaReader(filename) as reader:
+        assert reader.names() == ['chr4']
+        assert reader.fetch('chr4', 0, 4) == b'CCGG'
+
+
+class _SeekLog(object):
+    """File handle that counts seeks before the current offset."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.nb_seek = 0
+        self.nb_backward = 0
+
+    def seek(self, offset):
+        self.nb_seek += 1
+        self.nb_backward += offset < self.fh.tell()
+        return self.fh.seek(offset)
+
+    def read(self, size):
+        return self.fh.read(size)
+
+    def close(self):
+        self.fh.close()
+
+
+def test_indexed_reader_forward(tmpdir):
+    filename = str(tmpdir.join('seqs.fa.gz'))
+    _write_fasta(filename)
+    reader = fasta.IndexedFastaReader(filename)
+    reader.fh = _SeekLog(reader.fh)
+    # Overlapping windows at ascending positions
+    for name, seq in SEQS:
+        for start in range(-2, len(seq), 2):
+            expect = seq[max(0, start):max(0, start + 5)]
+            assert reader.fetch(name, start, start + 5).decode() == expect
+    assert reader.fh.nb_seek <= len(SEQS)
+    assert reader.fh.nb_backward == 0
+    reader.close()
@@ -1,5 +1,6 @@
 import numpy as np
 import numpy.testing as npt
+import pytest
 
 from deepcpg.data import feature_extractor as fe
 from deepcpg.data import dna
@@ -84,6 +85,44 @@ class TestKnnCpgFeatureExtractor(object):
         result = fe.KnnCpgFeatureExtractor(3).extract(x, y, ys)
         self._compare(result, expect)
 
+    def test_extract_compact(self):
+        y = np.array([1, 3, 5, 8, 15])
+        ys = np.array([0, 0, 1, 1, 0])
+        x = np.array([0, 3, 11, 20])
+        ext = fe.KnnCpgFeatureExtractor(2)
+        expect = ext.extract(x, y, ys)
+        state, dist = ext.extract(x, y, ys, compact=True)
+        assert state.dtype == np.int8
+        assert dist.dtype == np.int32
+        nan = np.isnan(expect[0])
+        npt.assert_array_equal(state == -1, nan)
+        npt.assert_array_equal(dist == -1, nan)
+        npt.assert_array_equal(state[~nan], expect[0][~nan])
+        npt.assert_array_equal(dist[~nan], expect[1][~nan])
+
+    def test_extract_cells(self):
+        x = np.array([0, 3, 6, 11, 20])
+        profiles = [(np.array([1, 3, 5, 8, 15]), np.array([0, 0, 1, 1, 0])),
+                    (np.array([], dtype=int), np.array([], dtype=int)),
+                    (np.array([6, 7]), np.array([1, 0]))]
+        ext = fe.KnnCpgFeatureExtractor(2)
+        for compact in [False, True]:
+            state, dist = ext.extract_cells(x, profiles, compact=compact)
+            assert state.shape == (len(x), len(profiles), 4)
+            assert dist.shape == (len(x), len(profiles), 4)
+            for i, (y, ys) in enumerate(profiles):
+                expect = ext.extract(x, y, ys, compact=compact)
+                npt.assert_array_equal(state[:, i], expect[0])
+                npt.assert_array_equal(dist[:, i], expect[1])
+
+    def test_extract_empty(self):
+        ext = fe.KnnCpgFeatureExtractor(2)
+        state, dist = ext.extract(np.array([1, 2]), np.array([]),
+                                  np.array([]))
+        assert state.shape == (2, 4)
+        assert np.all(np.isnan(state))
+        assert np.all(np.isnan(dist))
+
 
 class TestIntervalFeatureExtractor(object):
 
@@ -98,7 +137,7 @@ class TestIntervalFeatureExtractor(object):
         e = [2, 4, 10]
         expect = (s, e)
         result = f(s, e)
-        assert result == expect
+        npt.assert_array_equal(result, expect)
 
         x = np.array([[1, 2],
                       [3, 4], [4, 5],
@@ -209,3 +248,55 @@ class TestKmersFeatureExtractor(object):
         actual = ext(seqs)
         assert actual.shape == (2, 4**4)
         npt.assert_array_equal(actual, expect)
+
+    def test_special(self):
+        ext = fe.KmersFeatureExtractor(2)
+
+        seqs = self._translate_seqs('AGNGTA')
+        expect = self._freq({'AG': 1, 'GT': 1, 'TA': 1})
+        expect = np.array([expect])
+        actual = ext(seqs)
+        npt.assert_array_equal(actual, expect)
+
+        seqs = self._translate_seqs(['A', 'C'])
+        actual = ext(seqs)
+        assert actual.shape == (2, 4**2)
+        npt.assert_array_equal(actual, 0)
+
+    def test_batch(self):
+        ext = fe.KmersFeatureExtractor(3)
+        ext._BATCH_KMERS = 10
+        seqs = np.random.randint(0, 4, (20, 12))
+        expect = fe.KmersFeatureExtractor(3)(seqs)
+        actual = ext(seqs)
+        npt.assert_array_equal(actual, expect)
+        assert np.all(actual.sum(axis=1) == 10)
+
+    def test_batch_nb_kmer(self, monkeypatch):
+        bincount = np.bincount
+        lengths = []
+
+        def bincount_log(x, minlength=0):
+            counts = bincount(x, minlength=minlength)
+            lengths.append(len(counts))
+            return counts
+
+        ext = fe.KmersFeatureExtractor(3)
+        ext._BATCH_KMERS = 128
+        seqs = np.random.randint(0, 4, (20, 12))
+        expect = fe.KmersFeatureExtractor(3)(seqs)
+        monkeypatch.setattr(fe.np, 'bincount', bincount_log)
+        actual = ext(seqs)
+        npt.assert_array_equal(actual, expect)
+        # Frequencies of at most `_BATCH_KMERS` k-mers are counted at once
+        assert max(lengths) <= 128
+
+    def test_sparse(self):
+        pytest.importorskip('scipy')
+        seqs = self._translate_seqs(['AAAAAA',
+                                     'CGCGCG',
+                                     'ATGCNA'])
+        expect = fe.KmersFeatureExtractor(4)(seqs)
+        actual = fe.KmersFeatureExtractor(4, sparse=True)(seqs)
+        assert actual.shape == (3, 4**4)
+        npt.assert_array_equal(actual.toarray(), expect)
@@ -0,0 +1,75 @@
+import gzip
+import os
+
+import numpy as np
+import numpy.testing as npt
+
+from deepcpg.data import dna, genome
+
+
+def _write_fasta(filename, head, seq, line_len=4):
+    with gzip.open(filename, 'wt') as f:
+        f.write('>%s\n' % head)
+        for i in range(0, len(seq), line_len):
+            f.write(seq[i:i + line_len] + '\n')
+
+
+def test_convert_dna_db(tmpdir):
+    dna_db = str(tmpdir.mkdir('dna_db'))
+    seqs = {'1': 'NNACGTacgtCGCG', '19': 'ACGTTTGC'}
+    for chromo, seq in seqs.items():
+        filename = 'Mus_musculus.GRCm38.dna.chromosome.%s.fa.gz' % chromo
+        _write_fasta(os.path.join(dna_db, filename), chromo, seq)
+
+    assert not genome.is_cache(dna_db)
+    npt.assert_array_equal(genome.read_chromo(dna_db, '1'),
+                           dna.char_to_int(seqs['1']))
+
+    cache_dir = str(tmpdir.join('cache'))
+    index = genome.convert_dna_db(dna_db, cache_dir)
+    assert genome.is_cache(cache_dir)
+    assert dict(index) == {'1': 14, '19': 8}
+    assert dict(genome.read_index(cache_dir)['chromos']) == dict(index)
+    for chromo, seq in seqs.items():
+        actual = genome.read_chromo(cache_dir, chromo)
+        assert isinstance(actual, np.memmap)
+        assert actual.dtype == np.int8
+        npt.assert_array_equal(actual, dna.char_to_int(seq))
+
+
+def test_find_cpgs():
+    seq = dna.char_to_int('CGNACGTacgtCGCG')
+    npt.assert_array_equal(genome.find_cpgs(seq), [1, 5, 9, 12, 14])
+    npt.assert_array_equal(genome.find_cpgs(seq, seq_index=0),
+                           [0, 4, 8, 11, 13])
+    assert len(genome.find_cpgs(dna.char_to_int('GC'))) == 0
+    assert len(genome.find_cpgs(dna.char_to_int(''))) == 0
+
+    # CpG sites at block borders
+    block = genome._SCAN_BLOCK
+    genome._SCAN_BLOCK = 4
+    try:
+        npt.assert_array_equal(genome.find_cpgs(seq), [1, 5, 9, 12, 14])
+    finally:
+        genome._SCAN_BLOCK = block
+
+
+def test_iter_cpgs(tmpdir):
+    dna_db = str(tmpdir.mkdir('dna_db'))
+    seqs = {'1': 'NNACGTacgtCGCG', '19': 'ACGTTTGC', '2': 'CG'}
+    for chromo, seq in seqs.items():
+        filename = 'Mus_musculus.GRCm38.dna.chromosome.%s.fa.gz' % chromo
+        _write_fasta(os.path.join(dna_db, filename), chromo, seq)
+    cache_dir = str(tmpdir.join('cache'))
+    genome.convert_dna_db(dna_db, cache_dir)
+
+    for db in [dna_db, cache_dir]:
+        assert genome.get_chromos(db) == ['1', '19', '2']
+        cpgs = list(genome.iter_cpgs(db))
+        assert [chromo for chromo, _ in cpgs] == ['1', '19', '2']
+        npt.assert_array_equal(cpgs[0][1], [4, 8, 11, 13])
+        npt.assert_array_equal(cpgs[1][1], [2])
+        npt.assert_array_equal(cpgs[2][1], [1])
+        cpgs = list(genome.iter_cpgs(db, chromos=[2, 'X']))
+        assert len(cpgs) == 1
+        assert cpgs[0][0] == '2'
@@ -0,0 +1,109 @@
+import os
+
+import h5py as h5
+import numpy as np
+import numpy.testing as npt
+
+from deepcpg.data import hdf
+from deepcpg.data import manifest
+from deepcpg.data import utils
+
+
+def _write_chunk(filename, chromo, pos, nb_cell=2, dna_wlen=11, cpg_wlen=4):
+    h5_file = h5.File(filename, 'w')
+    h5_file.create_dataset('chromo', shape=(len(pos),), dtype='S2')
+    h5_file['chromo'][:] = chromo.encode()
+    h5_file.create_dataset('pos', data=pos, dtype=np.int32)
+    for i in range(nb_cell):
+        value = np.array([1, 0, -1] * len(pos))[:len(pos)]
+        h5_file.create_dataset('outputs/cpg/cell%d' % i, data=value,
+                               dtype=np.int8)
+        for name in ['state', 'dist']:
+            h5_file.create_dataset('inputs/cpg/cell%d/%s' % (i, name),
+                                   shape=(len(pos), cpg_wlen))
+    h5_file.create_dataset('inputs/dna', shape=(len(pos), dna_wlen),
+                           dtype=np.int8)
+    entry = manifest.describe(h5_file)
+    h5_file.close()
+    return entry
+
+
+class TestManifest(object):
+
+    def _write_chunks(self, dirname):
+        filenames = []
+        entries = dict()
+        for i, chromo in enumerate(['1', '1', '2']):
+            filename = os.path.join(dirname, 'c%d.h5' % i)
+            pos = np.arange(2, 2 + (i + 1) * 5, 2)
+            entries[filename] = _write_chunk(filename, chromo, pos)
+            filenames.append(filename)
+        return (filenames, entries)
+
+    def test_describe(self, tmpdir):
+        filename = str(tmpdir.join('c.h5'))
+        entry = _write_chunk(filename, '1', np.array([2, 4, 6, 8]))
+        assert entry['chromo'] == '1'
+        assert entry['start'] == 2
+        assert entry['end'] == 8
+        assert entry['nb_sample'] == 4
+        assert entry['nb_obs'] == [3, 3]
+        npt.assert_almost_equal(entry['mean'], [2 / 3, 2 / 3])
+        assert entry == manifest.describe(filename)
+
+    def test_describe_obs_stats(self, tmpdir):
+        filename = str(tmpdir.join('c.h5'))
+        entry = _write_chunk(filename, '1', np.array([2, 4, 6, 8]))
+        obs_stats = manifest.get_entry_obs_stats(entry)
+        assert list(obs_stats.keys()) == ['outputs/cpg/cell0',
+                                          'outputs/cpg/cell1']
+        assert obs_stats['outputs/cpg/cell0'] == \
+            manifest.get_obs_stats(np.array([1, 0, -1, 1]))
+        assert manifest.describe(filename, obs_stats) == entry
+        # Outputs in `obs_stats` are not read from file
+        obs_stats = {'outputs/cpg/cell1': (1, 0.5)}
+        actual = manifest.describe(filename, obs_stats)
+        assert actual['nb_obs'] == [3, 1]
+        assert actual['mean'] == [entry['mean'][0], 0.5]
+
+    def test_get_obs_stats(self):
+        assert manifest.get_obs_stats(np.array([1, -1, 0, 1])) == (3, 2 / 3)
+        assert manifest.get_obs_stats(np.array([-1, -1])) == (0, None)
+        assert manifest.get_obs_stats(np.array([0.5, 1.5, 2]), nan=2) == \
+            (2, 1.0)
+
+    def test_consumers(self, tmpdir):
+        filenames, entries = self._write_chunks(str(tmpdir))
+        expected = [utils.get_nb_sample(filenames),
+                    utils.get_nb_sample(filenames, nb_max=7),
+                    utils.get_dna_wlen(filenames[0]),
+                    utils.get_cpg_wlen(filenames[0]),
+                    utils.get_output_names(filenames[0]),
+                    utils.get_output_names(filenames[0], regex='cell1')]
+        assert manifest.get_entry(filenames[0]) is None
+
+        manifest.write_manifest(str(tmpdir), entries)
+        entry = manifest.get_entry(filenames[1])
+        assert entry['nb_sample'] == 5
+        assert entry['datasets'] == \
+            manifest.read_manifest(str(tmpdir))['datasets']
+        actual = [utils.get_nb_sample(filenames),
+                  utils.get_nb_sample(filenames, nb_max=7),
+                  utils.get_dna_wlen(filenames[0]),
+                  utils.get_cpg_wlen(filenames[0]),
+                  utils.get_output_names(filenames[0]),
+                  utils.get_output_names(filenames[0], regex='cell1')]
+        assert actual == expected
+        assert actual[:4] == [16, 7, 11, 4]
+
+        data = hdf.read(filenames, 'pos', nb_sample=7)
+        npt.assert_array_equal(data['pos'], [2, 4, 6, 2, 4, 6, 8])
+
+    def test_unlisted(self, tmpdir):
+        filenames, entries = self._write_chunks(str(tmpdir))
+        del entries[filenames[-1]]
+        manifest.write_manifest(str(tmpdir), entries)
+        assert manifest.get_nb_sample(filenames) is None
+        assert utils.get_nb_sample(filenames) == 16
+        manifest.remove_manifest(str(tmpdir))
+        assert manifest.read_manifest(str(tmpdir)) is None
@@ -0,0 +1,167 @@
+from collections import OrderedDict
+import os
+
+import numpy as np
+import numpy.testing as npt
+
+from deepcpg.data.profiles import CpgProfile, CpgProfileCache, \
+    CpgProfileStore, merge_pos
+
+
+def _profile():
+    data = OrderedDict()
+    data['1'] = (np.array([2, 5, 8], dtype=np.int32),
+                 np.array([0, 1, 0], dtype=np.int8))
+    data['X'] = (np.array([3], dtype=np.int32),
+                 np.array([1], dtype=np.int8))
+    return data
+
+
+class TestCpgProfile(object):
+
+    def test_from_dict(self):
+        profile = CpgProfile.from_dict(_profile())
+        assert len(profile) == 4
+        assert profile.chromos == ['1', 'X']
+        npt.assert_array_equal(profile.offsets, [0, 3, 4])
+        assert '1' in profile
+        assert '2' not in profile
+
+        pos, value = profile.get('1')
+        npt.assert_array_equal(pos, [2, 5, 8])
+        npt.assert_array_equal(value, [0, 1, 0])
+        assert pos.base is profile.pos
+        pos, value = profile.get('2')
+        assert len(pos) == 0 and len(value) == 0
+        assert pos.dtype == np.int32 and value.dtype == np.int8
+
+    def test_save_load(self, tmpdir):
+        profile = CpgProfile.from_dict(_profile())
+        prefix = str(tmpdir.join('cell'))
+        profile.save(prefix)
+        loaded = CpgProfile.load(prefix)
+        assert isinstance(loaded.pos, np.memmap)
+        assert loaded.chromos == profile.chromos
+        for chromo in profile.chromos:
+            for expect, actual in zip(profile.get(chromo),
+                                      loaded.get(chromo)):
+                npt.assert_array_equal(actual, expect)
+
+    def test_get_range(self):
+        profile = CpgProfile.from_dict(_profile())
+        npt.assert_array_equal(profile.get('1', 3, 8)[0], [5, 8])
+        npt.assert_array_equal(profile.get('1', 3, 7)[1], [1])
+        npt.assert_array_equal(profile.get('1', start=5)[0], [5, 8])
+        npt.assert_array_equal(profile.get('1', end=4)[0], [2])
+        npt.assert_array_equal(profile.get('1', 9, 20)[0], [])
+        npt.assert_array_equal(profile.get('1', 5, 5, margin=1)[0],
+                               [2, 5, 8])
+        npt.assert_array_equal(profile.get('1', 6, 7, margin=1)[0], [5, 8])
+        npt.assert_array_equal(profile.get('1', 1, 1, margin=2)[0], [2, 5])
+        npt.assert_array_equal(profile.get('X', 0, 10)[0], [3])
+        assert len(profile.get('2', 0, 10)[0]) == 0
+
+
+def test_cpg_profile_store():
+    store = CpgProfileStore()
+    store.add('cell1', _profile())
+    data = _profile()
+    del data['X']
+    data['2'] = (np.array([1], dtype=np.int32), np.array([1], dtype=np.int8))
+    store.add('cell2', CpgProfile.from_dict(data))
+
+    assert len(store) == 2
+    assert store.names() == ['cell1', 'cell2']
+    assert store.chromos() == ['1', '2', 'X']
+    npt.assert_array_equal(store.get('cell2', '2')[0], [1])
+    chromo_profiles = store.get_chromo('X')
+    npt.assert_array_equal(chromo_profiles[0][0], [3])
+    assert len(chromo_profiles[1][0]) == 0
+
+    pos, cov = store.merge_pos('1')
+    npt.assert_array_equal(pos, [2, 5, 8])
+    npt.assert_array_equal(cov, [2, 2, 2])
+    npt.assert_array_equal(store.coverage('X', [1, 3, 4]), [0, 1, 0])
+
+
+def test_merge_pos():
+    pos, count = merge_pos([np.array([1, 4, 6]), np.array([], dtype=int),
+                            np.array([0, 4, 7, 9]), np.array([6, 9])])
+    npt.assert_array_equal(pos, [0, 1, 4, 6, 7, 9])
+    npt.assert_array_equal(count, [1, 1, 2, 2, 1, 2])
+    pos, count = merge_pos([])
+    assert len(pos) == 0
+    assert len(count) == 0
+
+    pos, count = merge_pos([np.array([1, 4, 6]), np.array([0, 4, 9])],
+                           [np.array([3, 1, 2]), None])
+    npt.assert_array_equal(pos, [0, 1, 4, 6, 9])
+    npt.assert_array_equal(count, [1, 3, 2, 2, 1])
+
+
+def test_merge_pos_batches():
+    rng = np.random.RandomState(0)
+    store = CpgProfileStore()
+    for i in range(7):
+        pos = np.unique(rng.randint(0, 100, 30)).astype(np.int32)
+        store.add('cell%d' % i, {'1': (pos, np.zeros(len(pos), np.int8))})
+    expected = store.merge_pos('1')
+    for max_sites in [1, 50, 1000]:
+        actual = store.merge_pos('1', max_sites=max_sites)
+        npt.assert_array_equal(actual[0], expected[0])
+        npt.assert_array_equal(actual[1], expected[1])
+    npt.assert_array_equal(store.coverage('1', expected[0][5:20]),
+                           expected[1][5:20])
+
+
+class TestCpgProfileCache(object):
+
+    def _write(self, filename, lines):
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_read(self, tmpdir):
+        filename = str(tmpdir.join('cell.tsv'))
+        self._write(filename, ['1\t2\t0', '1\t5\t1', 'X\t3\t1'])
+        cache = CpgProfileCache(str(tmpdir.join('cache')))
+        assert cache.load(filename) is None
+        profile = cache.read(filename)
+        assert profile.chromos == ['1', 'X']
+        npt.assert_array_equal(profile.get('1')[0], [2, 5])
+        assert len(cache.entries()) == 1
+
+        profile = cache.load(filename)
+        assert isinstance(profile.pos, np.memmap)
+        npt.assert_array_equal(profile.get('X')[1], [1])
+
+        # Parsing options are part of the key
+        assert cache.load(filename, chromos=['1']) is None
+        profile = cache.read(filename, chromos=['1'])
+        assert profile.chromos == ['1']
+        assert len(cache.entries()) == 2
+
+        # Modified files are parsed again
+        self._write(filename, ['2\t1\t0', '2\t5\t1', '2\t7\t1'])
+        os.utime(filename, (0, 0))
+        assert cache.load(filename) is None
+        assert cache.read(filename).chromos == ['2']
+
+    def test_prune(self, tmpdir):
+        cache = CpgProfileCache(str(tmpdir.join('cache')))
+        filenames = []
+        for i in range(3):
+            filename = str(tmpdir.join('cell%d.tsv' % i))
+            self._write(filename, ['1\t%d\t0' % j for j in range(i + 1)])
+            filenames.append(filename)
+            cache.read(filename)
+        # Use first profile, which makes the second the least recently used
+        index_file = os.path.join(cache.cache_dir, cache.key(filenames[1]))
+        os.utime(index_file + '.json', (0, 0))
+        assert cache.load(filenames[0]) is not None
+
+        size = sum([entry[1] for entry in cache.entries()])
+        assert cache.prune(size) == 0
+        assert cache.prune(size - 1) == 1
+        assert cache.load(filenames[1]) is None
+        assert cache.load(filenames[0]) is not None
+        assert cache.load(filenames[2]) is not None
@@ -0,0 +1,73 @@
+import numpy as np
+import numpy.testing as npt
+
+from deepcpg.data import stats
+
+
+def _profiles():
+    return [(np.array([1, 3, 5, 8, 15]), np.array([0, 0, 1, 1, 0])),
+            (np.array([], dtype=int), np.array([], dtype=int)),
+            (np.array([4, 5, 20]), np.array([1, 1, 1]))]
+
+
+def test_win_counts():
+    pos = np.array([0, 5, 12, 20])
+    counts = stats.win_counts(pos, _profiles(), [1, 5, 101])
+    assert len(counts) == 3
+
+    nb_obs, nb_met = counts[0]
+    npt.assert_array_equal(nb_obs, [[0, 0, 0], [1, 0, 1], [0, 0, 0],
+                                    [0, 0, 1]])
+    npt.assert_array_equal(nb_met, [[0, 0, 0], [1, 0, 1], [0, 0, 0],
+                                    [0, 0, 1]])
+
+    nb_obs, nb_met = counts[1]
+    npt.assert_array_equal(nb_obs, [[1, 0, 0], [2, 0, 2], [0, 0, 0],
+                                    [0, 0, 1]])
+    npt.assert_array_equal(nb_met, [[0, 0, 0], [1, 0, 2], [0, 0, 0],
+                                    [0, 0, 1]])
+
+    nb_obs, nb_met = counts[2]
+    npt.assert_array_equal(nb_obs, [[5, 0, 3]] * 4)
+    npt.assert_array_equal(nb_met, [[2, 0, 3]] * 4)
+
+
+def test_win_stats():
+    nb_obs = np.array([[0, 0, 0], [2, 0, 2], [4, 1, 0], [1, 1, 1]])
+    nb_met = np.array([[0, 0, 0], [1, 0, 2], [1, 0, 0], [1, 1, 1]])
+    names = ['mean', 'mode', 'var', 'cat_var', 'cat2_var', 'entropy',
+             'diff', 'cov']
+    result = stats.win_stats(nb_obs, nb_met, names)
+    assert list(result.keys()) == names
+
+    x = np.ma.masked_array(nb_met / np.maximum(nb_obs, 1), nb_obs == 0)
+    for name in ['mean', 'mode', 'var', 'cat_var', 'cat2_var', 'entropy']:
+        expect = getattr(stats, name)(x)
+        npt.assert_array_almost_equal(result[name][1:], expect[1:])
+        assert result[name][0] == -1
+    npt.assert_array_equal(result['diff'], [-1, 1, 1, 0])
+    npt.assert_array_equal(result['cov'], [-1, 2, 2, 3])
+
+
+def test_cpg_stats():
+    x = np.array([[-1, -1, -1, -1],
+                  [0, 1, -1, 1],
+                  [1, 1, 1, -1],
+                  [0, -1, 0, 0],
+                  [-1, 1, -1, -1]], dtype=np.int8)
+    names = ['mean', 'mode', 'var', 'cat_var', 'cat2_var', 'entropy',
+             'diff', 'cov']
+    result = stats.cpg_stats(x, names)
+    assert list(result.keys()) == names
+
+    xm = np.ma.masked_values(x, -1)
+    for name in ['mean', 'mode', 'var', 'cat_var', 'cat2_var', 'entropy',
+                 'diff']:
+        expect = getattr(stats, name)(xm)
+        npt.assert_array_almost_equal(result[name][1:], expect[1:])
+        assert result[name][0] == -1
+    npt.assert_array_equal(result['cov'], [-1, 3, 3, 3, 1])
+
+    result = stats.cpg_stats(x, ['mean', 'cov'], min_cov=2)
+    npt.assert_array_equal(result['mean'][[0, 4]], [-1, -1])
+    npt.assert_array_equal(result['cov'], [-1, 3, 3, 3, -1])
@@ -0,0 +1,89 @@
+import sys
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from deepcpg import utils
+
+
+class TestStageTimer(object):
+
+    def test_stage(self, monkeypatch):
+        rss = [100, 150, 150, 150]
+        monkeypatch.setattr(utils, 'get_rss', lambda: rss.pop(0))
+        timer = utils.StageTimer(chromo='1')
+        with timer.stage('write', 10, chunk=1) as record:
+            record['nb_byte'] = 1000
+        with timer.stage('stats'):
+            pass
+        assert len(timer.records) == 2
+        record = timer.records[0]
+        assert list(record.keys())[:5] == \
+            ['chromo', 'chunk', 'stage', 'nb_site', 'nb_byte']
+        assert record['chromo'] == '1'
+        assert record['chunk'] == 1
+        assert record['nb_site'] == 10
+        assert record['nb_byte'] == 1000
+        assert record['time'] >= 0
+        assert record['peak_rss'] == 150
+        assert record['peak_rss_inc'] == 50
+        record = timer.records[1]
+        assert record['nb_site'] == 0
+        assert record['nb_byte'] == 0
+        assert record['peak_rss'] == 150
+        assert record['peak_rss_inc'] == 0
+
+    def test_stage_error(self):
+        timer = utils.StageTimer()
+        with pytest.raises(ValueError):
+            with timer.stage('write'):
+                raise ValueError()
+        # Records of failed stages are kept
+        assert [record['stage'] for record in timer.records] == ['write']
+        assert timer.records[0]['peak_rss'] <= utils.get_rss()
+
+
+def test_get_rss(monkeypatch):
+    resource = pytest.importorskip('resource')
+
+    class Usage(object):
+        ru_maxrss = 100
+
+    monkeypatch.setattr(resource, 'getrusage', lambda who: Usage())
+    monkeypatch.setattr(utils.sys, 'platform', 'linux')
+    assert utils.get_rss() == 100 * 1024
+    monkeypatch.setattr(utils.sys, 'platform', 'darwin')
+    assert utils.get_rss() == 100
+    # `resource` is not available on Windows
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    assert utils.get_rss() == 0
+
+
+def _record(stage, time, nb_site, nb_byte, peak_rss, peak_rss_inc):
+    return dict(stage=stage, time=time, nb_site=nb_site, nb_byte=nb_byte,
+                peak_rss=peak_rss, peak_rss_inc=peak_rss_inc)
+
+
+def test_summarize_stages():
+    mb = 1024**2
+    records = [_record('write', 1, 10, 2 * mb, 10 * mb, 4 * mb),
+               _record('knn', 2, 10, 0, 30 * mb, 20 * mb),
+               _record('write', 1, 20, 3 * mb, 20 * mb, 0)]
+    table = utils.summarize_stages(records)
+    assert table['stage'] == ['write', 'knn', 'total']
+    npt.assert_array_equal(table['time'], [2, 2, 4])
+    npt.assert_array_equal(table['time_per'], [50, 50, 100])
+    assert table['nb_site'] == [30, 10, None]
+    npt.assert_array_equal(table['sites_per_sec'][:2], [15, 5])
+    assert table['sites_per_sec'][2] is None
+    npt.assert_array_equal(table['mb_written'], [5, 0, 5])
+    npt.assert_array_equal(table['peak_rss_mb'], [20, 30, 30])
+    npt.assert_array_equal(table['peak_rss_inc_mb'], [4, 20, 24])
+
+
+def test_summarize_stages_empty():
+    table = utils.summarize_stages([])
+    assert table['stage'] == ['total']
+    assert table['time_per'] == [0]
+    assert np.all(np.array(table['mb_written']) == 0)
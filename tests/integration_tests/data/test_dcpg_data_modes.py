@@ -0,0 +1,500 @@
+"""Tests of `dcpg_data.py` on small generated inputs."""
+
+import gzip
+import importlib.util
+import json
+import os
+import sys
+
+import h5py as h5
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from deepcpg.data import CPG_NAN
+from deepcpg.data import dna
+from deepcpg.data import fasta
+from deepcpg.data import genome
+from deepcpg.data import manifest
+
+
+def _load_script():
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            '..', '..', '..', 'scripts', 'dcpg_data.py')
+    spec = importlib.util.spec_from_file_location('dcpg_data', filename)
+    module = importlib.util.module_from_spec(spec)
+    # Functions of worker processes are pickled by module name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+dcpg_data = _load_script()
+
+CHROMOS = ['1', '2']
+SEQ_LEN = 3000
+
+
+def _write_dna_db(dirname, seed=0):
+    """Writes FASTA file of random sequence with CpG sites per chromosome.
+
+    Returns
+    -------
+    Dict with CpG positions of each chromosome
+    """
+    os.makedirs(dirname)
+    rng = np.random.RandomState(seed)
+    cpgs = dict()
+    for chromo in CHROMOS:
+        seq = rng.choice(list('ACGT'), SEQ_LEN, p=[0.3, 0.2, 0.2, 0.3])
+        seq = ''.join(seq)
+        filename = os.path.join(dirname, 'test.chromosome.%s.fa.gz' % chromo)
+        with gzip.open(filename, 'wt') as f:
+            f.write('>%s\n' % chromo)
+            for i in range(0, len(seq), 60):
+                f.write(seq[i:i + 60] + '\n')
+        cpgs[chromo] = genome.find_cpgs(dna.char_to_int(seq))
+    return cpgs
+
+
+def _write_profiles(dirname, cpgs, nb_cell, seed=0):
+    """Writes profiles of cells that observe random subsets of `cpgs`."""
+    rng = np.random.RandomState(seed)
+    filenames = []
+    for i in range(nb_cell):
+        filename = os.path.join(dirname, 'cell%d.tsv' % i)
+        with open(filename, 'w') as f:
+            for chromo in CHROMOS:
+                pos = cpgs[chromo]
+                pos = np.sort(rng.choice(pos, len(pos) // 3, replace=False))
+                for p in pos:
+                    f.write('%s\t%d\t%d\n' % (chromo, p, rng.randint(2)))
+        filenames.append(filename)
+    return filenames
+
+
+def _run(*args):
+    args = ['dcpg_data.py'] + [str(arg) for arg in args]
+    assert dcpg_data.App().run(args) == 0
+
+
+def _read_chunks(dirname):
+    data = dict()
+    for filename in sorted(os.listdir(dirname)):
+        if not filename.endswith('.h5'):
+            continue
+        with h5.File(os.path.join(dirname, filename), 'r') as h5_file:
+            def _read(name, item):
+                if isinstance(item, h5.Dataset):
+                    data['%s/%s' % (filename, name)] = item[()]
+            h5_file.visititems(_read)
+    return data
+
+
+def _check_manifest(dirname):
+    """Checks that manifest entries match the chunk files of `dirname`."""
+    filenames = [os.path.join(dirname, filename)
+                 for filename in sorted(os.listdir(dirname))
+                 if filename.endswith('.h5')]
+    for filename in filenames:
+        entry = manifest.get_entry(filename)
+        assert entry is not None
+        expected = manifest.describe(filename)
+        for key, value in expected.items():
+            if key == 'datasets':
+                value = [list(dataset) for dataset in value]
+            assert entry[key] == value
+
+
+class _SeekLog(object):
+    """File handle that counts seeks before the current offset."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.nb_seek = 0
+        self.nb_backward = 0
+
+    def seek(self, offset):
+        self.nb_seek += 1
+        self.nb_backward += offset < self.fh.tell()
+        return self.fh.seek(offset)
+
+    def read(self, size):
+        return self.fh.read(size)
+
+    def close(self):
+        self.fh.close()
+
+
+class TestDcpgData(object):
+
+    def _setup(self, tmpdir, nb_cell=3):
+        tmpdir = str(tmpdir)
+        cpgs = _write_dna_db(os.path.join(tmpdir, 'dna_db'))
+        cells = _write_profiles(tmpdir, cpgs, nb_cell)
+        return (tmpdir, cpgs, cells)
+
+    def test_all_cpgs(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        _run('--dna_db', os.path.join(tmpdir, 'dna_db'),
+             '--cpg_profiles', *cells,
+             '--all_cpgs',
+             '--dna_wlen', 11,
+             '--stats', 'mean', 'var',
+             '--win_stats', 'mean',
+             '--win_stats_wlen', 100, 300,
+             '--chunk_size', 50,
+             '--out_dir', out_dir)
+        # Statistics of outputs in manifest are computed in memory
+        _check_manifest(out_dir)
+        data = _read_chunks(out_dir)
+        for chromo in CHROMOS:
+            pos = [value for name, value in sorted(data.items())
+                   if name.startswith('c%s_' % chromo) and
+                   name.endswith('.h5/pos')]
+            pos = np.hstack(pos)
+            # Includes CpG sites that were not observed in any cell
+            npt.assert_array_equal(pos, cpgs[chromo])
+
+    def test_all_cpgs_options(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        pos_file = os.path.join(tmpdir, 'pos.tsv')
+        with open(pos_file, 'w') as f:
+            f.write('1\t%d\n' % cpgs['1'][0])
+        args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                '--cpg_profiles'] + cells + \
+            ['--all_cpgs',
+             '--out_dir', os.path.join(tmpdir, 'data')]
+        for option in [['--cpg_cov', 1], ['--pos_file', pos_file]]:
+            with pytest.raises(ValueError):
+                _run(*(args + option))
+
+    def test_cpg_cov(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        _run('--dna_db', os.path.join(tmpdir, 'dna_db'),
+             '--cpg_profiles', *cells,
+             '--cpg_cov', 2,
+             '--out_dir', out_dir)
+        data = _read_chunks(out_dir)
+        cov = dict()
+        for name, value in data.items():
+            if '/outputs/cpg/' in name:
+                chunk_file = name.split('/')[0]
+                cov[chunk_file] = cov.get(chunk_file, 0) + \
+                    (value != CPG_NAN)
+        assert len(cov)
+        for chunk_cov in cov.values():
+            assert np.all(chunk_cov >= 2)
+
+    def test_nb_worker_no_chromo(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        _run('--dna_db', os.path.join(tmpdir, 'dna_db'),
+             '--cpg_profiles', *cells,
+             '--chromos', 'X',
+             '--nb_worker', 2,
+             '--out_dir', out_dir)
+        assert not _read_chunks(out_dir)
+
+    def test_extract_seq_windows_borders(self):
+        seq = 'ACGTACGTCG'
+        pos = [9, 12, 0, -5]
+        with pytest.warns(UserWarning, match='No CpG at 3 of 4'):
+            wins = dcpg_data.extract_seq_windows(seq, pos, 5)
+        npt.assert_array_equal(wins[0, :3], dna.char_to_int('GTC'))
+        # Windows outside the sequence are filled randomly
+        assert wins.shape == (4, 5)
+        assert wins.max() < 4
+
+    def test_fetch_seq_windows(self, tmpdir, monkeypatch):
+        tmpdir = str(tmpdir)
+        cpgs = _write_dna_db(os.path.join(tmpdir, 'dna_db'))
+        wlen = 11
+        seq = fasta.read_chromo(os.path.join(tmpdir, 'dna_db'), '1')
+        pos = cpgs['1'][(cpgs['1'] > wlen) &
+                        (cpgs['1'] < SEQ_LEN - wlen)]
+        expected = dcpg_data.extract_seq_windows(seq, pos, wlen)
+
+        fetched = []
+
+        class Reader(fasta.IndexedFastaReader):
+
+            def fetch(self, name, start, end):
+                fetched.append(end - start)
+                return super(Reader, self).fetch(name, start, end)
+
+        monkeypatch.setattr(dcpg_data, '_FETCH_MAX_LEN', 500)
+        reader = Reader(fasta.get_chromo_file(os.path.join(tmpdir, 'dna_db'),
+                                              '1'))
+        with reader:
+            actual = dcpg_data.fetch_seq_windows(reader, '1', pos, wlen)
+        # Ranges are split although windows are less than `_FETCH_GAP` apart
+        assert len(fetched) > 1
+        assert max(fetched) <= 500
+        npt.assert_array_equal(actual, expected)
+
+    def test_fasta_dense(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        dna_db = os.path.join(tmpdir, 'dna_db')
+        args = ['--dna_db', dna_db,
+                '--cpg_profiles'] + cells
+        # Windows cover the sequence, which is read without indexing it
+        _run(*(args + ['--dna_wlen', 101,
+                       '--out_dir', os.path.join(tmpdir, 'data')]))
+        assert not [name for name in os.listdir(dna_db)
+                    if name.endswith('.fai')]
+        # Windows cover a small part of the sequence and are read from the
+        # indexed file
+        _run(*(args + ['--dna_wlen', 3,
+                       '--out_dir', os.path.join(tmpdir, 'data_wins')]))
+        assert len([name for name in os.listdir(dna_db)
+                    if name.endswith('.fai')]) == len(CHROMOS)
+
+    def test_memory_budget_fasta(self, tmpdir, monkeypatch):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                '--cpg_profiles'] + cells + \
+            ['--cpg_wlen', 4,
+             '--dna_wlen', 101,
+             '--chunk_size', 20]
+        # Nucleotides outside sequence borders are chosen randomly
+        np.random.seed(0)
+        _run(*(args + ['--out_dir', os.path.join(tmpdir, 'data')]))
+
+        readers = []
+
+        class Reader(fasta.IndexedFastaReader):
+
+            def __init__(self, *args, **kwargs):
+                super(Reader, self).__init__(*args, **kwargs)
+                self.fh = _SeekLog(self.fh)
+                readers.append(self)
+
+        monkeypatch.setattr(fasta, 'IndexedFastaReader', Reader)
+        np.random.seed(0)
+        _run(*(args + ['--memory_budget', 1,
+                       '--out_dir', os.path.join(tmpdir, 'data_budget')]))
+        assert len(readers) == len(CHROMOS)
+        for reader in readers:
+            # Windows of all chunks are read in a single forward pass
+            assert reader.fh.nb_backward == 0
+
+        expected = _read_chunks(os.path.join(tmpdir, 'data'))
+        actual = _read_chunks(os.path.join(tmpdir, 'data_budget'))
+        assert sorted(actual.keys()) == sorted(expected.keys())
+        for name, value in expected.items():
+            npt.assert_array_equal(actual[name], value)
+
+    def test_timing(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        _run('--dna_db', os.path.join(tmpdir, 'dna_db'),
+             '--cpg_profiles', *cells,
+             '--cpg_wlen', 4,
+             '--dna_wlen', 11,
+             '--chunk_size', 50,
+             '--out_dir', out_dir)
+        prefix = os.path.join(out_dir, 'dcpg_data.timing')
+        with open(prefix + '.json') as f:
+            timing = json.load(f)
+        records = timing['records']
+        table = pd.read_csv(prefix + '.tsv', sep='\t')
+        assert list(table['stage']) == [record['stage'] for record in records]
+        assert list(table['nb_byte']) == \
+            [record['nb_byte'] for record in records]
+        stages = set([record['stage'] for record in records])
+        assert {'read_profiles', 'pos_table', 'map', 'write', 'dna_windows',
+                'knn', 'manifest'} <= stages
+        summary = timing['summary']
+        assert summary['stage'][-1] == 'total'
+        assert set(summary['stage'][:-1]) == stages
+
+        # Bytes are counted once per chunk after it is closed
+        chunk_files = [filename for filename in os.listdir(out_dir)
+                       if filename.endswith('.h5')]
+        nb_byte = sum([os.path.getsize(os.path.join(out_dir, filename))
+                       for filename in chunk_files])
+        assert sum([record['nb_byte'] for record in records]) == nb_byte
+        assert summary['mb_written'][-1] * 1024**2 == nb_byte
+        for record in records:
+            assert record['peak_rss'] > 0
+            assert record['peak_rss_inc'] >= 0
+        assert max(summary['peak_rss_mb']) == summary['peak_rss_mb'][-1]
+
+    def test_get_chunk_files(self, tmpdir):
+        tmpdir = str(tmpdir)
+        names = ['c1_1000000-1000050.h5', 'c1_000050-000100.h5',
+                 'c1_000000-000050.h5', 'c10_000000-000050.h5',
+                 'c2_000000-000050.h5', 'c2_000000-000050.h5.tmp1',
+                 'other.h5']
+        for name in names:
+            open(os.path.join(tmpdir, name), 'w').close()
+        chunk_files = dcpg_data.get_chunk_files(tmpdir)
+        assert list(chunk_files.keys()) == ['1', '10', '2']
+        assert [os.path.basename(filename) for filename in chunk_files['1']] \
+            == ['c1_000000-000050.h5', 'c1_000050-000100.h5',
+                'c1_1000000-1000050.h5']
+        assert chunk_files['2'] == [os.path.join(tmpdir,
+                                                 'c2_000000-000050.h5')]
+
+    def test_remove_tmp_files(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                '--cpg_profiles'] + cells + \
+            ['--dna_wlen', 11,
+             '--chunk_size', 50,
+             '--out_dir', out_dir]
+        _run(*(args + ['--chromos', '1']))
+        chunk_file = dcpg_data.get_chunk_files(out_dir)['1'][0]
+        # Temporary files of a killed run and of a run of another chromosome
+        killed = chunk_file + '.tmp1'
+        other = dcpg_data.get_chunk_file(out_dir, '2', 0, 50) + '.tmp1'
+        for filename in [killed, other]:
+            open(filename, 'w').close()
+        _run(*(args + ['--chromos', '1']))
+        assert not os.path.exists(killed)
+        assert os.path.exists(other)
+
+    def test_get_build(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+
+        def get_build(*args):
+            parser = dcpg_data.App().create_parser('dcpg_data.py')
+            args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                    '--cpg_profiles'] + cells + \
+                ['--out_dir', os.path.join(tmpdir, 'data')] + list(args)
+            opts = parser.parse_args([str(arg) for arg in args])
+            return dcpg_data.get_build(opts)
+
+        build = get_build()
+        assert get_build() == build
+        # Options that do not change chunk files
+        assert get_build('--nb_worker', 2, '--resume', '--memory_budget', 1,
+                         '--out_dir', os.path.join(tmpdir, 'data2')) == build
+        # Options and input files that change chunk files
+        assert get_build('--dna_wlen', 11) != build
+        assert get_build('--cpg_profiles', *cells[:2]) != build
+        with open(cells[0], 'a') as f:
+            f.write('2\t%d\t1\n' % cpgs['2'][-1])
+        assert get_build() != build
+
+    def test_append(self, tmpdir, monkeypatch):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                '--all_cpgs',
+                '--cpg_wlen', 4,
+                '--dna_wlen', 11,
+                '--stats', 'mean', 'var',
+                '--win_stats', 'mean',
+                '--win_stats_wlen', 100,
+                '--chunk_size', 50]
+        full_dir = os.path.join(tmpdir, 'data_full')
+        np.random.seed(0)
+        _run(*(args + ['--cpg_profiles'] + cells + ['--out_dir', full_dir]))
+
+        out_dir = os.path.join(tmpdir, 'data')
+        np.random.seed(0)
+        _run(*(args + ['--cpg_profiles'] + cells[:2] + ['--out_dir', out_dir]))
+        chunk_files = dcpg_data.get_chunk_files(out_dir)
+        append_args = ['--append', '--cpg_profiles'] + cells + \
+            ['--out_dir', out_dir]
+
+        # Kill run after the first chunk file was replaced
+        replace = os.replace
+        replaced = []
+
+        def kill_replace(src, dst):
+            replace(src, dst)
+            if dst.endswith('.h5'):
+                replaced.append(dst)
+                raise KeyboardInterrupt()
+
+        monkeypatch.setattr(os, 'replace', kill_replace)
+        with pytest.raises(KeyboardInterrupt):
+            _run(*append_args)
+        monkeypatch.undo()
+        assert replaced == [chunk_files['1'][0]]
+        # Entries of replaced files are not listed
+        assert manifest.get_entry(replaced[0]) is None
+
+        _run(*append_args)
+        _check_manifest(out_dir)
+        assert dcpg_data.get_chunk_files(out_dir) == chunk_files
+        with h5.File(chunk_files['1'][0], 'r') as h5_file:
+            assert sorted(h5_file['outputs/cpg'].keys()) == \
+                ['cell0', 'cell1', 'cell2']
+
+        # Same chunk files as full rebuild
+        expected = _read_chunks(full_dir)
+        actual = _read_chunks(out_dir)
+        assert sorted(actual.keys()) == sorted(expected.keys())
+        for name, value in expected.items():
+            npt.assert_array_equal(actual[name], value)
+        for filenames in chunk_files.values():
+            for filename in filenames:
+                expected = manifest.get_entry(
+                    os.path.join(full_dir, os.path.basename(filename)))
+                assert manifest.get_entry(filename) == expected
+
+    def test_append_cpg_wlen(self, tmpdir):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        _run('--dna_db', os.path.join(tmpdir, 'dna_db'),
+             '--cpg_profiles', *cells[:2],
+             '--all_cpgs',
+             '--chunk_size', 50,
+             '--out_dir', out_dir)
+        # CpG neighbors of existing cells are missing
+        with pytest.raises(ValueError, match='no CpG neighbors'):
+            _run('--append', '--cpg_profiles', *cells,
+                 '--cpg_wlen', 4,
+                 '--out_dir', out_dir)
+        _run('--append', '--cpg_profiles', *cells, '--out_dir', out_dir)
+        data = _read_chunks(out_dir)
+        assert not [name for name in data if '/inputs/cpg/' in name]
+        assert len([name for name in data if name.endswith('/cell2')])
+
+    def test_resume(self, tmpdir, monkeypatch):
+        tmpdir, cpgs, cells = self._setup(tmpdir)
+        out_dir = os.path.join(tmpdir, 'data')
+        args = ['--dna_db', os.path.join(tmpdir, 'dna_db'),
+                '--cpg_profiles'] + cells + \
+            ['--cpg_wlen', 4,
+             '--dna_wlen', 11,
+             '--chunk_size', 50,
+             '--out_dir', out_dir]
+        _run(*args)
+        expected = _read_chunks(out_dir)
+        chunk_files = dcpg_data.get_chunk_files(out_dir)
+        mtimes = dict([(filename, os.stat(filename).st_mtime_ns)
+                       for filenames in chunk_files.values()
+                       for filename in filenames])
+        # Chunk file in the middle of a chromosome, whose DNA windows do not
+        # overlap sequence borders
+        deleted = chunk_files['1'][1]
+        os.remove(deleted)
+
+        described = []
+        describe = manifest.describe
+
+        def describe_log(h5_file, *args, **kwargs):
+            entry = describe(h5_file, *args, **kwargs)
+            described.append(entry)
+            return entry
+
+        monkeypatch.setattr(manifest, 'describe', describe_log)
+        _run(*(args + ['--resume']))
+        # Only the deleted chunk file is written
+        assert len(described) == 1
+        for filename, mtime in mtimes.items():
+            if filename != deleted:
+                assert os.stat(filename).st_mtime_ns == mtime
+        _check_manifest(out_dir)
+        actual = _read_chunks(out_dir)
+        assert sorted(actual.keys()) == sorted(expected.keys())
+        for name, value in expected.items():
+            npt.assert_array_equal(actual[name], value)